@@ -5,7 +5,7 @@
 # only tested on SIM808 but should also work with other SIMCOM chips like SIM800 or SIM900
 # potentially also with others using the AT command protocol
 
-import time, serial, re
+import time, serial, re, threading, queue, collections, asyncio, os, io, json, zlib, array, bisect, calendar, struct, sys, logging, functools, inspect
 
 if __name__=="__main__":
     # initiate object
@@ -29,15 +29,1273 @@ if __name__=="__main__":
     # upload file
     sim.ftp_file_send(file="test_file.txt",dir="/test_dir/")
 
+# a unit of module output as framed by the reader thread
+# kind is one of 'echo', 'final', 'response' (+XXX: ...), 'data' (response followed by a binary payload), 'prompt' or 'text'
+Frame = collections.namedtuple('Frame', ['kind', 'line', 'payload'])
+
+# messages of the module after a restart or shutdown, all settings it had are lost
+POWER_DOWN_URCS = (b'NORMAL POWER DOWN', b'UNDER-VOLTAGE POWER DOWN', b'OVER-VOLTAGE POWER DOWN')
+RESET_URCS = (b'RDY',)+POWER_DOWN_URCS
+# URCs of the start-up and power down of the module, the time each was last received is kept, see SIM808.wait_ready
+MODULE_EVENTS = RESET_URCS+(b'Call Ready', b'SMS Ready')
+
+# largest block the module returns for AT+FTPGET=2,<n> and AT+FTPLIST=2,<n>
+FTP_MAX_CHUNK = 1460
+
+# responses that announce a binary payload of the given length directly after the line
+PAYLOAD_HEADER = re.compile(b'[+](?:FTPGET|FTPLIST): 2,(\\d+)$')
+
+# URCs whose content follows on the next line, a directly delivered SMS (+CMT) as text or PDU
+LINE_PAYLOAD = (b'+CMT:',)
+
+# fixed fields of a +CGNSINF or +UGNSINF line with a fix: UTC, lat, long, altitude, speed, course, HDOP, satellites used
+GPS_FIX = re.compile(b'[+][CU]GNSINF: 1,1,(\\d{14}(?:[.]\\d*)?),([-.\\d]+),([-.\\d]+),([-.\\d]*),([.\\d]*),([.\\d]*),'
+                     b'[^,\\r\\n]*,[^,\\r\\n]*,([.\\d]*),[^,\\r\\n]*,[^,\\r\\n]*,[^,\\r\\n]*,\\d*,(\\d*)')
+
+# response grammar: prefix -> alternatives of (precompiled pattern, conversion of every field)
+# optional fields that are missing are None, see parse_response
+def text_field(value):
+    return value.decode('utf-8', 'replace')
+
+def quoted_field(value):
+    return value.strip(b'"').decode('utf-8', 'replace')
+
+RESPONSES = {
+    # text mode and PDU mode
+    b'+CMGL': ((re.compile(b'[+]CMGL: (\\d+),"(.*)","(.*)","(.*)","(.*)"'), (text_field,)*5),
+               (re.compile(b'[+]CMGL: (\\d+),(\\d),(.*),(\\d+)'), (int, int, text_field, int))),
+    b'+CMGS': ((re.compile(b'[+]CMGS: (\\d+)'), (int,)),),
+    # text mode (sender, alpha, time stamp) and PDU mode (alpha, length)
+    b'+CMT': ((re.compile(b'[+]CMT: "(.*)",(?:"(.*)")?,"(.*)"'), (text_field,)*3),
+              (re.compile(b'[+]CMT: (.*),(\\d+)'), (text_field, int))),
+    b'+CMTI': ((re.compile(b'[+]CMTI: "(.*)",(\\d+)'), (text_field, int)),),
+    b'+SAPBR': ((re.compile(b'[+]SAPBR: (\\d),(\\d),"(\\d+[.]\\d+[.]\\d+[.]\\d+)"'), (int, int, text_field)),),
+    b'+FTPPUT': ((re.compile(b'[+]FTPPUT: (\\d),(\\d+),?(\\d+)?'), (int, int, int)),),
+    b'+FTPGET': ((re.compile(b'[+]FTPGET: (\\d),(\\d+)'), (int, int)),),
+    b'+FTPLIST': ((re.compile(b'[+]FTPLIST: (\\d),(\\d+)'), (int, int)),),
+    b'+FTPSIZE': ((re.compile(b'[+]FTPSIZE: (\\d),(\\d+),?(\\d+)?'), (int, int, int)),),
+    b'+FTPDELE': ((re.compile(b'[+]FTPDELE: (\\d),(\\d+)'), (int, int)),),
+    b'+FTPMKD': ((re.compile(b'[+]FTPMKD: (\\d),(\\d+)'), (int, int)),),
+    b'+FTPRMD': ((re.compile(b'[+]FTPRMD: (\\d),(\\d+)'), (int, int)),),
+    b'+SMTPSEND': ((re.compile(b'[+]SMTPSEND: (\\d+)'), (int,)),),
+    # 1 = module requests attachment data up to a length, 2 = length accepted for AT+SMTPFT
+    b'+SMTPFT': ((re.compile(b'[+]SMTPFT: (\\d),(\\d+)'), (int, int)),),
+    b'+CREG': ((re.compile(b'[+]CREG: (\\d),(\\d),?(".+")?,?(".+")?'), (int, int, text_field, text_field)),),
+    # test command (list of operators) and read command (current operator)
+    b'+COPS': ((re.compile(b'[+]COPS: ([(].+[)]),,([(].+[)]),([(].+[)])'), (text_field, text_field, text_field)),
+               (re.compile(b'[+]COPS: (\\d),?(\\d)?,?(.*)?'), (int, text_field, quoted_field))),
+    b'+IPR': ((re.compile(b'[+]IPR: (\\d+)'), (int,)),),
+}
+
+# converted fields of a response line, None if the line does not follow the grammar
+# prefix (e.g. b'+CREG') restricts the line to one response, otherwise it is taken from the line
+def parse_response(line, prefix=None):
+    alternatives = RESPONSES.get(prefix or line[:line.find(b':')])
+    if alternatives is None:
+        return None
+    for pattern, types in alternatives:
+        m = pattern.match(line)
+        if m:
+            return tuple(None if value is None else convert(value) for convert, value in zip(types, m.groups()))
+    return None
+
+# GSM 03.38 default alphabet, index = septet, and the characters reached through the escape septet 0x1B
+GSM7_BASIC = ('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+              '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXTENDED = {0x0A:'\f', 0x14:'^', 0x28:'{', 0x29:'}', 0x2F:'\\', 0x3C:'[', 0x3D:'~', 0x3E:']', 0x40:'|', 0x65:'€'}
+GSM7_SEPTETS = {c:(i,) for i, c in enumerate(GSM7_BASIC) if i != 0x1B}
+GSM7_SEPTETS.update({c:(0x1B, i) for i, c in GSM7_EXTENDED.items()})
+
+# stat of messages in PDU mode, named like in text mode
+SMS_STAT = {0:'REC UNREAD', 1:'REC READ', 2:'STO UNSENT', 3:'STO SENT', 4:'ALL'}
+
+# septets of text in the default alphabet, None if text has characters outside of it
+def gsm7_encode(text):
+    septets = []
+    for c in text:
+        septet = GSM7_SEPTETS.get(c)
+        if septet is None:
+            return None
+        septets.extend(septet)
+    return septets
+
+def gsm7_decode(septets):
+    text = []
+    escape = False
+    for septet in septets:
+        if escape:
+            text.append(GSM7_EXTENDED.get(septet, ' '))
+            escape = False
+        elif septet == 0x1B:
+            escape = True
+        else:
+            text.append(GSM7_BASIC[septet])
+    return ''.join(text)
+
+# septets are packed least significant bit first, fill bits align them after a user data header
+def gsm7_pack(septets, fill_bits=0):
+    n = 0
+    for i, septet in enumerate(septets):
+        n |= septet << (fill_bits+7*i)
+    return n.to_bytes((fill_bits+7*len(septets)+7)//8, 'little')
+
+def gsm7_unpack(data, count, fill_bits=0):
+    n = int.from_bytes(data, 'little')
+    return [(n >> (fill_bits+7*i)) & 0x7F for i in range(count)]
+
+# phone number of an address field in semi-octets, type 0x91 is international
+def pdu_decode_address(data, digits, type):
+    if type & 0x70 == 0x50:
+        # alphanumeric sender, e.g. the name of a network operator
+        return gsm7_decode(gsm7_unpack(data, digits*4//7))
+    number = ''.join('{:x}{:x}'.format(b & 0x0F, b >> 4) for b in data)[:digits]
+    return ('+' if type == 0x91 else '')+number.upper()
+
+# service centre time stamp as in text mode, yy/MM/dd,hh:mm:ss+zz with the zone in quarter hours
+def pdu_decode_timestamp(data):
+    fields = ['{:x}{:x}'.format(b & 0x0F, b >> 4) for b in data[:6]]
+    zone = data[6]
+    quarters = (zone & 0x07)*10+(zone >> 4)
+    return '{}/{}/{},{}:{}:{}{}{:02d}'.format(*fields, '-' if zone & 0x08 else '+', quarters)
+
+# seconds since the epoch of a time stamp yy/MM/dd,hh:mm:ss+zz, None if it does not follow that format
+def sms_timestamp_seconds(stamp):
+    m = re.match('(\\d\\d)/(\\d\\d)/(\\d\\d),(\\d\\d):(\\d\\d):(\\d\\d)([-+]\\d+)', stamp or '')
+    if not m:
+        return None
+    fields = [int(value) for value in m.groups()]
+    return calendar.timegm((2000+fields[0], fields[1], fields[2], fields[3], fields[4], fields[5], 0, 0, 0))-fields[6]*900
+
+# alphabet of a data coding scheme: 0 = default alphabet, 1 = 8 bit data, 2 = UCS2
+def pdu_alphabet(dcs):
+    if dcs & 0x80 == 0:
+        return (dcs >> 2) & 0x03
+    if dcs & 0xF0 == 0xF0:
+        return 1 if dcs & 0x04 else 0
+    if dcs & 0xF0 == 0xE0:
+        return 2
+    return 0
+
+# decode an SMS-DELIVER or SMS-SUBMIT PDU as listed by AT+CMGL in PDU mode
+# returns the number (sender or recipient), time stamp (DELIVER only), text (None for 8 bit data), raw user data
+# and for parts of concatenated messages the reference, the number of parts and the part number
+def pdu_decode(pdu):
+    data = bytes.fromhex(pdu.decode('ascii') if isinstance(pdu, bytes) else pdu)
+    pos = data[0]+1
+    first = data[pos]
+    pos = pos+1
+    submit = first & 0x03 == 1
+    if submit:
+        # message reference
+        pos = pos+1
+    digits = data[pos]
+    type = data[pos+1]
+    number = pdu_decode_address(data[pos+2:pos+2+(digits+1)//2], digits, type)
+    pos = pos+2+(digits+1)//2
+    dcs = data[pos+1]
+    pos = pos+2
+    timestamp = None
+    if submit:
+        # validity period: none, relative (1 octet) or absolute/enhanced (7 octets)
+        pos = pos+(0, 7, 1, 7)[(first >> 3) & 0x03]
+    else:
+        timestamp = pdu_decode_timestamp(data[pos:pos+7])
+        pos = pos+7
+    length = data[pos]
+    ud = data[pos+1:]
+    message = {'number':number, 'timestamp':timestamp, 'reference':None, 'parts':1, 'part':1}
+    header = 0
+    if first & 0x40:
+        # user data header, concatenation with 8 bit (0x00) or 16 bit (0x08) reference
+        header = ud[0]+1
+        i = 1
+        while i < header:
+            iei = ud[i]
+            iel = ud[i+1]
+            value = ud[i+2:i+2+iel]
+            if iei == 0x00 and iel == 3:
+                message['reference'], message['parts'], message['part'] = value[0], value[1], value[2]
+            elif iei == 0x08 and iel == 4:
+                message['reference'], message['parts'], message['part'] = (value[0] << 8) | value[1], value[2], value[3]
+            i = i+2+iel
+    alphabet = pdu_alphabet(dcs)
+    if alphabet == 0:
+        fill_bits = (7-header*8 % 7) % 7
+        septets = gsm7_unpack(ud[header:], length-(header*8+fill_bits)//7, fill_bits)
+        message['text'] = gsm7_decode(septets)
+        message['data'] = None
+    else:
+        message['data'] = ud[header:length]
+        message['text'] = message['data'].decode('utf-16-be', 'replace') if alphabet == 2 else None
+    return message
+
+# SMS-SUBMIT PDUs for text to number as (hex, length for AT+CMGS), more than one for concatenated messages
+# text in the default alphabet takes up to 160 characters per message (153 per part), others are sent as UCS2 (70, 67 per part)
+# report = True requests a status report, validity is the relative validity period (0xA7 = 24 hours)
+def pdu_encode_submit(number, text, reference=0, report=False, validity=0xA7):
+    gsm7 = gsm7_encode(text) is not None
+    single, limit = (160, 153) if gsm7 else (70, 67)
+    def units(part):
+        return len(gsm7_encode(part)) if gsm7 else len(part.encode('utf-16-be'))//2
+    parts = [text]
+    if units(text) > single:
+        # split between characters, so escape sequences and surrogate pairs stay together
+        parts = ['']
+        for c in text:
+            if units(parts[-1]+c) > limit:
+                parts.append('')
+            parts[-1] = parts[-1]+c
+    digits = number.lstrip('+')
+    semi_octets = digits+('F' if len(digits) % 2 else '')
+    address = '{:02X}{:02X}'.format(len(digits), 0x91 if number.startswith('+') else 0x81)
+    address = address+''.join(semi_octets[i+1]+semi_octets[i] for i in range(0, len(semi_octets), 2))
+    pdus = []
+    for n, part in enumerate(parts):
+        header = bytes([0x05, 0x00, 0x03, reference % 256, len(parts), n+1]) if len(parts) > 1 else b''
+        if gsm7:
+            septets = gsm7_encode(part)
+            fill_bits = (7-len(header)*8 % 7) % 7
+            ud = header+gsm7_pack(septets, fill_bits)
+            length = (len(header)*8+fill_bits)//7+len(septets)
+        else:
+            ud = header+part.encode('utf-16-be')
+            length = len(ud)
+        first = 0x11 | (0x20 if report else 0) | (0x40 if header else 0)
+        tpdu = '{:02X}00{}00{:02X}{:02X}{:02X}{}'.format(first, address, 0x00 if gsm7 else 0x08, validity, length, ud.hex().upper())
+        pdus.append(('00'+tpdu, len(tpdu)//2))
+    return pdus
+
+# unix style listing of most FTP servers, entries of ftp_list_dir and ftp_list_iter
+FTP_LIST_ENCODING = ['([\\w-]+)\\s+(\\d+)\\s+(\\w+)\\s+(\\w+)\\s+(\\d+)\\s+(.+\\s+.+\\s+.+)\\s+(.+)',
+                     ['permissions','links','user','group','size','date/time','name']]
+
+FTP_ERRORS = {1:'No Error',61:'Net Error',62:'DNS Error',63:'Connect Error',64:'Timeout',
+                65:'Server Error',66:'Operation not allowed', 70:'Replay Error',71:'User Error',
+                72:'Password Error',73:'Type Error',74:'Rest Error',75:'Passive error',
+                76:'Active error',77:'Operate Error',78:'Upload Error',79:'Download Error',
+                86:'Manual Quit'}
+
+# FTPSIZE error of a file that does not exist on the server
+FTP_FILE_MISSING = 77
+
+SMTP_ERRORS = {61:'Network error',62:'DNS resolve error',63:'SMTP TCP connection error',64:'Timeout of SMTP server response',
+                65:'SMTP server response error',66:'No authentication',68:'Bad recipient',
+                67:'Authentication failed. SMTP user name or password maybe not right.'}
+
+# splits the raw byte stream of the module into frames
+class ATFramer():
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.payload_length = 0
+        self.payload_header = b''
+        self.line_header = None
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        buffer = self.buffer
+        while buffer:
+            # binary payload announced by the previous line
+            if self.payload_length:
+                if len(buffer) < self.payload_length:
+                    break
+                # single copy out of the receive buffer, deleting from its front does not move the rest
+                with memoryview(buffer) as view:
+                    payload = bytes(view[:self.payload_length])
+                del buffer[:self.payload_length]
+                self.payload_length = 0
+                frames.append(Frame('data', self.payload_header, payload))
+                continue
+            # input prompt of AT+CMGS and similar commands is not terminated by a line break
+            if self.line_header is None and buffer[:2] == b'> ':
+                del buffer[:2]
+                frames.append(Frame('prompt', b'>', b''))
+                continue
+            end = buffer.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(buffer[:end]).strip(b'\r')
+            del buffer[:end+1]
+            if not line:
+                continue
+            if self.line_header is not None:
+                frames.append(Frame('response', self.line_header, line))
+                self.line_header = None
+                continue
+            if line.startswith(LINE_PAYLOAD):
+                self.line_header = line
+                continue
+            m = PAYLOAD_HEADER.match(line)
+            if m and int(m.group(1)) > 0:
+                self.payload_length = int(m.group(1))
+                self.payload_header = line
+                continue
+            frames.append(Frame(self.classify(line), line, b''))
+        return frames
+
+    def classify(self, line):
+        if line in (b'OK', b'ERROR', b'NO CARRIER') or line.startswith((b'+CME ERROR', b'+CMS ERROR')):
+            return 'final'
+        if line[:2] in (b'AT', b'at'):
+            return 'echo'
+        if line[:1] == b'+':
+            return 'response'
+        return 'text'
+
+# file-like view of an iterator of bytes, so uploads can read exactly as many bytes as the module accepts
+class IteratorReader(io.RawIOBase):
+
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    # fills b as far as the iterator allows, a short read means the iterator is exhausted
+    def readinto(self, b):
+        n = 0
+        while n < len(b):
+            if not self.pending:
+                try:
+                    self.pending = memoryview(next(self.iterator))
+                except StopIteration:
+                    break
+                continue
+            count = min(len(b)-n, len(self.pending))
+            b[n:n+count] = self.pending[:count]
+            self.pending = self.pending[count:]
+            n = n+count
+        return n
+
+# on-disk record of unfinished FTP transfers, so they continue at the last confirmed offset after a reboot
+# every entry holds the remote dir and name, the local path, the file size, the confirmed offset
+# and the crc32 of the data up to that offset
+class TransferJournal():
+
+    # the journal is written at most every interval bytes of progress to spare the SD card
+    def __init__(self, path, interval=16384):
+        self.path = path
+        self.interval = interval
+        self.unsaved = 0
+        try:
+            with open(path) as f:
+                self.transfers = json.load(f)
+        except (OSError, ValueError):
+            self.transfers = {}
+
+    def key(self, direction, dir, name):
+        return '{} {}{}'.format(direction, dir, name)
+
+    def get(self, key):
+        return self.transfers.get(key)
+
+    def start(self, key, dir, name, local, size, mtime=None, offset=0, crc=0):
+        self.transfers[key] = {'dir':dir, 'name':name, 'local':local, 'size':size, 'mtime':mtime, 'offset':offset, 'crc':crc}
+        self.save()
+        return self.transfers[key]
+
+    # record a confirmed chunk, sync is called before the journal is written so the data is on disk first
+    def advance(self, key, chunk, sync=None):
+        entry = self.transfers[key]
+        entry['offset'] = entry['offset']+len(chunk)
+        entry['crc'] = zlib.crc32(chunk, entry['crc'])
+        self.unsaved = self.unsaved+len(chunk)
+        if self.unsaved >= self.interval:
+            if sync is not None:
+                sync()
+            self.save()
+
+    def finish(self, key):
+        self.transfers.pop(key, None)
+        self.save()
+
+    # written to a temporary file first, so a power cut leaves either the old or the new journal
+    def save(self):
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.transfers, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.unsaved = 0
+
+    # crc32 of the first length bytes of a local file
+    def checksum(self, path, length):
+        crc = 0
+        with open(path, 'rb') as f:
+            while length > 0:
+                block = f.read(min(length, 65536))
+                if not block:
+                    return None
+                crc = zlib.crc32(block, crc)
+                length = length-len(block)
+        return crc
+
+# remote directory listings and file sizes by server and directory, so existence and size checks need no FTP session
+# entries are trusted for ttl seconds, the driver updates them after its own uploads, deletes and new directories
+# uploads from local files also keep the modification time of the file, which shows changes of the same size (see ftp_sync)
+# with a path the cache is kept in a file and survives restarts
+class FTPCache():
+
+    def __init__(self, ttl=300, path=None):
+        self.ttl = ttl
+        self.path = path
+        # 'server|dir' -> {'listed': time of the last complete listing, 'files': {name: {'size', 'time', 'mtime'}}}
+        self.dirs = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.dirs = json.load(f)
+            except (OSError, ValueError):
+                self.dirs = {}
+
+    def key(self, server, dir):
+        return '{}|{}'.format(server, dir if dir.endswith('/') else dir+'/')
+
+    def fresh(self, t):
+        return t is not None and time.time()-t < self.ttl
+
+    # names and sizes of a directory (None for subdirectories), None if it was not listed within ttl
+    def listing(self, server, dir):
+        entry = self.dirs.get(self.key(server, dir))
+        if entry is None or not self.fresh(entry['listed']):
+            return None
+        return {name:file['size'] for name, file in entry['files'].items()}
+
+    # size of a file, 0 if a recent listing does not contain it, None if unknown
+    def size(self, server, dir, name):
+        entry = self.dirs.get(self.key(server, dir))
+        if entry is None:
+            return None
+        file = entry['files'].get(name)
+        if file is not None and self.fresh(file['time']):
+            return file['size']
+        if file is None and self.fresh(entry['listed']):
+            return 0
+        return None
+
+    # modification time of the local file that was uploaded last, None if unknown
+    def mtime(self, server, dir, name):
+        entry = self.dirs.get(self.key(server, dir))
+        file = entry['files'].get(name) if entry is not None else None
+        return file['mtime'] if file is not None else None
+
+    def set_listing(self, server, dir, files):
+        entry = self.dirs.setdefault(self.key(server, dir), {'listed':None, 'files':{}})
+        now = time.time()
+        old = entry['files']
+        # a known upload stays valid as long as the server reports the same size
+        entry['files'] = {name:{'size':size, 'time':now, 'mtime':old[name]['mtime'] if name in old and old[name]['size'] == size else None}
+                          for name, size in files.items()}
+        entry['listed'] = now
+        self.save()
+
+    def set_size(self, server, dir, name, size, mtime=None):
+        entry = self.dirs.setdefault(self.key(server, dir), {'listed':None, 'files':{}})
+        entry['files'][name] = {'size':size, 'time':time.time(), 'mtime':mtime}
+        self.save()
+
+    def remove(self, server, dir, name):
+        entry = self.dirs.get(self.key(server, dir))
+        if entry is not None:
+            entry['files'].pop(name, None)
+            self.save()
+
+    # forget a directory, all directories of a server or everything
+    def invalidate(self, server=None, dir=None):
+        if dir is not None:
+            self.dirs.pop(self.key(server, dir), None)
+        elif server is not None:
+            self.dirs = {key:entry for key, entry in self.dirs.items() if not key.startswith(server+'|')}
+        else:
+            self.dirs = {}
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.dirs, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+# messages of a queue file, a file that cannot be read is logged and kept as path.bad and the queue starts empty
+def load_messages(path):
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.getLogger('SIM808').warning('Could not read {} ({}), kept as {}.bad'.format(path, e, path))
+        try:
+            os.replace(path, path+'.bad')
+        except OSError:
+            pass
+        return []
+
+# persistent queue of outgoing SMS, kept in a file so nothing is lost if the program or the module restarts
+# every message is split into its PDUs when it is added, the message reference (+CMGS: <mr>) of every sent part is kept
+# for matching delivery reports, sent messages stay until purge()
+class SMSQueue():
+
+    def __init__(self, path, report=False):
+        self.path = path
+        self.report = report
+        self.messages = load_messages(path)
+        self.next_id = max([m['id'] for m in self.messages], default=0)+1
+
+    def add(self, number, text):
+        message = {'id':self.next_id, 'number':number, 'text':text, 'state':'queued', 'attempts':0, 'created':time.time(), 'parts':[]}
+        for pdu, length in pdu_encode_submit(number, text, reference=self.next_id, report=self.report):
+            message['parts'].append({'pdu':pdu, 'length':length, 'mr':None, 'sent':None})
+        self.next_id = self.next_id+1
+        self.messages.append(message)
+        self.save()
+        return message['id']
+
+    def pending(self):
+        return [m for m in self.messages if m['state'] == 'queued']
+
+    # message and part number of a message reference, for status reports
+    def find(self, mr):
+        for message in reversed(self.messages):
+            for n, part in enumerate(message['parts']):
+                if part['mr'] == mr:
+                    return message, n
+        return None, None
+
+    def sent(self, message, part, mr):
+        message['parts'][part]['mr'] = mr
+        message['parts'][part]['sent'] = time.time()
+        if all(p['mr'] is not None for p in message['parts']):
+            message['state'] = 'sent'
+        self.save()
+
+    def failed(self, message, attempts):
+        message['attempts'] = message['attempts']+1
+        if message['attempts'] >= attempts:
+            message['state'] = 'failed'
+        self.save()
+
+    # drop sent (and failed) messages
+    def purge(self, failed=False):
+        self.messages = [m for m in self.messages if m['state'] == 'queued' or (m['state'] == 'failed' and not failed)]
+        self.save()
+
+    def save(self):
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.messages, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+# append-only inbox of received SMS, one JSON line per message, so they never have to be stored on the SIM
+# messages are indexed by the time stamp of the service centre (seconds since the epoch) and by sender
+# parts of concatenated messages are written as they arrive and joined to one message when the last part is there
+class SMSInbox():
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (time, file offset) in order of time, file offsets by sender
+        self.times = []
+        self.senders = {}
+        # received parts of incomplete messages by (sender, reference, parts)
+        self.parts = {}
+        self.size = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # last line cut short by a power loss
+                        break
+                    self.index(json.loads(line), self.size)
+                    self.size = self.size+len(line)
+            if self.size < os.path.getsize(path):
+                os.truncate(path, self.size)
+
+    def __len__(self):
+        return len(self.times)
+
+    def index(self, record, offset):
+        key = (record['sender'], record['reference'], record['parts'])
+        if record['part'] is not None:
+            self.parts.setdefault(key, {})[record['part']] = record
+            return
+        self.parts.pop(key, None)
+        bisect.insort(self.times, (record['time'], offset))
+        self.senders.setdefault(record['sender'], []).append(offset)
+
+    def append(self, record):
+        line = (json.dumps(record)+'\n').encode('utf-8')
+        with open(self.path, 'ab') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.index(record, self.size)
+        self.size = self.size+len(line)
+
+    # store a received message with sender, timestamp, message (text or None) and data (bytes or None),
+    # parts of a concatenated message also with reference, parts and part
+    # returns the complete message as stored, None while parts are missing
+    def add(self, message):
+        parts = message.get('parts', 1)
+        record = {'sender':message['sender'], 'timestamp':message['timestamp'], 'time':sms_timestamp_seconds(message['timestamp']),
+                  'received':time.time(), 'message':message['message'],
+                  'data':None if message.get('data') is None else message['data'].hex(),
+                  'reference':message.get('reference') if parts > 1 else None, 'parts':parts, 'part':None}
+        if record['time'] is None:
+            record['time'] = record['received']
+        with self.lock:
+            if parts > 1:
+                self.append(dict(record, part=message['part']))
+                received = self.parts[(record['sender'], record['reference'], parts)]
+                if len(received) < parts:
+                    return None
+                received = [received[part] for part in sorted(received)]
+                record['timestamp'] = received[0]['timestamp']
+                record['time'] = received[0]['time']
+                if all(part['message'] is not None for part in received):
+                    record['message'] = ''.join(part['message'] for part in received)
+                if all(part['data'] is not None for part in received):
+                    record['data'] = ''.join(part['data'] for part in received)
+            self.append(record)
+        return self.decode(record)
+
+    def decode(self, record):
+        message = dict(record)
+        del message['part']
+        if message['data'] is not None:
+            message['data'] = bytes.fromhex(message['data'])
+        return message
+
+    def read(self, offsets):
+        messages = []
+        with self.lock, open(self.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                messages.append(self.decode(json.loads(f.readline())))
+        return messages
+
+    # messages with a time stamp from start up to (not including) end, oldest first
+    def between(self, start, end):
+        first = bisect.bisect_left(self.times, (start,))
+        last = bisect.bisect_left(self.times, (end,))
+        return self.read([offset for t, offset in self.times[first:last]])
+
+    # messages of a sender in order of arrival
+    def sender(self, number):
+        return self.read(self.senders.get(number, []))
+
+    # the count most recent messages by time stamp, oldest first
+    def latest(self, count=10):
+        return self.read([offset for t, offset in self.times[-count:]])
+
+# persistent outbox of emails, sent by SIM808.email_send_outbox over one SMTP setup
+# attachments are local paths, which are only read while the email is sent, sent emails stay until purge()
+class EmailOutbox():
+
+    def __init__(self, path):
+        self.path = path
+        self.messages = load_messages(path)
+        self.next_id = max([m['id'] for m in self.messages], default=0)+1
+
+    def add(self, subject, message, to_address, to_name, cc_address='', cc_name='', bcc_address='', bcc_name='', attachments=()):
+        email = {'id':self.next_id, 'subject':subject, 'message':message, 'to':[to_address, to_name], 'cc':[cc_address, cc_name],
+                 'bcc':[bcc_address, bcc_name], 'attachments':list(attachments), 'state':'queued', 'attempts':0,
+                 'created':time.time(), 'sent':None}
+        self.next_id = self.next_id+1
+        self.messages.append(email)
+        self.save()
+        return email['id']
+
+    def pending(self):
+        return [m for m in self.messages if m['state'] == 'queued']
+
+    def sent(self, message):
+        message['state'] = 'sent'
+        message['sent'] = time.time()
+        self.save()
+
+    def failed(self, message, attempts):
+        message['attempts'] = message['attempts']+1
+        if message['attempts'] >= attempts:
+            message['state'] = 'failed'
+        self.save()
+
+    # drop sent (and failed) emails
+    def purge(self, failed=False):
+        self.messages = [m for m in self.messages if m['state'] == 'queued' or (m['state'] == 'failed' and not failed)]
+        self.save()
+
+    def save(self):
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.messages, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+# duty cycle of a battery powered logger: jobs are queued with a deadline and a priority and run together in as few
+# wake windows as possible, the module sleeps in between
+# a window opens lead seconds before the earliest deadline and runs every queued job by priority and deadline, so jobs
+# without urgency ride along with urgent ones, network jobs share the bearer the window opened first and wait for the
+# next window without using up an attempt if it could not be opened
+# idle: 'standby' = slow clock between windows (DTR pin), 'off' = power off (power pin), None = the module stays on
+# wake windows, awake seconds and jobs are counted in sim.metrics.counters, every window is kept in windows
+class DutyCycleScheduler():
+
+    def __init__(self, sim, idle='standby', lead=30, bearer=1, apn=None, attempts=3, retry=300, window=None):
+        # without the pin the module could not be woken again and no job would ever run
+        if idle == 'standby' and sim.dtr_pin == 0:
+            raise ValueError('idle = standby needs the DTR pin')
+        if idle == 'off' and sim.pwr_pin == 0:
+            raise ValueError('idle = off needs the power pin')
+        self.sim = sim
+        self.idle = idle
+        self.lead = lead
+        self.bearer = bearer
+        self.apn = apn
+        # a failed job is tried again after retry seconds until it failed attempts times
+        self.attempts = attempts
+        self.retry = retry
+        # maximum length of a window in seconds, jobs that do not fit wait for the next one
+        self.window = window
+        # start is the time.monotonic() from which a job opens a window, lead seconds before its deadline or its retry
+        self.jobs = []
+        self.windows = []
+        self.next_id = 1
+        self.lock = threading.Lock()
+        # set when jobs are added, so run() reconsiders the next window
+        self.changed = threading.Event()
+
+    # function(sim) returns a true value on success, deadline: seconds from now until the job should have run
+    # network = True opens the bearer of the window before the job, returns the id of the job
+    # network jobs need the apn of the scheduler or of sim.ftp_parameters/email_parameters, without one they could never run
+    def add(self, function, deadline=3600, priority=0, network=False, name=None):
+        if network and not (self.apn or getattr(self.sim, 'apn', None)):
+            raise ValueError('network jobs need an apn')
+        with self.lock:
+            due = time.monotonic()+deadline
+            job = {'id':self.next_id, 'name':name or getattr(function, '__name__', 'job'), 'function':function,
+                   'due':due, 'start':due-self.lead, 'priority':priority, 'network':network, 'attempts':0}
+            self.next_id = self.next_id+1
+            self.jobs.append(job)
+        self.changed.set()
+        return job['id']
+
+    def cancel(self, id):
+        with self.lock:
+            self.jobs = [job for job in self.jobs if job['id'] != id]
+
+    # time.monotonic() when the next window opens, None without jobs
+    def next_window(self):
+        with self.lock:
+            if not self.jobs:
+                return None
+            return min(job['start'] for job in self.jobs)
+
+    # runs a window if one is due or force is set, returns its record or None
+    def run_pending(self, force=False):
+        start = self.next_window()
+        if start is None or (start > time.monotonic() and not force):
+            return None
+        return self.run_window()
+
+    # runs windows until no jobs are left or stop() returns True, waiting for the next window in between
+    def run(self, stop=None, poll=60):
+        while not (stop and stop()):
+            start = self.next_window()
+            if start is None:
+                return
+            self.changed.clear()
+            if start > time.monotonic():
+                self.changed.wait(min(start-time.monotonic(), poll))
+                continue
+            self.run_window()
+
+    def wake(self):
+        if self.idle == 'standby':
+            return self.sim.standby(0)
+        if self.idle == 'off':
+            return self.sim.power(True)
+        return True
+
+    # bearers are closed before the slow clock, a powered down module loses them anyway
+    def sleep(self):
+        if self.idle == 'standby':
+            self.sim.bearer_close_idle(idle=0)
+            return self.sim.standby(1)
+        if self.idle == 'off':
+            return self.sim.power(False)
+        return True
+
+    def run_window(self):
+        counters = self.sim.metrics.counters
+        start = time.monotonic()
+        bytes_in, bytes_out = counters['bytes_in'], counters['bytes_out']
+        record = {'time':time.time(), 'awake':False, 'seconds':0, 'bytes_in':0, 'bytes_out':0, 'jobs':[]}
+        # every job rides along, except failed ones that wait for their retry
+        with self.lock:
+            jobs = sorted((job for job in self.jobs if job['attempts'] == 0 or job['start'] <= start),
+                          key=lambda job: (-job['priority'], job['due']))
+        record['awake'] = self.wake()
+        bearer = None
+        for job in jobs:
+            if not record['awake'] or (self.window is not None and time.monotonic()-start >= self.window):
+                break
+            job_start = time.monotonic()
+            if job['network'] and bearer is None:
+                bearer = self.sim.bearer_acquire(self.bearer, self.apn or self.sim.apn, attempts=self.attempts)
+            if job['network'] and not bearer:
+                # not the job's fault, it waits for the next try without using up an attempt
+                with self.lock:
+                    job['start'] = max(job['start'], time.monotonic()+self.retry)
+                counters['jobs_deferred'] += 1
+                continue
+            done = False
+            try:
+                done = bool(job['function'](self.sim))
+            except Exception as e:
+                self.sim.report('Job {} failed: {}'.format(job['name'], e), level=logging.WARNING)
+            late = time.monotonic() > job['due']
+            with self.lock:
+                job['attempts'] = job['attempts']+1
+                if done or job['attempts'] >= self.attempts:
+                    self.jobs = [j for j in self.jobs if j is not job]
+                else:
+                    job['start'] = time.monotonic()+self.retry
+            counters['jobs_done' if done else 'jobs_failed'] += 1
+            if late:
+                counters['jobs_late'] += 1
+            record['jobs'].append({'id':job['id'], 'name':job['name'], 'done':done, 'late':late, 'seconds':time.monotonic()-job_start})
+        if not record['awake']:
+            # jobs are not counted as failed if the module did not wake up, the window is tried again after retry
+            with self.lock:
+                for job in jobs:
+                    job['start'] = max(job['start'], time.monotonic()+self.retry)
+            counters['wake_failures'] += 1
+            self.sim.report('Module did not wake up, next try in {} seconds.'.format(self.retry), level=logging.WARNING)
+        else:
+            self.sleep()
+        record['seconds'] = time.monotonic()-start
+        record['bytes_in'] = counters['bytes_in']-bytes_in
+        record['bytes_out'] = counters['bytes_out']-bytes_out
+        if record['awake']:
+            counters['wake_windows'] += 1
+            counters['awake_seconds'] += record['seconds']
+        self.windows.append(record)
+        self.sim.report('Wake window: {} of {} jobs done in {:.1f} seconds, {} bytes.'.format(
+            sum(job['done'] for job in record['jobs']), len(jobs), record['seconds'], record['bytes_in']+record['bytes_out']))
+        return record
+
+    # totals over the windows in which the module was awake
+    def stats(self):
+        with self.lock:
+            queued = len(self.jobs)
+        awake = [window for window in self.windows if window['awake']]
+        windows = len(awake)
+        seconds = sum(window['seconds'] for window in awake)
+        transferred = sum(window['bytes_in']+window['bytes_out'] for window in awake)
+        jobs = [job for window in self.windows for job in window['jobs']]
+        return {'windows':windows, 'awake_seconds':seconds, 'bytes':transferred, 'bytes_per_wake':transferred/windows if windows else 0,
+                'seconds_per_wake':seconds/windows if windows else 0, 'jobs_done':sum(job['done'] for job in jobs),
+                'jobs_failed':sum(not job['done'] for job in jobs), 'jobs_late':sum(job['late'] for job in jobs),
+                'queued':queued}
+
+# GPS fixes stored column-wise in typed arrays, a few bytes per fix instead of a dict
+# time is the UTC of the fix in seconds since the epoch, missing values are nan (0 for sats)
+# fixes are expected in chronological order, as the module reports them
+class GPSTrack():
+
+    columns = (('time','d'), ('lat','d'), ('lon','d'), ('alt','f'), ('speed','f'), ('course','f'), ('hdop','f'), ('sats','H'))
+    magic = b'GPST'
+
+    def __init__(self):
+        for name, typecode in self.columns:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, i):
+        return {name:getattr(self, name)[i] for name, typecode in self.columns}
+
+    # add a single +CGNSINF/+UGNSINF line, False if it holds no fix
+    def append(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        m = GPS_FIX.match(line.strip())
+        if m is None:
+            return False
+        self.add(m.groups())
+        return True
+
+    # parse many lines at once, either as one bytes block (e.g. a log file) or an iterable of lines
+    # lines without a fix are skipped, returns the number of fixes added
+    def extend(self, lines):
+        if not isinstance(lines, (bytes, bytearray)):
+            lines = b'\n'.join(line.encode('utf-8') if isinstance(line, str) else line for line in lines)
+        n = 0
+        for m in GPS_FIX.finditer(lines):
+            self.add(m.groups())
+            n = n+1
+        return n
+
+    def add(self, fields):
+        utc, lat, lon, alt, speed, course, hdop, sats = fields
+        self.time.append(calendar.timegm((int(utc[0:4]), int(utc[4:6]), int(utc[6:8]), int(utc[8:10]), int(utc[10:12]), 0)) + float(utc[12:]))
+        self.lat.append(float(lat))
+        self.lon.append(float(lon))
+        self.alt.append(float(alt or 'nan'))
+        self.speed.append(float(speed or 'nan'))
+        self.course.append(float(course or 'nan'))
+        self.hdop.append(float(hdop or 'nan'))
+        self.sats.append(int(sats or 0))
+
+    # fixes with start <= time < end as a new track
+    def between(self, start, end):
+        i = bisect.bisect_left(self.time, start)
+        j = bisect.bisect_left(self.time, end)
+        track = GPSTrack()
+        for name, typecode in self.columns:
+            setattr(track, name, getattr(self, name)[i:j])
+        return track
+
+    # columns as numpy arrays, copied so the track can still grow while they are in use
+    # copy = False returns views of the arrays without copying, the track must not grow while a view is alive
+    # (adding a fix raises BufferError then), numpy is only needed for this function
+    def to_numpy(self, copy=True):
+        import numpy
+        if copy:
+            return {name:numpy.array(getattr(self, name), dtype=typecode) for name, typecode in self.columns}
+        return {name:numpy.frombuffer(getattr(self, name), dtype=typecode) for name, typecode in self.columns}
+
+    # binary file: magic, byte order, number of fixes, then every column as raw array
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.magic + (b'<' if sys.byteorder == 'little' else b'>') + struct.pack('<I', len(self)))
+            for name, typecode in self.columns:
+                f.write(getattr(self, name))
+
+    @classmethod
+    def load(cls, path):
+        track = cls()
+        with open(path, 'rb') as f:
+            header = f.read(9)
+            if header[:4] != cls.magic:
+                raise ValueError('{} is not a GPS track file'.format(path))
+            n = struct.unpack('<I', header[5:9])[0]
+            for name, typecode in cls.columns:
+                column = getattr(track, name)
+                column.fromfile(f, n)
+                if header[4:5] != (b'<' if sys.byteorder == 'little' else b'>'):
+                    column.byteswap()
+        return track
+
+# counters and command timings of a connection to the module
+# counters: commands, timeouts, retries, decode_errors, package_errors, bytes_in, bytes_out
+# sinks get command(name, seconds, final) after every command and message(text, level) for every report,
+# a sink can leave out either method, a plain function is called like command
+class Metrics():
+
+    def __init__(self, sinks=()):
+        self.counters = collections.Counter()
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks = self.sinks+[sink]
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks = [s for s in self.sinks if s is not sink]
+
+    def command(self, cmd, seconds, final):
+        self.counters['commands'] += 1
+        if final is None:
+            self.counters['timeouts'] += 1
+        if not self.sinks:
+            return
+        # timings are grouped by command without parameters, e.g. AT+FTPGET
+        name = cmd.split(b'=')[0].rstrip(b'?').decode('utf-8', 'replace')
+        for sink in self.sinks:
+            if hasattr(sink, 'command'):
+                sink.command(name, seconds, final)
+            elif callable(sink):
+                sink(name, seconds, final)
+
+    def message(self, text, level=logging.INFO):
+        for sink in self.sinks:
+            if hasattr(sink, 'message'):
+                sink.message(str(text).strip(), level)
+
+    # counters and histograms of HistogramSinks in the Prometheus text format
+    def prometheus(self, prefix='sim808'):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        for sink in self.sinks:
+            if isinstance(sink, HistogramSink):
+                lines.extend(sink.prometheus(prefix))
+        return '\n'.join(lines)+'\n'
+
+# passes reports and command timings to a logger, e.g. for headless operation
+class LoggingSink():
+
+    def __init__(self, logger=None, command_level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('SIM808')
+        self.command_level = command_level
+
+    def command(self, name, seconds, final):
+        self.logger.log(self.command_level, '%s: %s after %.3f s', name, final, seconds)
+
+    def message(self, text, level):
+        self.logger.log(level, text)
+
+# in-memory histogram of command durations, one per command
+class HistogramSink():
+
+    def __init__(self, buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 120)):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+
+    def command(self, name, seconds, final):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {'counts':[0]*(len(self.buckets)+1), 'sum':0.0, 'count':0}
+        histogram['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    # upper bucket bound below which the fraction q of the durations of name lie, inf beyond the last bucket
+    def quantile(self, name, q):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            return None
+        total = 0
+        for bound, count in zip(self.buckets+(float('inf'),), histogram['counts']):
+            total = total+count
+            if total >= q*histogram['count']:
+                return bound
+        return float('inf')
+
+    def prometheus(self, prefix='sim808'):
+        lines = ['# TYPE {}_command_seconds histogram'.format(prefix)]
+        for name, histogram in sorted(self.histograms.items()):
+            total = 0
+            for bound, count in zip(self.buckets+('+Inf',), histogram['counts']):
+                total = total+count
+                lines.append('{}_command_seconds_bucket{{command="{}",le="{}"}} {}'.format(prefix, name, bound, total))
+            lines.append('{}_command_seconds_sum{{command="{}"}} {}'.format(prefix, name, histogram['sum']))
+            lines.append('{}_command_seconds_count{{command="{}"}} {}'.format(prefix, name, histogram['count']))
+        return lines
+
+# binary log of serial traffic: RECORDING_MAGIC, start as wall clock time, then one record per read or write:
+# direction (b'<' read from the module, b'>' written to it), seconds since the start, length, data
+RECORDING_MAGIC = b'SIM808REC1'
+RECORDING_RECORD = struct.Struct('<cdI')
+
+# records of a serial log as (direction, seconds, data)
+def read_recording(path):
+    with open(path, 'rb') as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError('{} is not a serial recording'.format(path))
+        f.read(8)
+        while True:
+            header = f.read(RECORDING_RECORD.size)
+            if len(header) < RECORDING_RECORD.size:
+                return
+            direction, seconds, length = RECORDING_RECORD.unpack(header)
+            yield direction, seconds, f.read(length)
+
+# tap on a serial port that logs every read and write, everything else is passed to the port
+class SerialRecorder():
+
+    def __init__(self, port, path):
+        self.port = port
+        self.file = open(path, 'wb')
+        self.file.write(RECORDING_MAGIC + struct.pack('<d', time.time()))
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def record(self, direction, data):
+        with self.lock:
+            # the reader thread may still return data after detach
+            if self.file.closed:
+                return
+            self.file.write(RECORDING_RECORD.pack(direction, time.monotonic()-self.start, len(data)))
+            self.file.write(data)
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.record(b'<', data)
+        return data
+
+    def write(self, data):
+        self.record(b'>', bytes(data))
+        return self.port.write(data)
+
+    # stop recording, the port stays open
+    def detach(self):
+        with self.lock:
+            self.file.close()
+        return self.port
+
+    def close(self):
+        self.detach()
+        self.port.close()
+
+# stand-in for a serial port that plays back what the module sent in a recording, to be passed as port to SIM808
+# recorded reads are held back until the driver has written as many bytes as before them in the recording,
+# so responses never arrive ahead of their commands
+# realtime = True also keeps the recorded delays, otherwise data is delivered as fast as possible
+class ReplayPort():
+
+    def __init__(self, path, realtime=True, timeout=1):
+        self.records = []
+        written = 0
+        for direction, seconds, data in read_recording(path):
+            if direction == b'>':
+                written = written+len(data)
+            self.records.append((direction, seconds, data, written))
+        self.realtime = realtime
+        self.timeout = timeout
+        self.is_open = True
+        self.written = 0
+        self.pending = bytearray()
+        self.index = 0
+        self.previous = 0.0
+        self.clock = time.monotonic()
+        self.condition = threading.Condition()
+
+    # move recorded data into pending as far as the driver's writes and the recorded delays allow
+    # returns the local time at which the next record is due, None if waiting for the driver or at the end
+    def pump(self):
+        while self.index < len(self.records):
+            direction, seconds, data, written = self.records[self.index]
+            if direction == b'>':
+                if self.written < written:
+                    return None
+                if self.realtime:
+                    self.clock = max(self.clock, time.monotonic())
+            else:
+                due = self.clock+seconds-self.previous
+                if self.realtime and time.monotonic() < due:
+                    return due
+                self.pending += data
+                self.clock = due
+            self.previous = seconds
+            self.index = self.index+1
+        return None
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self.pump()
+            return len(self.pending)
+
+    def read(self, size=1):
+        deadline = time.monotonic()+(self.timeout or 0)
+        with self.condition:
+            while self.is_open:
+                due = self.pump()
+                if self.pending:
+                    data = bytes(self.pending[:size])
+                    del self.pending[:size]
+                    return data
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                self.condition.wait(min(deadline, due or deadline)-now)
+        return b''
+
+    # writes are not sent anywhere, they only release the recorded responses
+    def write(self, data):
+        with self.condition:
+            self.written = self.written+len(data)
+            self.pump()
+            self.condition.notify_all()
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.pending = bytearray()
+
+    # True once everything in the recording has been delivered
+    def finished(self):
+        with self.condition:
+            return self.index >= len(self.records) and not self.pending
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+# runs a method of SIM808 as one transaction on the port: other threads, e.g. URC handlers, only send commands
+# before or after it, so they cannot take or flush its responses (see SIM808.command_lock)
+# generators hold the lock until they are exhausted or closed
+# coroutines of AsyncSIM808 hold its asyncio lock instead, which the task that holds it can enter again
+def transaction(function):
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def locked(self, *args, **kwargs):
+            task = asyncio.current_task()
+            if self.lock_task is task:
+                return await function(self, *args, **kwargs)
+            async with self.lock:
+                self.lock_task = task
+                try:
+                    return await function(self, *args, **kwargs)
+                finally:
+                    self.lock_task = None
+    elif inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def locked(self, *args, **kwargs):
+            with self.command_lock:
+                return (yield from function(self, *args, **kwargs))
+    else:
+        @functools.wraps(function)
+        def locked(self, *args, **kwargs):
+            with self.command_lock:
+                return function(self, *args, **kwargs)
+    return locked
+
 class SIM808():
     
-    def __init__(self, port="/dev/ttyAMA0", baud=115200, t_out=1, rtscts=False, xonxoff=False, dtr_pin=0, pwr_pin=0):
-        self.port = serial.Serial(port, baudrate=baud, timeout=t_out)
-        self.ftp_errors = {1:'No Error',61:'Net Error',62:'DNS Error',63:'Connect Error',64:'Timeout',
-                            65:'Server Error',66:'Operation not allowed', 70:'Replay Error',71:'User Error',
-                            72:'Password Error',73:'Type Error',74:'Rest Error',75:'Passive error',
-                            76:'Active error',77:'Operate Error',78:'Upload Error',79:'Download Error',
-                            86:'Manual Quit'}
+    # verbose: 0 = no printing, 1 = status and errors, 2 = also progress of transfers and retries
+    # metrics: Metrics object collecting counters and command timings, see Metrics for sinks
+    # port can also be an open port object, e.g. a ReplayPort
+    def __init__(self, port="/dev/ttyAMA0", baud=115200, t_out=1, rtscts=False, xonxoff=False, dtr_pin=0, pwr_pin=0, verbose=1, metrics=None):
+        if isinstance(port, str):
+            port = serial.Serial(port, baudrate=baud, timeout=t_out)
+        self.port = port
+        self.verbose = verbose
+        self.metrics = metrics or Metrics()
+        self.ftp_errors = FTP_ERRORS
+        # request size for FTP reads, lowered if the module refuses it
+        self.ftp_chunk_max = FTP_MAX_CHUNK
+        # FTPCache of remote listings and sizes, updated by uploads, deletes and new directories if set
+        self.ftp_cache = None
+        # last confirmed setting commands of the module by key, see write_setting
+        self.settings = {}
+        # known status of the bearers by cid, the time they were last handed out and the backoff after failures, see bearer_acquire
+        self.bearers = {}
+        self.bearer_used = {}
+        self.bearer_backoff = {}
+        # time.monotonic() of the last RDY, Call Ready, SMS Ready and power down URCs, notified through module_changed
+        self.module_events = {}
+        self.module_changed = threading.Condition()
         self.dtr_pin = dtr_pin
         if dtr_pin != 0:
             import RPi.GPIO
@@ -51,9 +1309,39 @@ class SIM808():
             self.gpio.setmode(self.gpio.BOARD)
             self.gpio.setup(self.pwr_pin, self.gpio.OUT)  
             self.gpio.output(self.pwr_pin,self.gpio.HIGH)        
+        
+        # SerialRecorder while recording, see record
+        self.recorder = None
+        # held by every command and multi-command transaction, see transaction
+        self.command_lock = threading.RLock()
+        # background reader, frames everything the module sends into self.frames
+        self.frames = queue.Queue()
+        self.framer = ATFramer()
+        self.reading = True
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        
+        # handlers for unsolicited result codes by prefix, called from a separate dispatcher thread
+        # so they can send commands themselves without blocking the reader, the commands wait for a running transaction
+        self.urc_handlers = {}
+        self.urc_consumed = set()
+        self.urcs = queue.Queue()
+        self.dispatcher = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.dispatcher.start()
+        
+        # fixes received in streaming mode, see gps_stream_start
+        self.gps_fixes = collections.deque(maxlen=3600)
+        self.gps_callbacks = []
+        self.gps_track = None
+        
+        # inbox and callbacks of directly delivered SMS, see sms_receive_start
+        self.sms_inbox = None
+        self.sms_callbacks = []
             
     def __del__(self):
-        # close serial port on destruction of object
+        # stop reader and close serial port on destruction of object
+        self.reading = False
+        self.urcs.put(None)
         self.port.close()
         
         #clear Gpio pins if used
@@ -64,33 +1352,196 @@ class SIM808():
         
     def __repr__(self):
         return str(self.gps_read())
+    
+    # runs in the reader thread, blocks on the serial port only for as long as no data arrives
+    def read_loop(self):
+        while self.reading:
+            try:
+                data = self.port.read(self.port.in_waiting or 1)
+            except Exception:
+                break
+            if not data:
+                continue
+            recorder = self.recorder
+            if recorder is not None:
+                recorder.record(b'<', data)
+            self.metrics.counters['bytes_in'] += len(data)
+            for frame in self.framer.feed(data):
+                self.track_state(frame)
+                consumed = False
+                for prefix, handlers in list(self.urc_handlers.items()):
+                    if frame.line.startswith(prefix):
+                        consumed = consumed or prefix in self.urc_consumed
+                        for handler in handlers:
+                            self.urcs.put((handler, frame))
+                if not consumed:
+                    self.frames.put(frame)
+    
+    # state the module changes on its own: settings are lost on a restart, bearers are closed by the network
+    def track_state(self, frame):
+        if frame.line in MODULE_EVENTS:
+            with self.module_changed:
+                self.module_events[frame.line] = time.monotonic()
+                self.module_changed.notify_all()
+        if frame.line in RESET_URCS:
+            self.settings = {}
+            self.bearers = {}
+        elif frame.line.startswith(b'+SAPBR ') and frame.line[7:8].isdigit():
+            # e.g. +SAPBR 1: DEACT
+            self.bearers[int(frame.line[7:8])] = 3
+    
+    # runs in the dispatcher thread, a failing handler must not stop the delivery of later URCs
+    def dispatch_loop(self):
+        while True:
+            item = self.urcs.get()
+            if item is None:
+                return
+            handler, frame = item
+            try:
+                handler(frame)
+            except Exception as e:
+                self.report('URC handler for {} failed: {}'.format(frame.line, e), level=logging.WARNING)
+    
+    # subscribe handler(frame) to unsolicited result codes starting with prefix, e.g.
+    # '+CMTI:' new SMS, '+SAPBR ' bearer deactivated, '+FTPGET: 1,' FTP download events, 'RING', '+CPIN:'
+    # URCs are still delivered to the running command as well, so subscribing does not change its behaviour
+    # consume = True keeps them away from commands, for frequent URCs that no command waits for
+    def urc_subscribe(self, prefix, handler, consume=False):
+        if isinstance(prefix, str):
+            prefix = prefix.encode('utf-8')
+        handlers = list(self.urc_handlers.get(prefix, []))
+        handlers.append(handler)
+        self.urc_handlers[prefix] = handlers
+        if consume:
+            self.urc_consumed.add(prefix)
+    
+    # handler = None removes all handlers of prefix
+    def urc_unsubscribe(self, prefix, handler=None):
+        if isinstance(prefix, str):
+            prefix = prefix.encode('utf-8')
+        handlers = [h for h in self.urc_handlers.get(prefix, []) if handler is not None and h != handler]
+        if handlers:
+            self.urc_handlers[prefix] = handlers
+        else:
+            self.urc_handlers.pop(prefix, None)
+            self.urc_consumed.discard(prefix)
+    
+    # log all serial traffic with timestamps to path until record_stop, see ReplayPort for playing it back
+    # the port is not swapped, the reader may already wait for data on it, it hands every chunk to the recorder instead
+    def record(self, path):
+        self.record_stop()
+        self.recorder = SerialRecorder(self.port, path)
+    
+    def record_stop(self):
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            recorder.detach()
+    
+    # progress and error messages, passed to the metrics sinks and printed depending on verbose
+    # hot = True for messages within transfers and retries, which are only printed with verbose = 2
+    def report(self, text, hot=False, end='\n', level=None):
+        self.metrics.message(text, level or (logging.DEBUG if hot else logging.INFO))
+        if self.verbose >= (2 if hot else 1):
+            print(text, end=end)
+    
+    def write(self, data):
+        self.metrics.counters['bytes_out'] += len(data)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(b'>', bytes(data))
+        self.port.write(data)
+    
+    # discard frames that were received before the next command
+    # subscribed URCs among them have already been passed to their handlers
+    def flush(self):
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                return
+    
+    # next frame from the reader, None if nothing arrives before the deadline
+    def next_frame(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            return self.frames.get(timeout=remaining)
+        except queue.Empty:
+            return None
+    
+    # collect frames until a final result code arrives
+    # returns the final result code (None on timeout) and the intermediate frames
+    def read_response(self, timeout=5, echo=None):
+        deadline = time.monotonic() + timeout
+        frames = []
+        while True:
+            frame = self.next_frame(deadline)
+            if frame is None:
+                return None, frames
+            if frame.kind == 'final':
+                return frame.line, frames
+            if frame.kind == 'echo' and frame.line == echo:
+                continue
+            frames.append(frame)
+    
+    # write a command and return as soon as its final result code arrives
+    # flush = False keeps frames received before the command, e.g. URCs of a running FTP session
+    @transaction
+    def write_command(self, cmd, timeout=5, flush=True):
+        if isinstance(cmd, str):
+            cmd = cmd.encode('utf-8')
+        cmd = cmd.strip()
+        if flush:
+            self.flush()
+        start = time.monotonic()
+        self.write(cmd+b'\r\n')
+        final, frames = self.read_response(timeout, echo=cmd)
+        self.metrics.command(cmd, time.monotonic()-start, final)
+        return final, frames
+    
+    # wait for a frame starting with prefix (bytes or tuple of bytes), skipping all others
+    def wait_for(self, prefix, timeout=5):
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.next_frame(deadline)
+            if frame is None:
+                self.metrics.counters['timeouts'] += 1
+                return None
+            if frame.line.startswith(prefix):
+                return frame
         
-    def power(self, on=True, attempts=3):
+    # on: wakes the module from slow clock or switches it on with the power pin, returns as soon as it is ready (see wait_ready)
+    # off: returns as soon as the module reports the power down, or does not answer anymore
+    # timeout: deadline in seconds for every attempt, probe: seconds the AT probe after a lost power down URC waits for an answer
+    def power(self, on=True, attempts=3, timeout=10, probe=1):
+        self.settings = {}
+        self.bearers = {}
         for i in range(attempts):
             if on:
-                if self.standby(0,attempts=1):
+                if self.standby(0,attempts=1,timeout=1) or self.wait_ready(timeout=0.5):
+                    return True
+                since = time.monotonic()
+                if not self.power_toggle():
+                    return False
+                if self.wait_ready(timeout=timeout, since=since):
                     return True
-                else:
-                    self.power_toggle()
-                    if self.standby(0,attempts=attempts):
-                        return True
-                    else:
-                        continue
             else:
-                self.port.write(b'AT+CPOWD=1\r\n')
-                self.port.write(b'AT+CCID\r\n')
-                failed = False
-                for i in range(attempts*3):
-                    if self.port.readline() != b'':
-                        failed  = True
-                        break
-                if failed:
-                    continue
-                else:
+                since = time.monotonic()
+                self.write(b'AT+CPOWD=1\r\n')
+                if self.wait_event(POWER_DOWN_URCS, timeout, since) is not None:
+                    return True
+                # the URC can get lost, the module is off if it does not answer anymore
+                final, frames = self.write_command('AT', timeout=probe)
+                if final is None and not frames:
                     return True
         return False
-        
-    def power_toggle(self,duration=3):
+    
+    # the module switches on or off after the power pin was held low for duration seconds
+    def power_toggle(self,duration=1.5):
+        self.settings = {}
+        self.bearers = {}
         if self.pwr_pin != 0:
             self.gpio.output(self.pwr_pin,self.gpio.LOW)
             time.sleep(duration)
@@ -98,31 +1549,77 @@ class SIM808():
             return True
         return False
     
+    # the first of events the module sent since the time.monotonic() since, None if there is none
+    def module_event(self, events, since):
+        for event in events:
+            if self.module_events.get(event, since-1) >= since:
+                return event
+        return None
+    
+    # wait for one of events (URCs of MODULE_EVENTS) sent since since (default now), returns it or None after timeout seconds
+    def wait_event(self, events, timeout, since=None):
+        since = time.monotonic() if since is None else since
+        deadline = time.monotonic()+timeout
+        with self.module_changed:
+            while True:
+                event = self.module_event(events, since)
+                remaining = deadline-time.monotonic()
+                if event is not None or remaining <= 0:
+                    return event
+                self.module_changed.wait(remaining)
+    
+    # wait until the module accepts commands: it sent one of events since since (default now) or answers an AT probe
+    # a probe is sent every probe seconds, this also lets an auto-bauding module (AT+IPR=0), which sends no RDY, detect the baudrate
+    # probe = None only waits for the URCs, e.g. events=(b'SMS Ready',) before sending the first SMS after start-up
+    # returns as soon as the module is ready, False after timeout seconds
+    def wait_ready(self, timeout=10, since=None, events=(b'RDY',), probe=0.5):
+        since = time.monotonic() if since is None else since
+        deadline = time.monotonic()+timeout
+        while True:
+            remaining = deadline-time.monotonic()
+            if self.module_event(events, since) is not None:
+                return True
+            if remaining <= 0:
+                return False
+            if probe is None:
+                return self.wait_event(events, remaining, since) is not None
+            # a URC that arrives while the probe is pending ends the wait as well, both are frames of the reader
+            probe_deadline = time.monotonic()+min(probe, remaining)
+            with self.command_lock:
+                self.flush()
+                self.write(b'AT\r\n')
+                while True:
+                    frame = self.next_frame(probe_deadline)
+                    if frame is None:
+                        break
+                    if frame.kind == 'final' or self.module_event(events, since) is not None:
+                        return True
+    
     # 0 = slow clock off, 1 = slow clock on, 2 = slow clock auto
     # dtr pin needs to be connected and initialized for manual options
-    def standby(self,stby=1, attempts=3):
+    # timeout: deadline in seconds for the module to wake up after DTR went low
+    def standby(self,stby=1, attempts=3, timeout=5):
         for i in range(attempts):
             if stby == 1:
                 if self.dtr_pin == 0:
                     return False
                 self.gpio.output(self.dtr_pin,self.gpio.HIGH)
-                if not self.write_simple_command('AT+CSCLK=1',attempts):
+                if not self.write_setting('AT+CSCLK=1',attempts):
                     continue
                 return True
             if stby == 0:
                 if self.dtr_pin == 0:
                     return False
                 self.gpio.output(self.dtr_pin,self.gpio.LOW)
-                self.port.write(b'AT+CSCLK=0\r\n')
-                time.sleep(3)
-                self.port.write(b'AT+CCID\r\n')
-                for i in range(attempts*3):
-                    line = self.port.readline() 
-                    if line != b'' and line != b'AT+CSCLK=0\r\n' and line != b'AT+CCID\r\n':
-                        return True
+                # the serial port answers again a few milliseconds after DTR went low
+                if not self.wait_ready(timeout=timeout, probe=0.1):
+                    continue
+                if self.write_simple_command('AT+CSCLK=0',attempts=1):
+                    self.settings['AT+CSCLK'] = 'AT+CSCLK=0'
+                    return True
                 continue
             if stby == 2:
-                if not self.write_simple_command('AT+CSCLK=2',attempts):
+                if not self.write_setting('AT+CSCLK=2',attempts):
                     continue
                 return True
         return False
@@ -140,39 +1637,30 @@ class SIM808():
     def sms_get(self, type='ALL', mode=0, attempts=3):
         for i in range(attempts):
             # set SMS Text Mode (1= txt, 0 = PDU)
-            if not self.write_simple_command('AT+CMGF=1'):
+            if not self.write_setting('AT+CMGF=1'):
                 continue
-            pattern = re.compile('[+]CMGL: (\d),"(.*)","(.*)","(.*)","(.*)"\\r\\n')
-
-            self.port.write('AT+CMGL="{}",{}\r\n'.format(type,mode).encode('utf-8'))
-            for j in range(25):
-                line = self.port.readline()
-                if line == 'AT+CMGL="{}",{}\r\r\n'.format(type,mode).encode('utf-8'):
-                    messages = []
-                    for i in range(150):
-                        try:
-                            line = self.port.readline().decode('utf-8')
-                        except:
-                            continue
-                        if line == 'OK\r\n':
-                            return messages
-                        m = pattern.match(line)
-                        if m:
-                            index = m.group(1)
-                            stat = m.group(2)
-                            sender = m.group(3)
-                            alpha = m.group(4)
-                            timestamp = m.group(5)
-                            try:
-                                line = self.port.readline()
-                                message = line.decode('utf-8')
-                            except Exception as e:
-                                message = "Decoding error"
-                            message = message.strip('\r\n')
-                            messages.append({'index':index,'stat':stat,'sender':sender,'alpha':alpha,'timestamp':timestamp,'message':message})
-                            self.port.readline()
-                    return messages
+            final, frames = self.write_command('AT+CMGL="{}",{}'.format(type,mode), timeout=20)
+            if final != b'OK':
+                continue
+            return self.sms_parse_list(frames)
         return None
+    
+    # every +CMGL header is followed by the message text
+    def sms_parse_list(self, frames):
+        messages = []
+        for j in range(len(frames)):
+            fields = parse_response(frames[j].line, b'+CMGL')
+            if fields and len(fields) == 5:
+                index, stat, sender, alpha, timestamp = fields
+                message = ''
+                if j+1 < len(frames) and frames[j+1].kind == 'text':
+                    try:
+                        message = frames[j+1].line.decode('utf-8')
+                    except Exception as e:
+                        self.metrics.counters['decode_errors'] += 1
+                        message = "Decoding error"
+                messages.append({'index':index,'stat':stat,'sender':sender,'alpha':alpha,'timestamp':timestamp,'message':message})
+        return messages
      
     # mode:
     # 0 Delete the message specified in <index>
@@ -186,121 +1674,354 @@ class SIM808():
         cmd = 'AT+CMGD={},{}'.format(index,mode)
         return self.write_simple_command(cmd)
     
-    def sms_send(self, number, message, attempts=3):
-        for i in range(attempts):
-            # set SMS Text Mode (1= txt, 0 = PDU)
-            if not self.write_simple_command('AT+CMGF=1'):
+    # delete many messages with batch deletions concatenated into one command line (AT+CMGD=1;+CMGD=2;...)
+    # returns the indices that could not be deleted
+    def sms_delete_batch(self, indices, batch=10, attempts=3):
+        failed = []
+        indices = list(indices)
+        for i in range(0, len(indices), batch):
+            chunk = indices[i:i+batch]
+            if not self.write_simple_command('AT'+';'.join('+CMGD={}'.format(index) for index in chunk), attempts=attempts, timeout=5+len(chunk)):
+                failed.extend(chunk)
+        return failed
+    
+    # read messages in PDU mode (AT+CMGF=0), decoded and yielded one at a time while the module lists them instead of as one list
+    # stat: 0 = received unread, 1 = received read, 2 = stored unsent, 3 = stored sent, 4 = all
+    # parts of concatenated messages are joined, parts whose rest is missing stay in storage unless partial = True
+    # delete = True deletes every yielded message after the listing, in batches of sms_delete_batch
+    # no other commands can be sent until the generator is exhausted
+    @transaction
+    def sms_iter(self, stat=4, delete=False, batch=10, partial=False, timeout=20):
+        if not self.write_setting('AT+CMGF=0'):
+            return
+        self.flush()
+        self.write('AT+CMGL={}\r\n'.format(stat).encode('utf-8'))
+        parts = {}
+        read = []
+        header = None
+        while True:
+            # timeout applies between messages, a full storage takes longer than that to list
+            frame = self.next_frame(time.monotonic()+timeout)
+            if frame is None:
+                self.metrics.counters['timeouts'] += 1
+                break
+            if frame.kind == 'final':
+                break
+            fields = parse_response(frame.line, b'+CMGL')
+            if fields is not None and len(fields) == 4:
+                header = fields
                 continue
-            
-            # recipient number
-            cmd = 'AT+CMGS=\"{}\"\r\n'.format(number)
-            self.port.write(cmd.encode('utf-8'))
+            if header is None or frame.kind != 'text':
+                continue
+            index, status, alpha, length = header
+            header = None
             try:
-                line = self.port.readline().decode('utf-8')
-            except:
+                pdu = pdu_decode(frame.line)
+            except (ValueError, IndexError):
+                self.metrics.counters['decode_errors'] += 1
                 continue
-            if line != 'AT+CMGS="{}"\r\r\n'.format(number):
+            message = {'index':[index], 'stat':SMS_STAT.get(status, status), 'sender':pdu['number'], 'timestamp':pdu['timestamp'],
+                       'message':pdu['text'], 'data':pdu['data']}
+            if pdu['parts'] < 2:
+                read.extend(message['index'])
+                yield message
                 continue
-            
-            # message content
-            self.port.write(message.encode('utf-8'))
-            try:
-                line = self.port.readline()
-            except:
+            key = (pdu['number'], pdu['reference'], pdu['parts'])
+            received = parts.setdefault(key, {})
+            received[pdu['part']] = message
+            if len(received) == pdu['parts']:
+                del parts[key]
+                message = self.sms_join([received[part] for part in sorted(received)])
+                read.extend(message['index'])
+                yield message
+        if partial:
+            for received in parts.values():
+                message = self.sms_join([received[part] for part in sorted(received)])
+                read.extend(message['index'])
+                yield message
+        if delete and read:
+            self.sms_delete_batch(read, batch)
+    
+    # one message from the parts of a concatenated message in order
+    def sms_join(self, parts):
+        message = dict(parts[0])
+        message['index'] = [index for part in parts for index in part['index']]
+        if all(part['message'] is not None for part in parts):
+            message['message'] = ''.join(part['message'] for part in parts)
+        if all(part['data'] is not None for part in parts):
+            message['data'] = b''.join(part['data'] for part in parts)
+        return message
+    
+    @transaction
+    def sms_send(self, number, message, attempts=3):
+        for i in range(attempts):
+            # set SMS Text Mode (1= txt, 0 = PDU)
+            if not self.write_setting('AT+CMGF=1'):
                 continue
-            if line != '> {}'.format(message).encode('utf-8'):
+            
+            # recipient number, module answers with an input prompt
+            self.flush()
+            self.write('AT+CMGS=\"{}\"\r'.format(number).encode('utf-8'))
+            frame = self.wait_for((b'>', b'ERROR', b'+CMS ERROR'))
+            if frame is None or frame.kind != 'prompt':
                 continue
             
-            # confirmation
-            self.port.write(chr(26).encode('utf-8'))
-            self.port.write('\r\n'.encode('utf-8'))
-            for i in range(25):
-                if self.port.readline() == b'OK\r\n':
-                    return True
+            # message content and confirmation
+            self.write(message.encode('utf-8'))
+            self.write(chr(26).encode('utf-8'))
+            final, frames = self.read_response(timeout=60)
+            if final == b'OK':
+                return True
         return False
     
-    def gps_activate(self,on=True):
-        if on:
-            return self.write_simple_command('AT+CGNSPWR=1')
-        else:
-            return self.write_simple_command('AT+CGNSPWR=0')
+    # send one PDU as made by pdu_encode_submit, returns the message reference or None
+    @transaction
+    def sms_send_pdu(self, pdu, length, timeout=60):
+        if not self.write_setting('AT+CMGF=0'):
+            return None
+        self.flush()
+        self.write('AT+CMGS={}\r'.format(length).encode('utf-8'))
+        frame = self.wait_for((b'>', b'ERROR', b'+CMS ERROR'))
+        if frame is None or frame.kind != 'prompt':
+            return None
+        self.write(pdu.encode('utf-8')+b'\x1a')
+        final, frames = self.read_response(timeout=timeout)
+        if final != b'OK':
+            return None
+        for frame in frames:
+            fields = parse_response(frame.line, b'+CMGS')
+            if fields:
+                return fields[0]
+        return None
     
-    def gps_timestamp_to_dict(self,stamp):
-        return {'year':int(stamp[0:4]),'month':int(stamp[4:6]),'day':int(stamp[6:8]),
-                'hour':int(stamp[8:10]),'minute':int(stamp[10:12]),'second':float(stamp[12:14])}
+    # send the pending messages of an SMSQueue in one session, AT+CMMS=2 keeps the radio link open between them
+    # a failed part is tried again after a growing pause (congestion), a message fails after attempts tries
+    # limit sets the maximum number of messages to send in this call
+    def sms_send_queue(self, sms_queue, attempts=3, limit=None, timeout=60):
+        start = time.time()
+        result = {'sent':0, 'failed':0, 'parts':0, 'seconds':0}
+        pending = sms_queue.pending()[:limit]
+        if not pending:
+            return result
+        self.write_setting('AT+CMMS=2')
+        pause = 1
+        for message in pending:
+            while message['state'] == 'queued':
+                part = next(n for n, p in enumerate(message['parts']) if p['mr'] is None)
+                mr = self.sms_send_pdu(message['parts'][part]['pdu'], message['parts'][part]['length'], timeout)
+                if mr is None:
+                    sms_queue.failed(message, attempts)
+                    if message['state'] == 'queued':
+                        time.sleep(pause)
+                        pause = min(pause*2, 30)
+                    continue
+                pause = 1
+                sms_queue.sent(message, part, mr)
+                result['parts'] = result['parts']+1
+            result['sent' if message['state'] == 'sent' else 'failed'] += 1
+        self.write_setting('AT+CMMS=0')
+        result['seconds'] = time.time()-start
+        self.report('Sent {} SMS ({} parts, {} failed) in {:.1f} seconds.'.format(result['sent'], result['parts'], result['failed'], result['seconds']))
+        return result
+    
+    # let the module pass received SMS straight to the host as +CMT URCs (AT+CNMI=2,2) instead of storing them on the SIM
+    # every message is appended to inbox (SMSInbox) and then passed to the callbacks of sms_subscribe
+    # messages arrive in the current mode, PDU mode (AT+CMGF=0, as set by sms_iter) also receives data and multipart messages
+    def sms_receive_start(self, inbox):
+        self.sms_inbox = inbox
+        self.urc_unsubscribe('+CMT:', self.sms_on_urc)
+        self.urc_subscribe('+CMT:', self.sms_on_urc, consume=True)
+        return self.write_setting('AT+CNMI=2,2,0,0,0')
+    
+    # store received SMS on the SIM again, announced by +CMTI
+    def sms_receive_stop(self):
+        self.urc_unsubscribe('+CMT:', self.sms_on_urc)
+        return self.write_setting('AT+CNMI=2,1,0,0,0')
+    
+    # the framer attaches the text or PDU of the message to the +CMT line as payload
+    def sms_on_urc(self, frame):
+        fields = parse_response(frame.line, b'+CMT')
+        if fields is None or self.sms_inbox is None:
+            return
+        if len(fields) == 3:
+            message = {'sender':fields[0], 'timestamp':fields[2], 'message':frame.payload.decode('utf-8', 'replace'), 'data':None}
+        else:
+            try:
+                pdu = pdu_decode(frame.payload)
+            except (ValueError, IndexError):
+                self.metrics.counters['decode_errors'] += 1
+                return
+            message = {'sender':pdu['number'], 'timestamp':pdu['timestamp'], 'message':pdu['text'], 'data':pdu['data'],
+                       'reference':pdu['reference'], 'parts':pdu['parts'], 'part':pdu['part']}
+        self.metrics.counters['sms_received'] += 1
+        message = self.sms_inbox.add(message)
+        if message is not None:
+            for callback in self.sms_callbacks:
+                callback(message)
+    
+    # callback(message) is called for every complete received message, from the URC dispatcher
+    def sms_subscribe(self, callback):
+        self.sms_callbacks = self.sms_callbacks+[callback]
+    
+    def sms_unsubscribe(self, callback):
+        self.sms_callbacks = [c for c in self.sms_callbacks if c != callback]
+    
+    def gps_activate(self,on=True):
+        if on:
+            return self.write_simple_command('AT+CGNSPWR=1')
+        else:
+            return self.write_simple_command('AT+CGNSPWR=0')
+    
+    def gps_timestamp_to_dict(self,stamp):
+        return {'year':int(stamp[0:4]),'month':int(stamp[4:6]),'day':int(stamp[6:8]),
+                'hour':int(stamp[8:10]),'minute':int(stamp[10:12]),'second':float(stamp[12:14])}
     
     def gps_read(self,attempts=3):
         for i in range(attempts):
-            self.port.write('AT+CGNSINF\r\n'.encode('utf-8'))
-            labels = ['GPSon','GPSfix','UTC','Lat','Long','MSLalt','Speed','Course','FixMode','Res1',
-            'HDOP','PDOP','VDOP','Res2','GPSsatView','GPSsatUsed','GLONASSsatView','Res3','C/N0max','HPA','VPA']
-            integers = [0,1,8,14,15,16,18]
-            floats = [2,3,4,5,6,7,10,11,12,19,20]
-            
-            line = self.port.readline()
-            raw_gps = []
-            gps = {}
-            if line == b'AT+CGNSINF\r\r\n':
-                for i in range(10):
-                    try:
-                        line = self.port.readline().decode('utf-8')
-                    except:
-                        continue
-                    if line == 'OK\r\n':
+            final, frames = self.write_command('AT+CGNSINF')
+            for frame in frames:
+                if frame.line.startswith(b'+CGNSINF:'):
+                    gps = self.gps_parse(frame.line)
+                    if gps is not None:
                         return gps
-                    raw_gps = line[10:-2].split(',')
-                    for i in range(len(raw_gps)):
-                        if i in integers:
-                            try:
-                                gps[labels[i]] = int(raw_gps[i])
-                            except:
-                                gps[labels[i]] = raw_gps[i]
-                        elif i in floats:
-                            try:
-                                gps[labels[i]] = float(raw_gps[i])
-                            except:
-                                gps[labels[i]] = raw_gps[i]
-                        else:
-                            gps[labels[i]] = raw_gps[i]
-                    gps['UTCdict']=self.gps_timestamp_to_dict(str(gps['UTC']))
-                    return gps
+            if final == b'OK':
+                return {}
         return None
     
+    # report fixes as +UGNSINF URCs instead of polling, every interval-th fix (1 Hz at interval 1)
+    # fixes are kept in a ring buffer of the last size fixes, see gps_latest, gps_since and gps_subscribe
+    # the URCs are consumed by the stream, so commands can be sent in between as usual
+    # fixes are also appended to track if a GPSTrack is given
+    def gps_stream_start(self, interval=1, size=3600, track=None):
+        self.gps_track = track
+        if self.gps_fixes.maxlen != size:
+            self.gps_fixes = collections.deque(self.gps_fixes, maxlen=size)
+        self.urc_unsubscribe('+UGNSINF:', self.gps_on_urc)
+        self.urc_subscribe('+UGNSINF:', self.gps_on_urc, consume=True)
+        return self.write_setting('AT+CGNSURC={}'.format(interval))
+    
+    def gps_stream_stop(self):
+        self.urc_unsubscribe('+UGNSINF:', self.gps_on_urc)
+        return self.write_setting('AT+CGNSURC=0')
+    
+    # +UGNSINF has the same fields as +CGNSINF, only fixes are kept
+    # 'received' is the local time.time() of arrival
+    def gps_on_urc(self, frame):
+        try:
+            gps = self.gps_parse(frame.line)
+        except ValueError:
+            return
+        if gps is None or gps.get('GPSfix') != 1:
+            return
+        gps['received'] = time.time()
+        self.gps_fixes.append(gps)
+        # a failing consumer must not keep the fix from the others
+        if self.gps_track is not None:
+            try:
+                self.gps_track.append(frame.line)
+            except Exception as e:
+                self.report('GPS track failed: {}'.format(e), level=logging.WARNING)
+        for callback in self.gps_callbacks:
+            try:
+                callback(gps)
+            except Exception as e:
+                self.report('GPS callback failed: {}'.format(e), level=logging.WARNING)
+    
+    # most recent fix, None before the first one
+    def gps_latest(self):
+        try:
+            return self.gps_fixes[-1]
+        except IndexError:
+            return None
+    
+    # fixes received after timestamp (time.time()), oldest first
+    def gps_since(self, timestamp):
+        fixes = []
+        for gps in reversed(list(self.gps_fixes)):
+            if gps['received'] <= timestamp:
+                break
+            fixes.append(gps)
+        return fixes[::-1]
+    
+    # callback(fix) is called for every new fix, from the URC dispatcher
+    def gps_subscribe(self, callback):
+        self.gps_callbacks = self.gps_callbacks+[callback]
+    
+    def gps_unsubscribe(self, callback):
+        self.gps_callbacks = [c for c in self.gps_callbacks if c != callback]
+    
+    # convert a +CGNSINF line into a dict of labelled values
+    def gps_parse(self, line):
+        labels = ['GPSon','GPSfix','UTC','Lat','Long','MSLalt','Speed','Course','FixMode','Res1',
+        'HDOP','PDOP','VDOP','Res2','GPSsatView','GPSsatUsed','GLONASSsatView','Res3','C/N0max','HPA','VPA']
+        integers = [0,1,8,14,15,16,18]
+        floats = [2,3,4,5,6,7,10,11,12,19,20]
+        gps = {}
+        try:
+            line = line.decode('utf-8')
+        except:
+            self.metrics.counters['decode_errors'] += 1
+            return None
+        raw_gps = line[10:].split(',')
+        for i in range(len(raw_gps)):
+            if i in integers:
+                try:
+                    gps[labels[i]] = int(raw_gps[i])
+                except:
+                    gps[labels[i]] = raw_gps[i]
+            elif i in floats:
+                try:
+                    gps[labels[i]] = float(raw_gps[i])
+                except:
+                    gps[labels[i]] = raw_gps[i]
+            else:
+                gps[labels[i]] = raw_gps[i]
+        gps['UTCdict']=self.gps_timestamp_to_dict(str(gps['UTC']))
+        return gps
+    
+    # write a command that changes a setting, skipped if the module already confirmed the same command before
+    # key names the setting and defaults to the command up to '=', the cache is cleared when the module restarts
+    def write_setting(self, cmd, attempts=3, key=None):
+        key = key or cmd.split('=')[0]
+        if self.settings.get(key) == cmd:
+            return True
+        # state is unknown until the module confirms the new value
+        self.settings.pop(key, None)
+        if not self.write_simple_command(cmd, attempts):
+            return False
+        self.settings[key] = cmd
+        return True
+    
     # write a simple command that is replied to with OK
-    def write_simple_command(self, cmd, attempts=3):
-        cmd = (cmd+"\r\n").encode('utf-8')
+    def write_simple_command(self, cmd, attempts=3, timeout=5):
+        cmd = cmd.strip()
         #print(cmd)
         for i in range(attempts):
-            self.port.reset_input_buffer()
-            self.port.reset_output_buffer()
-            self.port.write(cmd)
-            for j in range(attempts*2):
-                line = self.port.readline()
-                #print(line)
-                if line == b'OK\r\n':
-                    #print("Command {} sent successfully.".format(cmd[:-2]))
-                    return True
-        print("Couldn't send command {}.".format(cmd[:-2]))
+            if i:
+                self.metrics.counters['retries'] += 1
+            final, frames = self.write_command(cmd, timeout=timeout)
+            if final == b'OK':
+                #print("Command {} sent successfully.".format(cmd))
+                return True
+        self.report("Couldn't send command {}.".format(cmd), hot=True, level=logging.WARNING)
         return False
     
     
-    def ftp_parameters(self, apn, server, port, user, pwd):
+    # bearer: cid of the bearer (1..3) used for FTP
+    def ftp_parameters(self, apn, server, port, user, pwd, bearer=1):
         self.apn = apn
+        self.ftp_bearer = bearer
         self.ftp_server = server
         self.ftp_port = port
         self.ftp_user = user
         self.ftp_pwd = pwd
     
     def ftp_initialize(self, attempts=5):
-        print('Setting up FTP connection.')
+        self.report('Setting up FTP connection.')
         for i in range(attempts):
-            if not self.bearer_set_connection_type(bearer=1, type="GPRS",attempts=attempts):
-                continue
-            if not self.bearer_set_apn(bearer=1, apn=self.apn,attempts=attempts):
+            if not self.bearer_acquire(self.ftp_bearer, self.apn, attempts=attempts):
                 continue
-            if not self.bearer_open(bearer=1,attempts=attempts):
-                continue
-            if not self.ftp_set_profile_id(1,attempts=attempts):
+            if not self.ftp_set_profile_id(self.ftp_bearer,attempts=attempts):
                 continue
             if not self.ftp_set_server(self.ftp_server,attempts=attempts):
                 continue
@@ -313,47 +2034,143 @@ class SIM808():
             return True
         return False
         
+    # attachment: local path or binary file object, or a list of them, each is streamed with AT+SMTPFILE and AT+SMTPFT
+    # in blocks of the length the module requests, so only one block is held in memory
+    # recipients, subject and attachment names are settings, they are not sent again for a retry or an email to the same recipient
+    @transaction
     def email_send(self,subject,message,recipient_to_address,recipient_to_name,recipient_cc_address='',
                     recipient_cc_name='',recipient_bcc_address='',recipient_bcc_name='',attachment='',attempts=3):
-        smtp_errors = {61:'Network error',62:'DNS resolve error',63:'SMTP TCP connection error',64:'Timeout of SMTP server response',
-                        65:'SMTP server response error',66:'No authentication',68:'Bad recipient',
-                        67:'Authentication failed. SMTP user name or password maybe not right.'}
+        message = message.encode('utf-8').hex()
+        attachments = list(attachment) if isinstance(attachment, (list, tuple)) else [attachment] if attachment else []
+        recipients = (('to',recipient_to_address,recipient_to_name), ('cc',recipient_cc_address,recipient_cc_name),
+                      ('bcc',recipient_bcc_address,recipient_bcc_name))
+        # file objects are sent again from where they started, streams that cannot seek only as long as nothing was read from them
+        starts = [None if isinstance(a, str) or not a.seekable() else a.tell() for a in attachments]
+        read = set()
         for i in range(attempts):
-            message = message.encode('utf-8').hex()
-            if not self.email_set_recipient('to',recipient_to_address,recipient_to_name,attempts):
+            if not all(self.email_set_recipient(type,address,name,attempts) for type, address, name in recipients):
                 continue
             if not self.email_set_subject(subject,attempts):
                 continue
-            self.port.write('AT+SMTPBODY={}\r\n'.format(len(message)).encode('utf-8'))
-            for j in range(5):
-                line = self.port.readline()
-                if line == b'DOWNLOAD\r\n':
-                    self.port.write(message.encode('utf-8'))
-                    break
-            for j in range(15):
-                line = self.port.readline()
-                if line == b'OK\r\n':
+            if not self.email_set_attachments(attachments,attempts):
+                continue
+            if i > 0:
+                if any(start is None and not isinstance(a, str) and index in read for index, (a, start) in enumerate(zip(attachments, starts))):
+                    self.report('Attachment stream was already read, the email is not sent again.', level=logging.WARNING)
                     break
-            self.port.write('AT+SMTPSEND\r\n'.encode('utf-8'))
-            for j in range(35):
-                line = self.port.readline()
-                #print(line)
-                if line == b'+SMTPSEND: 1\r\n':
-                    print('Email sent to {}.'.format(recipient_to_name))
-                    return True
-                elif b'+SMTPSEND:' in line:
-                    line = line.decode('utf-8')
-                    pattern = re.compile('[+]SMTPSEND: (\d+)\\r\\n')
-                    m = pattern.matchz(line)
-                    error = int(match.group(1))
-                    error = smtp_errors[error]
-                    print('Error sending Email: {}.'.format(error))
-                    return False
-
+                for a, start in zip(attachments, starts):
+                    if start is not None:
+                        a.seek(start)
+            self.flush()
+            self.write('AT+SMTPBODY={}\r\n'.format(len(message)).encode('utf-8'))
+            frame = self.wait_for((b'DOWNLOAD', b'ERROR'))
+            if frame is None or frame.line != b'DOWNLOAD':
+                continue
+            self.write(message.encode('utf-8'))
+            final, frames = self.read_response(timeout=15)
+            if final != b'OK':
+                continue
+            try:
+                files = [open(a,'rb') if isinstance(a, str) else a for a in attachments]
+            except OSError as e:
+                self.report('Attachment not readable: {}'.format(e), level=logging.WARNING)
+                return False
+            try:
+                if not self.write_simple_command('AT+SMTPSEND',attempts=1):
+                    continue
+                error = self.email_send_attachments(files, read)
+            finally:
+                for a, f in zip(attachments, files):
+                    if isinstance(a, str):
+                        f.close()
+            if error is None:
+                continue
+            if error == 1:
+                self.report('Email sent to {}.'.format(recipient_to_name))
+                return True
+            self.report('Error sending Email: {}.'.format(SMTP_ERRORS.get(error,error)), level=logging.WARNING)
             return False
+        return False
+    
+    # file name of every attachment by index, encoded as base64 by the module
+    # attachments of an earlier email with more of them are removed with an empty name
+    def email_set_attachments(self, attachments, attempts=3):
+        commands = {}
+        for key in self.settings:
+            if key.startswith('AT+SMTPFILE='):
+                commands[key] = key+',""'
+        for index, attachment in enumerate(attachments, 1):
+            name = self.get_file_from_path(attachment if isinstance(attachment, str) else getattr(attachment, 'name', 'attachment{}'.format(index)))
+            commands['AT+SMTPFILE={}'.format(index)] = 'AT+SMTPFILE={},"{}",1'.format(index, name)
+        for key, cmd in sorted(commands.items()):
+            if not self.write_setting(cmd, attempts, key=key):
+                return False
+        return True
+    
+    # after AT+SMTPSEND the module requests the data of every attachment in order (+SMTPFT: 1,<max length>)
+    # until an empty block ends it, returns the result code of +SMTPSEND, None if the transfer broke off
+    # read collects the indices of the files that were read from
+    @transaction
+    def email_send_attachments(self, files, read=None):
+        current = 0
+        sent = 0
+        while True:
+            frame = self.wait_for((b'+SMTPFT: 1,', b'+SMTPSEND:'), timeout=120)
+            if frame is None:
+                return None
+            if frame.line.startswith(b'+SMTPSEND:'):
+                fields = parse_response(frame.line, b'+SMTPSEND')
+                return fields[0] if fields else None
+            mode, maxlength = parse_response(frame.line, b'+SMTPFT') or (1, 0)
+            if read is not None and current < len(files):
+                read.add(current)
+            data = files[current].read(maxlength) if current < len(files) else b''
+            # frames of the running session must not be flushed
+            self.write('AT+SMTPFT={}\r\n'.format(len(data)).encode('utf-8'))
+            if data:
+                frame = self.wait_for((b'+SMTPFT: 2,', b'ERROR', b'+CME ERROR'))
+                if frame is None or frame.line != '+SMTPFT: 2,{}'.format(len(data)).encode('utf-8'):
+                    return None
+                self.write(data)
+                sent = sent+len(data)
+                self.report('Attached {} bytes.          '.format(sent), hot=True, end='\r')
+            else:
+                current = current+1
+            final, frames = self.read_response(timeout=30, echo='AT+SMTPFT={}'.format(len(data)).encode('utf-8'))
+            if final != b'OK':
+                return None
+    
+    # send the pending emails of an EmailOutbox after one email_initialize, a failed email is tried again after
+    # checking the bearer, until it failed attempts times, limit sets the maximum number of emails to send in this call
+    # returns the counts and for every email whether it was sent, its attempts so far and the time it took
+    def email_send_outbox(self, outbox, attempts=3, limit=None):
+        start = time.time()
+        result = {'sent':0, 'failed':0, 'messages':[], 'seconds':0}
+        pending = outbox.pending()[:limit]
+        if not pending:
+            return result
+        ready = self.email_initialize(attempts=attempts)
+        for message in pending:
+            message_start = time.time()
+            while ready and message['state'] == 'queued':
+                if self.email_send(message['subject'], message['message'], *message['to'], *message['cc'], *message['bcc'],
+                                   attachment=message['attachments'], attempts=1):
+                    outbox.sent(message)
+                    continue
+                outbox.failed(message, attempts)
+                if message['state'] == 'queued':
+                    ready = self.bearer_acquire(self.email_bearer, self.apn, attempts=attempts, verify=True)
+            sent = message['state'] == 'sent'
+            result['sent' if sent else 'failed'] += 1
+            result['messages'].append({'id':message['id'], 'sent':sent, 'attempts':message['attempts'], 'seconds':time.time()-message_start})
+        result['seconds'] = time.time()-start
+        self.report('Sent {} of {} emails in {:.1f} seconds.'.format(result['sent'], len(pending), result['seconds']))
+        return result
     
-    def email_parameters(self,apn,server,port,user,pwd,sender_address,sender_name,ssl=0,timeout=30,charset='UTF-8'):
+    # bearer: cid of the bearer (1..3) used for SMTP
+    def email_parameters(self,apn,server,port,user,pwd,sender_address,sender_name,ssl=0,timeout=30,charset='UTF-8',bearer=1):
         self.apn = apn
+        self.email_bearer = bearer
         self.email_timeout = timeout
         self.email_charset = charset
         self.email_server = server
@@ -366,14 +2183,10 @@ class SIM808():
 
     def email_initialize(self, attempts=5):
         for i in range(attempts):
-            print('Setting up SMTP connection.')
-            if not self.bearer_set_connection_type(bearer=1, type="GPRS",attempts=attempts):
-                continue
-            if not self.bearer_set_apn(bearer=1, apn=self.apn,attempts=attempts):
+            self.report('Setting up SMTP connection.')
+            if not self.bearer_acquire(self.email_bearer, self.apn, attempts=attempts):
                 continue
-            if not self.bearer_open(bearer=1,attempts=attempts):
-                continue
-            if not self.email_set_profile_id(1,attempts=attempts):
+            if not self.email_set_profile_id(self.email_bearer,attempts=attempts):
                 continue
             if not self.email_set_timeout(self.email_timeout,attempts=attempts):
                 continue
@@ -395,146 +2208,180 @@ class SIM808():
     # 2 Begin encrypt transmission with normal port
     def email_set_ssl(self, ssl, attempts=3):
         cmd = 'AT+EMAILSSL={}'.format(ssl)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
     
     def email_set_subject(self, subject, attempts=3):
         cmd = 'AT+SMTPSUB="{}"'.format(subject.encode('utf-8').hex())
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
     
     def email_set_charset(self, charset, attempts=3):
         cmd = 'AT+SMTPCS="{}"'.format(charset)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
     
     def email_set_timeout(self, timeout, attempts=3):
         cmd = 'AT+EMAILTO={}'.format(timeout)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
+    # an empty address removes the recipient of that type, so it does not stay set from an earlier email
     def email_set_recipient(self,type,  recipient_address, recipient_name, attempts=3):
         types = {'to':0,'cc':1,'bcc':2}
-        cmd = 'AT+SMTPRCPT={},0,"{}","{}"'.format(types[type],recipient_address,recipient_name)
-        return self.write_simple_command(cmd, attempts)
+        if recipient_address:
+            cmd = 'AT+SMTPRCPT={},0,"{}","{}"'.format(types[type],recipient_address,recipient_name)
+        else:
+            cmd = 'AT+SMTPRCPT={},0'.format(types[type])
+        return self.write_setting(cmd, attempts, key='AT+SMTPRCPT={}'.format(types[type]))
         
     def email_set_sender(self, sender_address, sender_name, attempts=3):
         cmd = 'AT+SMTPFROM="{}","{}"'.format(sender_address,sender_name)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def email_set_auth(self, user, pwd, attempts=3):
         cmd = 'AT+SMTPAUTH=1,"{}","{}"'.format(user,pwd)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
     
     def email_set_profile_id(self, id, attempts=3):
         cmd = 'AT+EMAILCID={}'.format(id)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def email_set_server(self, server, port, attempts=3):
         cmd = 'AT+SMTPSRV="{}",{}'.format(server,port)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def clock_network_sync(self, on=1, attempts=3):
         cmd = 'AT+CLTS={};&W'.format(on)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
 
     # 0 = no flowcontrol, 1= software flowcontrol, 2 = hardware flowcontrol
     def flowcontrol_set(self,fc=0,attempts=3):
         cmd = 'AT+IFC={},{}'.format(fc,fc)
-        return self.write_simple_command(cmd,attempts=attempts)
+        return self.write_setting(cmd,attempts=attempts)
     
     def ftp_set_username(self, user, attempts=3):
         cmd = 'AT+FTPUN="{}"'.format(user)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_set_password(self, pwd, attempts=3):
         cmd = 'AT+FTPPW="{}"'.format(pwd)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_set_port(self, port, attempts=3):
         cmd = 'AT+FTPPORT={}'.format(port)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_set_server(self, server, attempts=3):
         cmd = 'AT+FTPSERV="{}"'.format(server)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_put_name(self, name, attempts=3):
         cmd = 'AT+FTPPUTNAME="{}"'.format(name)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_put_path(self, path, attempts=3):
         cmd = 'AT+FTPPUTPATH="{}"'.format(path)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_get_name(self, name, attempts=3):
         cmd = 'AT+FTPGETNAME="{}"'.format(name)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_get_path(self, path, attempts=3):
         cmd = 'AT+FTPGETPATH="{}"'.format(path)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
         
     def ftp_set_profile_id(self, id, attempts=3):
         cmd = 'AT+FTPCID={}'.format(id)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts)
+        
+    # "STOR" overwrites the remote file, "APPE" appends to it
+    def ftp_set_put_option(self, option, attempts=3):
+        cmd = 'AT+FTPPUTOPT="{}"'.format(option)
+        return self.write_setting(cmd, attempts)
         
     def ftp_quit(self, attempts=3):
         return self.write_simple_command('AT+FTPQUIT', attempts)
         
     def bearer_set_connection_type(self, bearer=1, type="GPRS", attempts=3):
         cmd = 'AT+SAPBR=3,{},"Contype","{}"'.format(bearer,type)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts, key='AT+SAPBR=3,{},"Contype"'.format(bearer))
         
     def bearer_set_apn(self, apn, bearer=1, attempts=3):
         cmd = 'AT+SAPBR=3,{},"APN","{}"'.format(bearer,apn)
-        return self.write_simple_command(cmd, attempts)
+        return self.write_setting(cmd, attempts, key='AT+SAPBR=3,{},"APN"'.format(bearer))
         
-    def bearer_open(self, bearer=1, attempts=5):
-        status = self.bearer_get_status(bearer=bearer)
-        if status in (0,2):
-            time.sleep(2)
-            return self.bearer_open(bearer=bearer)
-        elif status == 1:
-            return True
-        else:
-            cmd = 'AT+SAPBR=1,{}'.format(bearer)
-            self.write_simple_command(cmd)
-            if attempts >= 0:
-                return self.bearer_open(bearer=bearer,attempts=attempts-1)
-            else:
+    # wait for the bearer to settle in the wanted state, sending the command again while it does not
+    # while it is connecting or closing the status is polled less and less often
+    def bearer_switch(self, bearer, open, attempts, timeout):
+        target = 1 if open else 3
+        cmd = 'AT+SAPBR={},{}'.format(1 if open else 0, bearer)
+        deadline = time.monotonic() + timeout
+        pause = 0.5
+        while time.monotonic() < deadline:
+            status = self.bearer_get_status(bearer=bearer)
+            if status == target:
+                return True
+            if status in (0,2):
+                time.sleep(min(pause, max(deadline-time.monotonic(), 0)))
+                pause = min(pause*2, 8)
+                continue
+            if attempts <= 0:
                 return False
-        
-    def bearer_close(self, bearer=1, attempts=5):
-        status = self.bearer_get_status(bearer=bearer)
-        if status in (0,2):
-            time.sleep(2)
-            return self.bearer_close(bearer=bearer)
-        elif status == 3:
+            attempts = attempts-1
+            # activation is only confirmed once the network has assigned an address
+            self.write_simple_command(cmd, attempts=1, timeout=85)
+        return False
+    
+    def bearer_open(self, bearer=1, attempts=5, timeout=180):
+        return self.bearer_switch(bearer, True, attempts, timeout)
+    
+    def bearer_close(self, bearer=1, attempts=5, timeout=120):
+        return self.bearer_switch(bearer, False, attempts, timeout)
+    
+    # open bearer (cid 1..3) for a user like FTP or SMTP and leave it open afterwards, so the next job does not wait for the activation again
+    # the status is known from earlier commands and +SAPBR <cid>: DEACT URCs, handing out an open bearer takes no command
+    # verify = True asks the module anyway, e.g. after a failed session
+    # after a failed activation the bearer is refused without trying for a growing time (10 seconds up to 10 minutes)
+    def bearer_acquire(self, bearer=1, apn=None, attempts=5, verify=False):
+        self.bearer_used[bearer] = time.monotonic()
+        if self.bearers.get(bearer) == 1 and not verify:
             return True
-        else:
-            cmd = 'AT+SAPBR=0,{}'.format(bearer)
-            self.write_simple_command(cmd)
-            if attempts >= 0:
-                return self.bearer_close(bearer=bearer,attempts=attempts-1)
-            else:
-                return False
-        
+        retry, delay = self.bearer_backoff.get(bearer, (0, 0))
+        if time.monotonic() < retry:
+            return False
+        if (self.bearer_set_connection_type(bearer=bearer, type="GPRS", attempts=attempts)
+                and self.bearer_set_apn(apn or self.apn, bearer=bearer, attempts=attempts)
+                and self.bearer_open(bearer=bearer, attempts=attempts)):
+            self.bearer_backoff.pop(bearer, None)
+            return True
+        delay = min(max(delay*2, 10), 600)
+        self.bearer_backoff[bearer] = (time.monotonic()+delay, delay)
+        self.report('Bearer {} could not be opened, next try in {} seconds.'.format(bearer, delay), level=logging.WARNING)
+        return False
+    
+    # close bearers that were not handed out for idle seconds, returns their cids
+    def bearer_close_idle(self, idle=300):
+        closed = []
+        for bearer, used in list(self.bearer_used.items()):
+            if self.bearers.get(bearer) == 1 and time.monotonic()-used >= idle and self.bearer_close(bearer=bearer):
+                closed.append(bearer)
+        return closed
+    
     def bearer_query(self, bearer=1, attempts=3):
         for i in range(attempts):
-            self.port.reset_input_buffer()
-            self.port.reset_output_buffer()
-            self.port.write('AT+SAPBR=2,1\r\n'.encode('utf-8'))
-            pattern=re.compile('[+]SAPBR: (\d),(\d),"(\d+\.\d+\.\d+\.\d+)"\\r\\n')
-            for j in range(5):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                except:
-                    continue
-                m = pattern.match(line)
-                if  m != None:
-                    cid = int(m.group(1))
-                    status = int(m.group(2))
-                    ip = m.group(3)
-                    return cid, status, ip
+            final, frames = self.write_command('AT+SAPBR=2,{}'.format(bearer))
+            result = self.bearer_parse(frames)
+            if result is not None:
+                self.bearers[bearer] = result[1]
+                return result
         return 0, 0, ""
     
+    # cid, status and ip from a +SAPBR: response
+    def bearer_parse(self, frames):
+        for frame in frames:
+            fields = parse_response(frame.line, b'+SAPBR')
+            if fields is not None:
+                return fields
+        return None
+    
     # 0 = connecting, 1 = connected, 2 = closing, 3 = closed
     def bearer_get_status(self, bearer=1):
         cid, status, ip = self.bearer_query(bearer = bearer)
@@ -545,595 +2392,804 @@ class SIM808():
         return ip
     
     # opening a ftp put session returns either an error or a maximum length for transfer
+    @transaction
     def ftp_open_put_session(self,attempts=3):
         if not self.write_simple_command('AT+FTPPUT=1',attempts=attempts):
             return (False,0,0)
-        pattern = re.compile('[+]FTPPUT: (\d),(\d+),?(\d+)?')
-        for i in range(50):
-            try:
-                line = self.port.readline().decode('utf-8')
-            except:
-                continue
-            if not 'FTPPUT' in line:
-                continue
-            m = pattern.match(line)
-            if m:
-                mode = int(m.group(1))
-                if mode != 1:
-                    return (False,0,0)
-                error = int(m.group(2))
-                if error != 1:
-                    return (False,error,0)
-                else:
-                    maxlength = int(m.group(3))
-                    return (True, 1, maxlength)
+        frame = self.wait_for(b'+FTPPUT:', timeout=75)
+        if frame is None:
+            return (False,0,0)
+        fields = parse_response(frame.line, b'+FTPPUT')
+        if fields:
+            mode, error, maxlength = fields
+            if mode != 1:
+                return (False,0,0)
+            if error != 1:
+                return (False,error,0)
             else:
-                return self.open_put_session()
+                return (True, 1, maxlength)
+        return (False,0,0)
     
     def ftp_close_put_session(self,attempts=3):
         return self.write_simple_command('AT+FTPPUT=2,0', attempts)
         
+    @transaction
     def ftp_file_delete(self,file,dir,attempts=3):
         for i in range(attempts):
-            print('Deleting file.')
+            self.report('Deleting file.')
             if not self.ftp_get_name(file,attempts=attempts):
                 continue
             if not self.ftp_get_path(dir,attempts=attempts):
                 continue
             if not self.write_simple_command('AT+FTPDELE') :
                 continue
-            for i in range(20):
-                line = self.port.readline()
-                if line == b'+FTPDELE: 1,0\r\n':
-                    print('Deleted {}.'.format(file))
-                    return True
-        print('Could not delete {}.'.format(file))
+            frame = self.wait_for(b'+FTPDELE: 1,', timeout=75)
+            if frame is not None and frame.line == b'+FTPDELE: 1,0':
+                self.report('Deleted {}.'.format(file))
+                if self.ftp_cache is not None:
+                    self.ftp_cache.remove(self.ftp_cache_server(), dir, file)
+                return True
+        self.report('Could not delete {}.'.format(file), level=logging.WARNING)
         return False
     
     # if file is smaller than the max transfer length, it can be transferred as one chunk
     # this function is not for direct use, file transfers including setup are implemented in ftp_file_upload
+    @transaction
     def ftp_put_file_small(self,data,attempts=3):
         for i in range(attempts):
-            self.port.write('AT+FTPPUT=2,{}\r\n'.format(len(data)).encode('utf-8'))
-            for j in range(5):
-                raw_line = self.port.readline()
-                try:
-                    line = raw_line.decode('utf-8')
-                except:
-                    continue
-                if line == 'AT+FTPPUT=2,{}\r\r\n'.format(len(data)):
-                    raw_line = self.port.readline()
-                    try:
-                        line = raw_line.decode('utf-8')
-                    except:
-                        continue
-                    if line == '+FTPPUT: 2,{}\r\n'.format(len(data)):
-                        self.port.write(data)
-                        for k in range(30):
-                            line = self.port.readline()
-                            if line == b'OK\r\n':
-                                return True
-                            elif line == b'ERROR\r\n':
-                                #print('\nError\n')
-                                return False
+            # frames of the running put session must not be flushed
+            self.write('AT+FTPPUT=2,{}\r\n'.format(len(data)).encode('utf-8'))
+            frame = self.wait_for((b'+FTPPUT: 2,', b'ERROR', b'+CME ERROR'))
+            if frame is None:
+                continue
+            if frame.line != '+FTPPUT: 2,{}'.format(len(data)).encode('utf-8'):
+                return False
+            self.write(data)
+            final, frames = self.read_response(timeout=30)
+            if final == b'OK':
+                return True
+            elif final is not None:
+                #print('\nError\n')
+                return False
         return False
         
     # this function is not for direct use, file transfers including setup are implemented in ftp_file_upload
     def ftp_put_file_large(self,data,maxlength,attempts=3):
-        size = len(data)
-        pointer=0
-        pattern = re.compile('[+]FTPPUT: (\d),(\d+),?(\d+)?.*')
+        return self.ftp_put_stream(io.BytesIO(data),maxlength,attempts=attempts) == len(data)
+    
+    # send what source provides in an open put session, never reading more than the module currently accepts
+    # source is a binary file object, chunks are read into one reusable buffer
+    # progress is called with every chunk the module has accepted
+    # returns the number of bytes sent or None if the session failed
+    @transaction
+    def ftp_put_stream(self,source,maxlength,attempts=3,progress=None):
+        buffer = bytearray(maxlength)
+        sent = 0
         errors = 0
-        for i in range(attempts):
-            while True:
-                chunk = data[pointer:(pointer+maxlength)]
-                chunk_size = len(chunk)
-                if not self.ftp_put_file_small(chunk,attempts=attempts):
-                    errors = errors+1
-                    for j in range(50):
-                        try:
-                            raw_line = self.port.readline()
-                            line = raw_line.decode('utf-8')
-                        except:
-                            continue
-                        m = pattern.match(line)
-                        if m:
-                            mode = int(m.group(1))
-                            error = int(m.group(2))
-                            if mode == 1 and error == 1:
-                                new_maxlength = int(m.group(3))
-                                maxlength=new_maxlength
-                                break
-                    continue
-                if chunk_size+1 < maxlength:
-                    print('Transferred {} of {} bytes ({} package errors).                       '.format(pointer+chunk_size,size,errors), end='\n')
-                    return True
-                for j in range(50):
-                    try:
-                        raw_line = self.port.readline()
-                        line = raw_line.decode('utf-8')
-                    except:
-                        continue
-                    m = pattern.match(line)
-                    if m:
-                        #print('\n',raw_line)
-                        mode = int(m.group(1))
-                        error = int(m.group(2))
-                        if mode == 1 and error == 1:
-                            new_maxlength = int(m.group(3))
-                            pointer = pointer+maxlength
-                            maxlength=new_maxlength
-                            break
-                print('Transferred {} of {} bytes ({} package errors).          '.format(pointer+chunk_size, size, errors), end='\r')
-        return False
+        failures = 0
+        length = source.readinto(memoryview(buffer)[:maxlength])
+        while length:
+            if self.ftp_put_file_small(memoryview(buffer)[:length],attempts=attempts):
+                sent = sent+length
+                if progress is not None:
+                    progress(memoryview(buffer)[:length])
+                failures = 0
+                self.report('Transferred {} bytes ({} package errors).          '.format(sent, errors), hot=True, end='\r')
+                # a short read means the source is exhausted
+                if length < maxlength:
+                    break
+                accepted = True
+            else:
+                errors = errors+1
+                self.metrics.counters['package_errors'] += 1
+                failures = failures+1
+                if failures > attempts:
+                    return None
+                accepted = False
+            # module requests the next chunk and reports the length it accepts
+            frame = self.wait_for(b'+FTPPUT: 1,', timeout=75)
+            if frame is None:
+                # after an accepted chunk the same data must not be sent again, the session is given up instead
+                if accepted:
+                    return None
+                failures = failures+1
+                if failures > attempts:
+                    return None
+                continue
+            fields = parse_response(frame.line, b'+FTPPUT')
+            if fields is None:
+                return None
+            mode, error, maxlength = fields
+            if mode != 1 or error != 1 or maxlength is None:
+                self.report(self.ftp_errors.get(error,error), level=logging.WARNING)
+                return None
+            if maxlength > len(buffer):
+                buffer = bytearray(maxlength)
+            if accepted:
+                length = source.readinto(memoryview(buffer)[:maxlength])
+            elif length > maxlength:
+                # resend of a chunk that no longer fits, give back what is left for the next one
+                if not source.seekable():
+                    return None
+                source.seek(maxlength-length, io.SEEK_CUR)
+                length = maxlength
+        self.report('Transferred {} bytes ({} package errors).                       '.format(sent,errors))
+        return sent
     
-    # if validate = True, the correct file size on the FTP server is confirmed after the transfer 
-    def ftp_file_upload(self,file,dir,validate=False,attempts=3):
+    # if validate = True, the correct file size on the FTP server is confirmed after the transfer
+    # file is a local path, a binary file object or an iterator of bytes, name sets the remote name for the latter two
+    # only one chunk of the file is held in memory at a time
+    # with a TransferJournal an interrupted upload of a local path is continued instead of started over
+    @transaction
+    def ftp_file_upload(self,file,dir,validate=False,attempts=3,name=None,journal=None):
         start_time = time.time()
+        if journal is not None:
+            return self.ftp_file_upload_journal(file,dir,journal,validate,attempts)
+        if isinstance(file, str):
+            with open(file,'rb') as f:
+                stat = os.fstat(f.fileno())
+                complete = self.ftp_file_upload(f,dir,validate,attempts,name or self.get_file_from_path(file))
+            if complete and self.ftp_cache is not None:
+                self.ftp_cache.set_size(self.ftp_cache_server(), dir, name or self.get_file_from_path(file), stat.st_size, stat.st_mtime)
+            return complete
+        if not hasattr(file, 'readinto'):
+            file = IteratorReader(file)
+        if name is None:
+            name = self.get_file_from_path(getattr(file,'name',''))
+        start = file.tell() if file.seekable() else 0
         for i in range(attempts):
             # if any step fails, stop and restart procedure
-            file_name = self.get_file_from_path(file)
-            if not self.ftp_put_name(file_name):
+            if not self.ftp_put_name(name):
                 continue
             if not self.ftp_put_path(dir):
                 continue
-            print('\nOpening FTP Put Session.')
+            if i > 0:
+                # data of a failed attempt can only be sent again if the source can rewind
+                if not file.seekable():
+                    break
+                file.seek(start)
+            self.report('\nOpening FTP Put Session.')
             ftp_open, ftp_error, ftp_maxlength = self.ftp_open_put_session()
             if not ftp_open:
                 self.ftp_initialize()
-                print(self.ftp_errors[ftp_error])
+                self.report(self.ftp_errors.get(ftp_error,ftp_error), level=logging.WARNING)
+                continue
+            size = self.ftp_put_stream(file,ftp_maxlength,attempts=attempts)
+            if size is None:
                 continue
-            f = open(file,'rb')
-            f_data=f.read()
-            f.close()
-            if len(f_data) < ftp_maxlength:
-                print('small file')
-                if not self.ftp_put_file_small(f_data,ftp_maxlength):
-                    continue
-                print('Transferred {} bytes.'.format(len(f_data)))
-            else:
-                if not self.ftp_put_file_large(f_data,ftp_maxlength):
-                    continue
             self.ftp_close_put_session()  
             duration = time.time()-start_time
-            speed = int(len(f_data)/duration)
-            print('Transfer of {} completed in {:.2f} seconds ({} B/s).'.format(file, duration, speed))
+            speed = int(size/duration)
+            self.report('Transfer of {} completed in {:.2f} seconds ({} B/s).'.format(name, duration, speed))
             
             if validate:
-                if len(f_data) == self.ftp_get_filesize(dir,file,attempts=attempts):
-                    print("File size validated.")
+                if size == self.ftp_get_filesize(dir,name,attempts=attempts):
+                    self.report("File size validated.")
                     return True
                 else:
-                    print("File size does not match, attempt again:")
-                    self.ftp_file_delete(file,dir,attempts=attempts)
+                    self.report("File size does not match, attempt again:", level=logging.WARNING)
+                    self.ftp_file_delete(name,dir,attempts=attempts)
                     continue
             else:
+                if self.ftp_cache is not None:
+                    self.ftp_cache.set_size(self.ftp_cache_server(), dir, name, size)
+                return True
+        self.report('Transfer of {} failed.'.format(name), level=logging.WARNING)
+        return False
+    
+    # upload many files over one bearer and FTP profile setup, the remote directory is only set once
+    # files is a list of local paths or a local directory whose files are all uploaded
+    # returns the result of every file and the aggregate throughput
+    def ftp_batch_upload(self,files,dir,validate=False,attempts=3,journal=None):
+        if isinstance(files, str):
+            files = [os.path.join(files, f) for f in sorted(os.listdir(files)) if os.path.isfile(os.path.join(files, f))]
+        start_time = time.time()
+        results = []
+        ready = self.ftp_initialize(attempts=attempts)
+        path_set = False
+        for path in files:
+            file_start = time.time()
+            size = os.path.getsize(path)
+            name = self.get_file_from_path(path)
+            complete = False
+            if ready and journal is not None:
+                complete = self.ftp_file_upload_journal(path,dir,journal,validate,attempts)
+                path_set = complete
+            elif ready:
+                for i in range(attempts):
+                    if not path_set:
+                        path_set = self.ftp_put_path(dir)
+                        if not path_set:
+                            continue
+                    if not self.ftp_put_name(name):
+                        continue
+                    ftp_open, ftp_error, ftp_maxlength = self.ftp_open_put_session()
+                    if not ftp_open:
+                        self.report(self.ftp_errors.get(ftp_error,ftp_error), level=logging.WARNING)
+                        self.ftp_reconnect(attempts=attempts)
+                        continue
+                    with open(path,'rb') as f:
+                        sent = self.ftp_put_stream(f,ftp_maxlength,attempts=attempts)
+                    if sent is None:
+                        continue
+                    self.ftp_close_put_session()
+                    if validate and self.ftp_get_filesize(dir,name,attempts=attempts) != size:
+                        self.report("File size of {} does not match, attempt again:".format(name), level=logging.WARNING)
+                        continue
+                    complete = True
+                    break
+            if complete and self.ftp_cache is not None:
+                self.ftp_cache.set_size(self.ftp_cache_server(), dir, name, size, os.path.getmtime(path))
+            results.append({'file':path, 'complete':complete, 'size':size, 'seconds':time.time()-file_start})
+        duration = time.time()-start_time
+        transferred = sum(r['size'] for r in results if r['complete'])
+        completed = len([r for r in results if r['complete']])
+        self.report('Uploaded {} of {} files ({} bytes) in {:.2f} seconds.'.format(completed, len(results), transferred, duration))
+        return {'files':results, 'completed':completed, 'failed':len(results)-completed, 'bytes':transferred,
+                'seconds':duration, 'speed':int(transferred/duration) if duration > 0 else 0}
+    
+    # after a failed FTP session only the bearer needs to be restored, the FTP parameters stay set in the module
+    def ftp_reconnect(self, attempts=3):
+        return self.bearer_acquire(self.ftp_bearer, self.apn, attempts=attempts, verify=True)
+    
+    # upload that continues where an earlier, interrupted upload of the same file stopped
+    # the remote file is appended to from the size the server reports, as long as the local file did not change
+    def ftp_file_upload_journal(self,path,dir,journal,validate=False,attempts=3):
+        start_time = time.time()
+        name = self.get_file_from_path(path)
+        key = journal.key('upload', dir, name)
+        stat = os.stat(path)
+        entry = journal.get(key)
+        if entry is None or entry['local'] != path or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime or \
+           journal.checksum(path, entry['offset']) != entry['crc']:
+            entry = journal.start(key, dir, name, path, stat.st_size, stat.st_mtime)
+        with open(path,'rb') as f:
+            for i in range(attempts):
+                # only data the server has stored counts, which can be more than the journal recorded before a power cut
+                offset = 0
+                if entry['offset'] > 0:
+                    remote = self.ftp_get_filesize(dir,name,attempts=attempts)
+                    # keep the journal as it is until the server can tell how much it has
+                    if remote is None:
+                        continue
+                    if remote <= stat.st_size:
+                        offset = remote
+                entry = journal.start(key, dir, name, path, stat.st_size, stat.st_mtime, offset, journal.checksum(path, offset))
+                if not self.ftp_set_put_option('APPE' if offset else 'STOR'):
+                    continue
+                if not self.ftp_put_name(name):
+                    continue
+                if not self.ftp_put_path(dir):
+                    continue
+                if offset:
+                    self.report('Resuming upload of {} at {} of {} bytes.'.format(name, offset, stat.st_size))
+                ftp_open, ftp_error, ftp_maxlength = self.ftp_open_put_session()
+                if not ftp_open:
+                    self.report(self.ftp_errors.get(ftp_error,ftp_error), level=logging.WARNING)
+                    self.ftp_initialize()
+                    continue
+                f.seek(offset)
+                sent = self.ftp_put_stream(f,ftp_maxlength,attempts=attempts,progress=lambda chunk: journal.advance(key, chunk))
+                journal.save()
+                if sent is None:
+                    continue
+                self.ftp_close_put_session()
+                if validate and self.ftp_get_filesize(dir,name,attempts=attempts) != stat.st_size:
+                    self.report("File size does not match, attempt again:", level=logging.WARNING)
+                    continue
+                duration = time.time()-start_time
+                self.report('Transfer of {} completed in {:.2f} seconds ({} B/s).'.format(name, duration, int(sent/duration)))
+                journal.finish(key)
+                self.ftp_set_put_option('STOR')
+                if self.ftp_cache is not None:
+                    self.ftp_cache.set_size(self.ftp_cache_server(), dir, name, stat.st_size, stat.st_mtime)
                 return True
-        print('Transfer of {} failed.'.format(file))
+        self.ftp_set_put_option('STOR')
+        self.report('Transfer of {} failed.'.format(name), level=logging.WARNING)
         return False
     
     # local directory has to already exist or be created separately
+    @transaction
     def ftp_file_download(self,file,dir_server,dir_local='',validate=False,attempts=3):
         
-        data = b'' 
-        chunk = b''
-        error = False
+        data = bytearray()
         errors = []
-        download_open = False
-        download_complete = False
         output = {}
         file_start = time.time()
         
+        def received(chunk):
+            data.extend(chunk)
+            self.report('Downloaded {} bytes ({} package errors).'.format(len(data),len(errors)), hot=True, end='\r')
+        
         for i in range(attempts):
-            if not self.ftp_get_name(file,attempts=attempts):
-                continue
-            if not self.ftp_get_path(dir_server,attempts=attempts):
+            # continue after the data received in previous attempts
+            status = self.ftp_open_get_session(file,dir_server,len(data),attempts=attempts)
+            if status == 1:
+                self.report('\nStarting download.')
+                status = self.ftp_read_session('FTPGET', received)
+            if status is None:
                 continue
-            if not self.write_simple_command('AT+FTPREST=0',attempts=attempts):
+            if status != 0:
+                errors.append(status)
                 continue
-                
-            if error:
-                self.write_simple_command('AT+FTPREST={}'.format(len(data)-len(chunk)),attempts=attempts)
-                data = data[:-len(chunk)]
-                error = False
             
-            if not self.write_simple_command('AT+FTPGET=1',attempts=attempts):
-                continue
-                        
-            for j in range(75):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                    #print(line)
-                except:
+            duration = time.time()-file_start
+            size = len(data)
+            speed = int(size/duration)
+            self.report('\nDownloaded {} in {:.1f} seconds({} bytes, {} B/s)'.format(file,duration,size,speed))
+            if validate:
+                if len(data) == self.ftp_get_filesize(dir_server,file):
+                    self.report('File size validated.')
+                else:
+                    self.report('File size incorrect, attempt again.', level=logging.WARNING)
+                    data = bytearray()
                     continue
-                if line == '+FTPGET: 1,1\r\n':
-                    download_open = True
-                    break
-                if line == '+FTPGET: 1,0\r\n':
-                    download_complete = True
-                    break
-                if '+FTPGET: 1,' in line:
-                    pattern = re.compile('[+]FTPGET: 1,(\d+)\\r\\n')
-                    m = pattern.match(line)
-                    error = int(m.group(1))
-                    errors.append(error)
-                    error = True
-                    break
-                    
-            if error:
-                continue
-            if download_complete:
-                duration = time.time()-file_start
-                size = len(data)
-                speed = int(size/duration)
-                print('\nDownloaded {} in {:.1f} seconds({} bytes, {} B/s)'.format(file,duration,size,speed))
-                
-                if validate:
-                    if len(data) == self.ftp_get_filesize(dir_server,file):
-                        print('File size validated.')
-                    else:
-                        print('File size incorrect, attempt again.')
-                        error = True
-                        continue
-                        
-                output['errors'] = errors
-                output['data'] = data
-                output['complete'] = True
-                try:
-                    path = dir_local + file
-                    f = open(path,'wb')
-                    f.write(data)
-                    f.close()
-                except Exception as e:
-                    print('Could not write data to file.', e)
-                return output
-                
-            if download_open:
-                print('\nStarting download.')
-                j = 0
-                while j < 75:
-                    j = j+1 
-                    chunk_start = time.time()
-                    self.port.write('AT+FTPGET=2,1024\r\n'.encode('utf-8'))
-                    for k in range(100):
-                        try:
-                            line = self.port.readline().decode('utf-8')
-                            #print('1',line)
-                        except:
-                            continue
-                        if line == '+FTPGET: 2,0\r\n':
-                            #print('No data.')
-                            break
-                        if line == 'ERROR\r\n':
-                            error = True
-                            break
-                        if '+FTPGET: 2,' in line:
-                            pattern = re.compile('[+]FTPGET: 2,(\d+)\\r\\n')
-                            m = pattern.match(line)
-                            length = int(m.group(1))
-                            chunk = self.port.read(length)
-                            data = data + chunk
-                            print('Downloaded {} bytes ({} package errors).'.format(len(data),len(errors)), end='\r')
-                            j = 0
-                            break
-                        if line == '+FTPGET: 1,0\r\n':
-                            download_complete = True
-                            break
-                        if line == '+FTPGET: 1,1\r\n':
-                            download_open = True
-                        if '+FTPGET: 1,' in line:
-                            pattern = re.compile('[+]FTPGET: 1,(\d+)\\r\\n')
-                            m = pattern.match(line)
-                            error = int(m.group(1))
-                            errors.append(error)
-                            error = True
-                            break
-                            
-                    if error:
-                        break
-                        
-                    if download_complete:
-                        duration = time.time()-file_start
-                        size = len(data)
-                        speed = int(size/duration)
-                        print('\nDownloaded {} in {:.1f} seconds({} bytes, {} B/s)'.format(file,duration,size,speed))
-                        if validate:
-                            if len(data) == self.ftp_get_filesize(dir_server,file):
-                                print('File size validated.')
-                            else:
-                                print('File size incorrect, attempt again.')
-                                error = True
-                                break
-                        output['errors'] = errors
-                        output['data'] = data
-                        output['complete'] = True
-                        try:
-                            path = dir_local + file
-                            f = open(path,'wb')
-                            f.write(data)
-                            f.close()
-                        except Exception as e:
-                            print('Could not write data to file.', e)
-                        return output
-                        
-                    if download_open:
-                        j = 0
-                        continue
-            if error:
-                continue
+            output['errors'] = errors
+            output['data'] = bytes(data)
+            output['complete'] = True
+            try:
+                path = dir_local + file
+                f = open(path,'wb')
+                f.write(data)
+                f.close()
+            except Exception as e:
+                self.report('Could not write data to file: {}'.format(e), level=logging.WARNING)
+            return output
         
         # return whatever was downloaded when attempts timed out      
         output['errors'] = errors
-        output['data'] = data
+        output['data'] = bytes(data)
         output['complete'] = False
         
         duration = time.time()-file_start
         size = len(data)
         speed = int(size/duration)
-        print('\nDownload of {} interrupted after {:.1f} seconds({} bytes, {} B/s)'.format(file,duration,size,speed))
+        self.report('\nDownload of {} interrupted after {:.1f} seconds({} bytes, {} B/s)'.format(file,duration,size,speed), level=logging.WARNING)
         try:
             path = dir_local + file
             f = open(path,'wb')
             f.write(data)
             f.close()
         except Exception as e:
-            print('Could not write data to file.', e)
+            self.report('Could not write data to file: {}'.format(e), level=logging.WARNING)
+        return output
+    
+    # download without holding the file in memory, every received block goes straight to sink
+    # sink is a local path, a file object opened for binary writing or a function called with each block
+    # with resume = True a download into an existing file continues after the bytes already on disk (AT+FTPREST),
+    # for a function sink offset gives the number of bytes it already has
+    # with a TransferJournal and a path as sink, only data confirmed by the journal is kept and resumed from
+    @transaction
+    def ftp_file_download_stream(self,file,dir_server,sink,resume=True,validate=False,offset=0,attempts=3,journal=None):
+        if journal is not None:
+            return self.ftp_file_download_journal(file,dir_server,sink,journal,validate,attempts)
+        if isinstance(sink, str):
+            with open(sink, 'ab' if resume else 'wb') as f:
+                return self.ftp_file_download_stream(file,dir_server,f,resume,validate,offset,attempts)
+        
+        if hasattr(sink, 'write'):
+            write = sink.write
+            if resume:
+                offset = sink.tell()
+            else:
+                sink.seek(0)
+                sink.truncate()
+                offset = 0
+        else:
+            write = sink
+        
+        output = {'errors':[], 'size':offset, 'complete':False}
+        file_start = time.time()
+        
+        def received(chunk):
+            write(chunk)
+            output['size'] = output['size']+len(chunk)
+        
+        for i in range(attempts):
+            status = self.ftp_open_get_session(file,dir_server,output['size'],attempts=attempts)
+            if status == 1:
+                status = self.ftp_read_session('FTPGET', received)
+            if status is None:
+                continue
+            if status != 0:
+                output['errors'].append(status)
+                continue
+            if validate and output['size'] != self.ftp_get_filesize(dir_server,file):
+                self.report('File size incorrect, attempt again.', level=logging.WARNING)
+                if not hasattr(sink, 'truncate'):
+                    break
+                sink.seek(0)
+                sink.truncate()
+                output['size'] = 0
+                continue
+            output['complete'] = True
+            break
+        
+        duration = time.time()-file_start
+        self.report('Download of {} {} after {:.1f} seconds ({} bytes).'.format(file,'completed' if output['complete'] else 'interrupted',duration,output['size']),
+                    level=logging.INFO if output['complete'] else logging.WARNING)
+        return output
+    
+    # download into path that continues after the data confirmed by the journal
+    # the local file must still match the recorded checksum and the remote file its recorded size
+    def ftp_file_download_journal(self,file,dir_server,path,journal,validate=False,attempts=3):
+        key = journal.key('download', dir_server, file)
+        size = self.ftp_get_filesize(dir_server,file,attempts=attempts)
+        if size is None:
+            self.report('Size of {} unknown, download postponed.'.format(file), level=logging.WARNING)
+            entry = journal.get(key)
+            return {'errors':[], 'size':entry['offset'] if entry is not None else 0, 'complete':False}
+        entry = journal.get(key)
+        offset = 0
+        if entry is not None and entry['local'] == path and entry['size'] == size and os.path.exists(path):
+            if journal.checksum(path, entry['offset']) == entry['crc']:
+                offset = entry['offset']
+        entry = journal.start(key, dir_server, file, path, size, offset=offset, crc=entry['crc'] if offset else 0)
+        with open(path, 'r+b' if offset else 'wb') as f:
+            # data after the last checkpoint may not have reached the disk completely
+            f.truncate(offset)
+            f.seek(offset)
+            
+            def sync():
+                f.flush()
+                os.fsync(f.fileno())
+            
+            def received(chunk):
+                f.write(chunk)
+                journal.advance(key, chunk, sync)
+            
+            output = self.ftp_file_download_stream(file,dir_server,received,validate=validate,offset=offset,attempts=attempts)
+            sync()
+        if output['complete']:
+            journal.finish(key)
+        else:
+            journal.save()
         return output
+    
+    # set up a download session starting at offset
+    # returns 1 if data is available, 0 if the transfer is already finished, an FTP error or None on timeout
+    @transaction
+    def ftp_open_get_session(self,file,dir_server,offset=0,attempts=3):
+        if not self.ftp_get_name(file,attempts=attempts):
+            return None
+        if not self.ftp_get_path(dir_server,attempts=attempts):
+            return None
+        if not self.write_simple_command('AT+FTPREST={}'.format(offset),attempts=attempts):
+            return None
+        if not self.write_simple_command('AT+FTPGET=1',attempts=attempts):
+            return None
+        frame = self.wait_for(b'+FTPGET: 1,', timeout=75)
+        if frame is None:
+            return None
+        return self.ftp_session_status(frame, 'FTPGET')
+    
+    # status of +FTPGET: 1,<status> or +FTPLIST: 1,<status> (1 = data available, 0 = finished, otherwise an FTP error)
+    # None if the line does not match
+    def ftp_session_status(self, frame, command):
+        fields = parse_response(frame.line, '+{}'.format(command).encode('utf-8'))
+        return fields[1] if fields else None
+    
+    # read the data of an open FTPGET or FTPLIST session and pass every block to sink until the module reports the end of the transfer
+    # returns the final status (0 = complete, otherwise an FTP error) or None on timeout
+    # requests are as large as the module allows and the next one is sent as soon as the previous one is answered,
+    # only a short block (buffer of the module drained) makes it wait briefly for the module to announce more data
+    def ftp_read_session(self, command, sink, size=None):
+        blocks = self.ftp_read_blocks(command, size)
+        while True:
+            try:
+                sink(next(blocks))
+            except StopIteration as stop:
+                return stop.value
+    
+    # blocks of an FTPGET or FTPLIST session as a generator, returns the final status like ftp_read_session
+    @transaction
+    def ftp_read_blocks(self, command, size=None):
+        prefix = '+{}: 1,'.format(command).encode('utf-8')
+        size = size or self.ftp_chunk_max
+        status = 1
+        while status == 1:
+            start = time.monotonic()
+            final, frames = self.write_command('AT+{}=2,{}'.format(command,size), timeout=10, flush=False)
+            if final is None:
+                return None
+            if final != b'OK':
+                # some firmware versions accept less than FTP_MAX_CHUNK
+                if size <= 256:
+                    return None
+                size = size//2
+                self.ftp_chunk_max = size
+                self.metrics.counters['package_errors'] += 1
+                continue
+            round_trip = time.monotonic()-start
+            received = 0
+            for frame in frames:
+                if frame.kind == 'data':
+                    yield frame.payload
+                    received = len(frame.payload)
+                elif frame.line.startswith(prefix):
+                    status = self.ftp_session_status(frame, command)
+            if status != 1 or received == size:
+                continue
+            if received == 0:
+                # buffer of the module is empty, wait until it reports new data or the end of the transfer
+                frame = self.wait_for(prefix, timeout=75)
+                if frame is None:
+                    return None
+                status = self.ftp_session_status(frame, command)
+            else:
+                # the end of the transfer usually follows a short block, asking again before that costs a round trip
+                frame = self.wait_for(prefix, timeout=round_trip*2)
+                if frame is not None:
+                    status = self.ftp_session_status(frame, command)
+        return status
      
     # create = True for making dir, False for deleting dir     
+    @transaction
     def ftp_dir_create_delete(self, dir, create, attempts=3):
         for i in range(attempts):
         # if any step fails, stop and restart procedure
             if not self.ftp_get_path(dir):
                 continue
             if create:
-                print('Creating directory {}.'.format(dir))
-                if not self.write_simple_command('AT+FTPMKD'):
-                    continue
-                pattern = re.compile('[+]FTPMKD: \d,(\d+)\\r\\n')
-                for j in range(15):
-                    try:
-                        line = self.port.readline().decode('utf-8')
-                    except:
-                        continue
-                    m = pattern.match(line)
-                    if m:
-                        ftp_error = int(m.group(1))
-                        if ftp_error == 0:
-                            return True
-                        else:
-                            print(self.ftp_errors[ftp_error])
-                            return False
-                    else:
-                        continue
+                self.report('Creating directory {}.'.format(dir))
+                cmd = 'AT+FTPMKD'
             else:
-                print('Removing directory {}.'.format(dir))
-                if not self.write_simple_command('AT+FTPRMD'):
-                    continue
-                pattern = re.compile('[+]FTPRMD: \d,(\d+)\\r\\n')
-                for j in range(15):
-                    try:
-                        line = self.port.readline().decode('utf-8')
-                    except:
-                        continue
-                    m = pattern.match(line)
-                    if m:
-                        ftp_error = int(m.group(1))
-                        if ftp_error == 0:
-                            return True
+                self.report('Removing directory {}.'.format(dir))
+                cmd = 'AT+FTPRMD'
+            if not self.write_simple_command(cmd):
+                continue
+            frame = self.wait_for(cmd[2:].encode('utf-8')+b':', timeout=75)
+            if frame is None:
+                continue
+            fields = parse_response(frame.line, cmd[2:].encode('utf-8'))
+            if fields:
+                ftp_error = fields[1]
+                if ftp_error == 0:
+                    if self.ftp_cache is not None:
+                        # a new directory is empty, a removed one is forgotten
+                        if create:
+                            self.ftp_cache.set_listing(self.ftp_cache_server(), dir, {})
                         else:
-                            print(self.ftp_errors[ftp_error])
-                            return False
-                    else:
-                        continue
+                            self.ftp_cache.invalidate(self.ftp_cache_server(), dir)
+                    return True
+                else:
+                    self.report(self.ftp_errors.get(ftp_error,ftp_error), level=logging.WARNING)
+                    return False
         return False
         
+    # size of file on the server, 0 if it does not exist and None if the size could not be determined
+    @transaction
     def ftp_get_filesize(self,dir,file,attempts=3):
         for i in range(attempts):
             if not self.ftp_get_path(dir,attempts=attempts):
                 continue
             if not self.ftp_get_name(file,attempts=attempts):
                 continue
-            if not self.write_simple_command('AT+FTPSIZE\r\n',attempts=attempts):
+            if not self.write_simple_command('AT+FTPSIZE',attempts=attempts):
                 continue
-            for i in range(attempts*10):
-                line = self.port.readline()
-                try:
-                    line = line.decode('utf-8')
-                except:
-                    continue
-                if '+FTPSIZE: 1,0,' in line:
-                    pattern = re.compile('[+]FTPSIZE: 1,0,(\d+)\\r\\n')
-                    m = pattern.match(line)
-                    if m:
-                        return int(m.group(1))
-                    else:
-                        return 0
-                elif '+FTPSIZE: 1,' in line:
-                    pattern = re.compile('[+]FTPSIZE: 1,(\d+).*')
-                    m = pattern.match(line)
-                    error = int(m.group(1))
-                    print('Error',self.ftp_errors(error))
-                    return 0
-        return 0
+            frame = self.wait_for(b'+FTPSIZE: 1,', timeout=75)
+            if frame is None:
+                continue
+            fields = parse_response(frame.line, b'+FTPSIZE')
+            if not fields:
+                continue
+            mode, error, size = fields
+            if error == 0:
+                if self.ftp_cache is not None:
+                    self.ftp_cache.set_size(self.ftp_cache_server(), dir, file, size or 0)
+                return size or 0
+            if error == FTP_FILE_MISSING:
+                return 0
+            self.report('Error {}'.format(self.ftp_errors.get(error,error)), level=logging.WARNING)
+            return None
+        return None
         
+    # size of a file from the cache, asks the server only if the cache does not know it
+    def ftp_get_filesize_cached(self,dir,file,attempts=3):
+        if self.ftp_cache is None:
+            self.ftp_cache = FTPCache()
+        size = self.ftp_cache.size(self.ftp_cache_server(), dir, file)
+        if size is not None:
+            return size
+        return self.ftp_get_filesize(dir,file,attempts=attempts)
+    
+    # names and sizes of the entries of dir (None for subdirectories) from the cache or a new listing, None if listing failed
+    def ftp_list_cached(self, dir, attempts=3):
+        if self.ftp_cache is None:
+            self.ftp_cache = FTPCache()
+        files = self.ftp_cache.listing(self.ftp_cache_server(), dir)
+        if files is not None:
+            return files
+        listing = self.ftp_list_dir(dir, FTP_LIST_ENCODING, attempts=attempts)
+        if not listing or listing['error']:
+            return None
+        files = {entry['name']:None if entry['permissions'].startswith('d') else int(entry['size']) for entry in listing['elements']}
+        self.ftp_cache.set_listing(self.ftp_cache_server(), dir, files)
+        return files
+    
+    # key of the server in the cache
+    def ftp_cache_server(self):
+        return '{}:{}'.format(self.ftp_server, self.ftp_port)
+    
+    # one-way sync of the files in local_dir to remote_dir: files the server does not have, has with another size or that
+    # changed locally since their last upload through this cache are uploaded, all others cost no FTP session at all
+    # a missing remote directory is created, returns the uploaded, unchanged and failed local paths
+    def ftp_sync(self, local_dir, remote_dir, validate=False, attempts=3, journal=None):
+        start_time = time.time()
+        result = {'uploaded':[], 'unchanged':[], 'failed':[], 'seconds':0}
+        if not self.ftp_initialize(attempts=attempts):
+            result['failed'] = [os.path.join(local_dir, f) for f in sorted(os.listdir(local_dir)) if os.path.isfile(os.path.join(local_dir, f))]
+            return result
+        remote = self.ftp_list_cached(remote_dir, attempts=attempts)
+        if remote is None:
+            remote = {} if self.ftp_dir_create_delete(remote_dir, True, attempts=attempts) else None
+        changed = []
+        for name in sorted(os.listdir(local_dir)):
+            path = os.path.join(local_dir, name)
+            if not os.path.isfile(path):
+                continue
+            if remote is None:
+                result['failed'].append(path)
+                continue
+            stat = os.stat(path)
+            mtime = self.ftp_cache.mtime(self.ftp_cache_server(), remote_dir, name)
+            if remote.get(name) == stat.st_size and mtime in (None, stat.st_mtime):
+                result['unchanged'].append(path)
+            else:
+                changed.append(path)
+        if changed:
+            batch = self.ftp_batch_upload(changed, remote_dir, validate=validate, attempts=attempts, journal=journal)
+            for file in batch['files']:
+                result['uploaded' if file['complete'] else 'failed'].append(file['file'])
+        result['seconds'] = time.time()-start_time
+        self.report('Synchronized {}: {} uploaded, {} unchanged, {} failed in {:.1f} seconds.'.format(
+            remote_dir, len(result['uploaded']), len(result['unchanged']), len(result['failed']), result['seconds']))
+        return result
+    
     def ftp_list_decode(self,list,encoding,error=False):
-        output = {}
-        output['error'] = error
         pattern = re.compile(encoding[0])
         labels = encoding[1]
-        if 'type' in labels:
-            output['elements'] = {}
-            output['decoding_errors'] = []
-            types = []
-            for element in list:
-                m = pattern.match(element)
-                if m:
-                    type = m.group(labels.index('type')+1)
-                    if type not in types:
-                        types.append(type)
-            for type in types:
-                output['elements'][type]=[]
-            for element in list:
-                dict = {}
-                m = pattern.match(element)
-                if m:
-                    for i in range(len(labels)):
-                         dict[labels[i]] = m.group(i+1)
-                    type = m.group(labels.index('type')+1)
-                    output['elements'][type].append(dict)
-                else:
-                    output['decoding_errors'].append(element)
-                    
-        else:
-            output['elements'] = []
-            output['decoding_errors'] = []
-            for element in list:
-                dict = {}
-                m = pattern.match(element)
-                if m:
-                    for i in range(len(labels)):
-                        dict[labels[i]] = m.group(i+1)
-                    output['elements'].append(dict)  
-                else:
-                    output['decoding_errors'].append(element)
+        # entries grouped by type in order of appearance if there is a label 'type'
+        grouped = 'type' in labels
+        output = {'error':error, 'elements':{} if grouped else [], 'decoding_errors':[]}
+        for element in list:
+            entry = self.ftp_list_entry(element, pattern, labels)
+            if entry is None:
+                output['decoding_errors'].append(element)
+            elif grouped:
+                output['elements'].setdefault(entry['type'], []).append(entry)
+            else:
+                output['elements'].append(entry)
         return output
     
-    # encoding of list can vary between ftp servers
-    # common seems to be: ['([\w-]+)\s+(\d+)\s+(\w+)\s+(\w+)\s+(\d+)\s+(.+\s+.+\s+.+)\s+(.+)',['permissions','type','user','group','size','date/time','name']]
-    # encoding = [] gives raw list
-    # otherwise specify as [<regex pattern>,[<label0>,<label1>,...]]
-    def ftp_list_dir(self, dir, encoding=[],attempts=3):
+    # labelled fields of one line of a listing, None if it does not match
+    def ftp_list_entry(self, line, pattern, labels):
+        m = pattern.match(line)
+        if m is None:
+            return None
+        return dict(zip(labels, m.groups()))
+    
+    # complete lines of blocks from ftp_read_blocks, a line can be split between two blocks
+    # returns the status of the session
+    def ftp_read_lines(self, blocks):
+        pending = b''
+        while True:
+            try:
+                block = next(blocks)
+            except StopIteration as stop:
+                if pending and stop.value == 0:
+                    yield pending
+                return stop.value
+            lines = (pending+block).split(b'\r\n')
+            pending = lines.pop()
+            yield from lines
+    
+    # listing of dir as a generator, every entry is yielded as soon as the block with it has arrived
+    # encoding as for ftp_list_dir: [] yields the lines, otherwise dicts of the labelled fields (lines that do not match are skipped)
+    # stopping early, e.g. when a file is found, ends the session with AT+FTPQUIT
+    # a failed listing is started again and the entries that were already yielded are skipped
+    @transaction
+    def ftp_list_iter(self, dir, encoding=[], attempts=3):
+        pattern = re.compile(encoding[0]) if encoding else None
+        done = 0
         for i in range(attempts):
-            error = False
-            transfer_complete = False
-            # set directory
             if not self.ftp_get_path(dir):
                 continue
-            # start ftp list session   
-            print('Opening FTP directory readout.')
             if not self.write_simple_command('AT+FTPLIST=1'):
                 continue
-            
-            start = time.time()            
-            # using while loop to be able to reset counter
-            j=0
-            dir_list = b''
-            while j < 50:
-                j = j+1
+            frame = self.wait_for(b'+FTPLIST: 1,', timeout=75)
+            if frame is None:
+                continue
+            status = self.ftp_session_status(frame, 'FTPLIST')
+            if status == 1:
+                lines = self.ftp_read_lines(self.ftp_read_blocks('FTPLIST'))
+                seen = 0
                 try:
-                    line = self.port.readline().decode('utf-8')
-                    #print('3',line)
-                except:
-                    continue
-                if line == '+FTPLIST: 1,0\r\n' or transfer_complete:
-                    # data transfer finished
-                    print('Data transfer complete.')
-                    if encoding == []:
-                        return dir_list.decode('utf-8').split('\r\n')
-                    else:
-                        return self.ftp_list_decode(dir_list.decode('utf-8').split('\r\n'),encoding)
-                if line == b'ERROR\r\n':
-                    error = True
-                if '+FTPLIST: 2,' in line:
-                    # data transmission is beginning
-                    # get size of data and read that many bytes
-                    pattern = re.compile('[+]FTPLIST: 2,(\d+)\\r\\n')
-                    m = pattern.match(line)
-                    size = m.group(1)
-                    chunk = self.port.read(int(size))
-                    #print(chunk)
-                    dir_list = dir_list + chunk
-                    # transmission of data block completed
-                    continue
-                elif line == '+FTPLIST: 1,1\r\n':
-                    print('Receiving Data.')
-                    # ftp list session is open
-                    
-                    no_data = False
-                    k = 0
-                    while k <10:
-                        k = k+1
-                        # request data
-                        self.port.write('AT+FTPLIST=2,1460\r\n'.encode('utf-8'))
-                        
-                        for l in range(attempts):
-                            try:
-                                line = self.port.readline().decode('utf-8')
-                                #print('1',line)
-                            except:
-                                continue
-                            if line == b'ERROR\r\n':
-                                error = True
-                                break
-                            if line == '+FTPLIST: 1,0\r\n':
-                                transfer_complete = True
-                                break
-                            if line == '+FTPLIST: 2,0\r\n':
-                                no_data = True
-                                for i in range(20):
-                                    try:
-                                        line = self.port.readline().decode('utf-8')
-                                        #print('2',line)
-                                    except:
-                                        continue
-                                    if line == 'OK\r\n':
-                                        #print('Okidoki')
-                                        j=0
-                                        break
-                                break
-                            elif '+FTPLIST: 2,' in line:
-                                # data transmission is beginning
-                                # get size of data and read that many bytes
-                                pattern = re.compile('[+]FTPLIST: 2,(\d+)\\r\\n')
-                                m = pattern.match(line)
-                                size = m.group(1)
-                                chunk = self.port.read(int(size))
-                                #print(chunk)
-                                dir_list = dir_list + chunk
-                                block_finished = True
-                                k=0
-                                # transmission of data block completed
-                                break
-                        if transfer_complete or error:
+                    while True:
+                        try:
+                            line = next(lines)
+                        except StopIteration as stop:
+                            status = stop.value
                             break
-                elif error:
-                    continue
-                        
-                elif '+FTPLIST: 1,' in line:
-                    print(line)
-                    # error
-                    pattern = re.compile('[+]FTPLIST: 1,(\d+)\\r\\n')
-                    m = pattern.match(line)
-                    error = int(m.group(1))
-                    print('FTP Error:',self.ftp_errors[error])
-                    print(time.time()-start)
-                    
-                    if encoding == []:
-                        return dir_list.decode('utf-8').split('\r\n')
-                    else:
-                        return self.ftp_list_decode(dir_list.decode('utf-8').split('\r\n'),encoding,error=True)
-            return[]
+                        if not line:
+                            continue
+                        seen = seen+1
+                        if seen <= done:
+                            continue
+                        done = seen
+                        line = line.decode('utf-8', 'replace')
+                        if pattern is None:
+                            yield line
+                            continue
+                        entry = self.ftp_list_entry(line, pattern, encoding[1])
+                        if entry is None:
+                            self.metrics.counters['decode_errors'] += 1
+                            continue
+                        yield entry
+                finally:
+                    # stopped early or the module stopped answering
+                    if status in (1, None):
+                        self.ftp_quit(attempts=1)
+            if status == 0:
+                return
+            if status is not None:
+                self.report('FTP Error: {}'.format(self.ftp_errors.get(status,status)), level=logging.WARNING)
+    
+    # encoding of list can vary between ftp servers
+    # common seems to be: ['([\w-]+)\s+(\d+)\s+(\w+)\s+(\w+)\s+(\d+)\s+(.+\s+.+\s+.+)\s+(.+)',['permissions','type','user','group','size','date/time','name']]
+    # encoding = [] gives raw list
+    # otherwise specify as [<regex pattern>,[<label0>,<label1>,...]]
+    @transaction
+    def ftp_list_dir(self, dir, encoding=[],attempts=3):
+        for i in range(attempts):
+            # set directory
+            if not self.ftp_get_path(dir):
+                continue
+            # start ftp list session   
+            self.report('Opening FTP directory readout.')
+            if not self.write_simple_command('AT+FTPLIST=1'):
+                continue
+            
+            start = time.time()
+            dir_list = bytearray()
+            # 1 = data available, 0 = transfer finished, anything else is an error
+            frame = self.wait_for(b'+FTPLIST: 1,', timeout=75)
+            if frame is None:
+                continue
+            status = self.ftp_session_status(frame, 'FTPLIST')
+            if status == 1:
+                self.report('Receiving Data.')
+                status = self.ftp_read_session('FTPLIST', dir_list.extend)
+            
+            if status is None:
+                continue
+            if status == 0:
+                # data transfer finished
+                self.report('Data transfer complete.')
+                if encoding == []:
+                    return dir_list.decode('utf-8').split('\r\n')
+                else:
+                    return self.ftp_list_decode(dir_list.decode('utf-8').split('\r\n'),encoding)
+            # error
+            self.report('FTP Error: {}'.format(self.ftp_errors.get(status,status)), level=logging.WARNING)
+            self.report('{:.1f} seconds'.format(time.time()-start))
+            if encoding == []:
+                return dir_list.decode('utf-8').split('\r\n')
+            else:
+                return self.ftp_list_decode(dir_list.decode('utf-8').split('\r\n'),encoding,error=True)
+        return []
     
         # get ccid of sim card (0 = error)
     def sim_get_ccid(self, attempts=3):
         for i in range(attempts):
-            self.port.write('AT+CCID\r\n'.encode('utf-8'))
-            pattern = re.compile('(.*)\r\n')
-            for j in range(5):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                except:
-                    continue
-                if line == 'AT+CCID\r\r\n':
+            final, frames = self.write_command('AT+CCID')
+            for frame in frames:
+                if frame.kind == 'text':
                     try:
-                        line = self.port.readline().decode('utf-8')
+                        return frame.line.decode('utf-8')
                     except:
+                        self.metrics.counters['decode_errors'] += 1
                         continue
-                    m = pattern.match(line)
-                    if m:
-                        ccid = m.group(1)
-                        return ccid
         return 0
     
     # lac & ci (location infor only returned when n=2, stat: 
@@ -1145,76 +3201,76 @@ class SIM808():
     # 5 Registered, roaming
     def network_get_registration(self, attempts=3):
         for i in range(attempts):
-            self.port.write('AT+CREG?\r\n'.encode('utf-8'))
-            pattern = re.compile('[+]CREG: (\d),(\d),?(".+")?,?(".+")?\\r\\n')
-            for j in range(5):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                except:
-                    continue
-                m = pattern.match(line)
-                if m:
-                    n = int(m.group(1))
-                    stat = int(m.group(2))
-                    lac = m.group(3)
-                    ci = m.group(4)
-                    return {'n':n, 'stat':stat, 'lac':lac, 'ci':ci}
+            final, frames = self.write_command('AT+CREG?')
+            result = self.network_parse_registration(frames)
+            if result is not None:
+                return result
         return {'n':None, 'stat':None, 'lac':None, 'ci':None}
     
+    # registration dict from a +CREG: response
+    def network_parse_registration(self, frames):
+        for frame in frames:
+            fields = parse_response(frame.line, b'+CREG')
+            if fields:
+                n, stat, lac, ci = fields
+                return {'n':n, 'stat':stat, 'lac':lac, 'ci':ci}
+        return None
+    
     # get list of available network operators, first home network then networks referenced in SIM, and other networks.
     def operator_get_available(self, attempts=3):
         for i in range(attempts):
-            self.port.write('AT+COPS=?\r\n'.encode('utf-8'))
-            pattern = re.compile('[+]COPS: ([(].+[)]),,([(].+[)]),([(].+[)])\\r\\n')
-            for j in range(20):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                except:
-                    continue
-                m = pattern.match(line)
-                if m:
-                    available_raw = m.group(1).split("),(")
-                    available = []
-                    for operator in available_raw:
-                        operator = operator.strip("()").split(',')
-                        operator_dict = {}
-                        operator_dict['supported_stat'] = int(operator[0])
-                        operator_dict['id_long'] = operator[1].strip('"')
-                        operator_dict['id_short'] = operator[2].strip('"')
-                        operator_dict['id_num'] = int(operator[3].strip('"'))
-                        available.append(operator_dict)
-                    modes = m.group(2)
-                    formats = m.group(3)
-                    return {'available':available,'modes':modes,'formats':formats}
-        return {'available':None,'modes':None,'formats':None} 
+            # network scan takes up to a few minutes
+            final, frames = self.write_command('AT+COPS=?', timeout=180)
+            result = self.operator_parse_available(frames)
+            if result is not None:
+                return result
+        return {'available':None,'modes':None,'formats':None}
+    
+    # operator list from a +COPS: test command response
+    def operator_parse_available(self, frames):
+        for frame in frames:
+            fields = parse_response(frame.line, b'+COPS')
+            if fields and fields[0].startswith('('):
+                available_raw = fields[0].split("),(")
+                available = []
+                for operator in available_raw:
+                    operator = operator.strip("()").split(',')
+                    operator_dict = {}
+                    operator_dict['supported_stat'] = int(operator[0])
+                    operator_dict['id_long'] = operator[1].strip('"')
+                    operator_dict['id_short'] = operator[2].strip('"')
+                    operator_dict['id_num'] = int(operator[3].strip('"'))
+                    available.append(operator_dict)
+                modes = fields[1]
+                formats = fields[2]
+                return {'available':available,'modes':modes,'formats':formats}
+        return None
         
     def operator_get_current(self, attempts=3):
         for i in range(attempts):
-            self.port.write('AT+COPS?\r\n'.encode('utf-8'))
-            pattern = re.compile('[+]COPS: (\d),?(\d)?,?(.*)?\\r\\n')
-            for j in range(5):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                except:
-                    continue
-                if line == 'AT+COPS?\r\r\n':
-                    try:
-                        line = self.port.readline().decode('utf-8')
-                    except:
-                        continue
-                    m = pattern.match(line)
-                    if m:
-                        mode = int(m.group(1))
-                        if m.group(2):
-                            format = m.group(2)
-                            operator = m.group(3).strip('"')
-                        else:
-                            format = None
-                            operator = None
-                        current_operator = {'mode':mode,'format':format,'operator':operator}
-                        return current_operator
+            final, frames = self.write_command('AT+COPS?')
+            result = self.operator_parse_current(frames)
+            if result is not None:
+                return result
         return {'mode':None,'format':None,'operator':None}
     
+    # current operator from a +COPS: read command response
+    def operator_parse_current(self, frames):
+        for frame in frames:
+            fields = parse_response(frame.line, b'+COPS')
+            if fields and isinstance(fields[0], int):
+                mode = fields[0]
+                if fields[1]:
+                    format = fields[1]
+                    operator = fields[2]
+                else:
+                    format = None
+                    operator = None
+                current_operator = {'mode':mode,'format':format,'operator':operator}
+                return current_operator
+        return None
+    
+    
     def operator_set_automatic(self,attempts=3):
         cmd = 'AT+COPS=0'
         return self.write_simple_command(cmd,attempts=attempts)
@@ -1236,29 +3292,823 @@ class SIM808():
     # baudrate 0 = automatic mode
     def get_serial_baudrate(self,attempts=3):
         for i in range(attempts):
-            self.port.write('AT+IPR?\r\n'.encode('utf-8'))
-            pattern = re.compile('[+]IPR: (\d+)\\r\\n')
-            for j in range(5):
-                try:
-                    line = self.port.readline().decode('utf-8')
-                except:
-                    continue
-                if line == 'AT+IPR?\r\r\n':
-                    try:
-                        line = self.port.readline().decode('utf-8')
-                    except:
-                        continue
-                    m = pattern.match(line)
-                    if m:
-                        baudrate = int(m.group(1))
-                        return baudrate
+            final, frames = self.write_command('AT+IPR?')
+            for frame in frames:
+                fields = parse_response(frame.line, b'+IPR')
+                if fields:
+                    return fields[0]
         return None
     
     def set_serial_baudrate(self,baudrate=0,attempts=3):
         supported = [0,1200,2400,4900,9600,19200,38400,57600,115200,230400,460800]
         if baudrate in supported:
             cmd = 'AT+IPR={}'.format(baudrate)
-            return self.write_simple_command(cmd,attempts=attempts)
+            return self.write_setting(cmd,attempts=attempts)
         else:
-            print('Baud rate not in supported({}).'.format(supported))
+            self.report('Baud rate not in supported({}).'.format(supported), level=logging.WARNING)
+            return False
+
+
+# asyncio version of SIM808 for use inside an event loop
+# the serial port is read through the event loop, so no call blocks other tasks and all timeouts are asyncio deadlines
+# every command and multi-command operation holds sim.lock, so several tasks can share the modem (see transaction)
+#
+#   async with AsyncSIM808('/dev/ttyAMA0') as sim:
+#       print(await sim.gps_read())
+class AsyncSIM808():
+    
+    def __init__(self, port="/dev/ttyAMA0", baud=115200, dtr_pin=0, pwr_pin=0, verbose=1, metrics=None):
+        self.port = serial.Serial(port, baudrate=baud, timeout=0)
+        self.verbose = verbose
+        self.metrics = metrics or Metrics()
+        self.ftp_errors = FTP_ERRORS
+        self.dtr_pin = dtr_pin
+        self.pwr_pin = pwr_pin
+        if dtr_pin != 0 or pwr_pin != 0:
+            import RPi.GPIO
+            self.gpio = RPi.GPIO
+            self.gpio.setmode(self.gpio.BOARD)
+        if dtr_pin != 0:
+            self.gpio.setup(self.dtr_pin, self.gpio.OUT)
+        if pwr_pin != 0:
+            self.gpio.setup(self.pwr_pin, self.gpio.OUT)
+            self.gpio.output(self.pwr_pin,self.gpio.HIGH)
+        self.framer = ATFramer()
+        self.urc_handlers = {}
+        self.urc_consumed = set()
+        self.settings = {}
+        self.bearers = {}
+        self.bearer_used = {}
+        self.bearer_backoff = {}
+        # notified by track_state like in SIM808, AsyncSIM808.wait_event polls module_events instead of waiting on it
+        self.module_events = {}
+        self.module_changed = threading.Condition()
+        self.gps_fixes = collections.deque(maxlen=3600)
+        self.gps_callbacks = []
+        self.gps_track = None
+        self.sms_inbox = None
+        self.sms_callbacks = []
+        self.loop = None
+        self.frames = None
+        # asyncio.Lock held by every command and multi-command operation and the task holding it, see transaction
+        self.lock = None
+        self.lock_task = None
+    
+    async def __aenter__(self):
+        return await self.open()
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+    
+    # start reading the port through the running event loop
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.frames = asyncio.Queue()
+        self.lock = asyncio.Lock()
+        os.set_blocking(self.port.fileno(), False)
+        self.loop.add_reader(self.port.fileno(), self.on_readable)
+        return self
+    
+    async def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.port.fileno())
+        self.port.close()
+        if self.dtr_pin != 0:
+            self.gpio.cleanup(self.dtr_pin)
+        if self.pwr_pin != 0:
+            self.gpio.cleanup(self.pwr_pin)
+    
+    # called by the event loop whenever the port has data
+    def on_readable(self):
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except Exception:
+            return
+        self.metrics.counters['bytes_in'] += len(data)
+        for frame in self.framer.feed(data):
+            self.track_state(frame)
+            consumed = False
+            for prefix, handlers in list(self.urc_handlers.items()):
+                if frame.line.startswith(prefix):
+                    consumed = consumed or prefix in self.urc_consumed
+                    for handler in handlers:
+                        self.loop.call_soon(self.dispatch, handler, frame)
+            if not consumed:
+                self.frames.put_nowait(frame)
+    
+    # handlers can be plain functions or coroutine functions
+    def dispatch(self, handler, frame):
+        try:
+            result = handler(frame)
+            if asyncio.iscoroutine(result):
+                self.loop.create_task(result)
+        except Exception as e:
+            self.report('URC handler for {} failed: {}'.format(frame.line, e), level=logging.WARNING)
+    
+    # helpers that do not touch the port are shared with SIM808
+    # setters only return the result of write_simple_command, which is awaitable here
+    report = SIM808.report
+    track_state = SIM808.track_state
+    module_event = SIM808.module_event
+    urc_subscribe = SIM808.urc_subscribe
+    urc_unsubscribe = SIM808.urc_unsubscribe
+    get_file_from_path = SIM808.get_file_from_path
+    sms_parse_list = SIM808.sms_parse_list
+    sms_delete = SIM808.sms_delete
+    sms_receive_start = SIM808.sms_receive_start
+    sms_receive_stop = SIM808.sms_receive_stop
+    sms_on_urc = SIM808.sms_on_urc
+    sms_subscribe = SIM808.sms_subscribe
+    sms_unsubscribe = SIM808.sms_unsubscribe
+    gps_activate = SIM808.gps_activate
+    gps_timestamp_to_dict = SIM808.gps_timestamp_to_dict
+    gps_parse = SIM808.gps_parse
+    gps_stream_start = SIM808.gps_stream_start
+    gps_stream_stop = SIM808.gps_stream_stop
+    gps_on_urc = SIM808.gps_on_urc
+    gps_latest = SIM808.gps_latest
+    gps_since = SIM808.gps_since
+    gps_subscribe = SIM808.gps_subscribe
+    gps_unsubscribe = SIM808.gps_unsubscribe
+    ftp_parameters = SIM808.ftp_parameters
+    ftp_set_username = SIM808.ftp_set_username
+    ftp_set_password = SIM808.ftp_set_password
+    ftp_set_port = SIM808.ftp_set_port
+    ftp_set_server = SIM808.ftp_set_server
+    ftp_put_name = SIM808.ftp_put_name
+    ftp_put_path = SIM808.ftp_put_path
+    ftp_get_name = SIM808.ftp_get_name
+    ftp_get_path = SIM808.ftp_get_path
+    ftp_set_profile_id = SIM808.ftp_set_profile_id
+    ftp_quit = SIM808.ftp_quit
+    ftp_close_put_session = SIM808.ftp_close_put_session
+    ftp_list_decode = SIM808.ftp_list_decode
+    ftp_session_status = SIM808.ftp_session_status
+    email_parameters = SIM808.email_parameters
+    email_set_ssl = SIM808.email_set_ssl
+    email_set_subject = SIM808.email_set_subject
+    email_set_charset = SIM808.email_set_charset
+    email_set_timeout = SIM808.email_set_timeout
+    email_set_recipient = SIM808.email_set_recipient
+    email_set_sender = SIM808.email_set_sender
+    email_set_auth = SIM808.email_set_auth
+    email_set_profile_id = SIM808.email_set_profile_id
+    email_set_server = SIM808.email_set_server
+    bearer_set_connection_type = SIM808.bearer_set_connection_type
+    bearer_set_apn = SIM808.bearer_set_apn
+    bearer_parse = SIM808.bearer_parse
+    network_parse_registration = SIM808.network_parse_registration
+    operator_parse_available = SIM808.operator_parse_available
+    operator_parse_current = SIM808.operator_parse_current
+    operator_set_automatic = SIM808.operator_set_automatic
+    operator_set_manual = SIM808.operator_set_manual
+    
+    # write without blocking the event loop, waits for the port to become writable if its buffer is full
+    async def write(self, data):
+        self.metrics.counters['bytes_out'] += len(data)
+        fd = self.port.fileno()
+        view = memoryview(data)
+        while view:
+            try:
+                n = os.write(fd, view)
+            except BlockingIOError:
+                n = 0
+            view = view[n:]
+            if view:
+                writable = self.loop.create_future()
+                self.loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(fd)
+    
+    def flush(self):
+        while not self.frames.empty():
+            self.frames.get_nowait()
+    
+    async def next_frame(self, deadline):
+        remaining = deadline - self.loop.time()
+        if remaining <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self.frames.get(), remaining)
+        except asyncio.TimeoutError:
+            return None
+    
+    async def read_response(self, timeout=5, echo=None):
+        deadline = self.loop.time() + timeout
+        frames = []
+        while True:
+            frame = await self.next_frame(deadline)
+            if frame is None:
+                return None, frames
+            if frame.kind == 'final':
+                return frame.line, frames
+            if frame.kind == 'echo' and frame.line == echo:
+                continue
+            frames.append(frame)
+    
+    @transaction
+    async def write_command(self, cmd, timeout=5, flush=True):
+        if isinstance(cmd, str):
+            cmd = cmd.encode('utf-8')
+        cmd = cmd.strip()
+        if flush:
+            self.flush()
+        start = self.loop.time()
+        await self.write(cmd+b'\r\n')
+        final, frames = await self.read_response(timeout, echo=cmd)
+        self.metrics.command(cmd, self.loop.time()-start, final)
+        return final, frames
+    
+    async def wait_for(self, prefix, timeout=5):
+        deadline = self.loop.time() + timeout
+        while True:
+            frame = await self.next_frame(deadline)
+            if frame is None:
+                self.metrics.counters['timeouts'] += 1
+                return None
+            if frame.line.startswith(prefix):
+                return frame
+    
+    async def write_simple_command(self, cmd, attempts=3, timeout=5):
+        cmd = cmd.strip()
+        for i in range(attempts):
+            if i:
+                self.metrics.counters['retries'] += 1
+            final, frames = await self.write_command(cmd, timeout=timeout)
+            if final == b'OK':
+                return True
+        self.report("Couldn't send command {}.".format(cmd), hot=True, level=logging.WARNING)
+        return False
+    
+    async def write_setting(self, cmd, attempts=3, key=None):
+        key = key or cmd.split('=')[0]
+        if self.settings.get(key) == cmd:
+            return True
+        self.settings.pop(key, None)
+        if not await self.write_simple_command(cmd, attempts):
+            return False
+        self.settings[key] = cmd
+        return True
+    
+    @transaction
+    async def power(self, on=True, attempts=3, timeout=10, probe=1):
+        self.settings = {}
+        self.bearers = {}
+        for i in range(attempts):
+            if on:
+                if await self.standby(0,attempts=1,timeout=1) or await self.wait_ready(timeout=0.5):
+                    return True
+                since = time.monotonic()
+                if not await self.power_toggle():
+                    return False
+                if await self.wait_ready(timeout=timeout, since=since):
+                    return True
+            else:
+                since = time.monotonic()
+                await self.write(b'AT+CPOWD=1\r\n')
+                if await self.wait_event(POWER_DOWN_URCS, timeout, since) is not None:
+                    return True
+                final, frames = await self.write_command('AT', timeout=probe)
+                if final is None and not frames:
+                    return True
+        return False
+    
+    async def power_toggle(self,duration=1.5):
+        self.settings = {}
+        self.bearers = {}
+        if self.pwr_pin != 0:
+            self.gpio.output(self.pwr_pin,self.gpio.LOW)
+            await asyncio.sleep(duration)
+            self.gpio.output(self.pwr_pin,self.gpio.HIGH)
+            return True
+        return False
+    
+    async def wait_event(self, events, timeout, since=None):
+        since = time.monotonic() if since is None else since
+        deadline = time.monotonic()+timeout
+        while True:
+            event = self.module_event(events, since)
+            remaining = deadline-time.monotonic()
+            if event is not None or remaining <= 0:
+                return event
+            await asyncio.sleep(min(remaining, 0.02))
+    
+    @transaction
+    async def wait_ready(self, timeout=10, since=None, events=(b'RDY',), probe=0.5):
+        since = time.monotonic() if since is None else since
+        deadline = time.monotonic()+timeout
+        while True:
+            remaining = deadline-time.monotonic()
+            if self.module_event(events, since) is not None:
+                return True
+            if remaining <= 0:
+                return False
+            if probe is None:
+                return await self.wait_event(events, remaining, since) is not None
+            probe_deadline = self.loop.time()+min(probe, remaining)
+            self.flush()
+            await self.write(b'AT\r\n')
+            while True:
+                frame = await self.next_frame(probe_deadline)
+                if frame is None:
+                    break
+                if frame.kind == 'final' or self.module_event(events, since) is not None:
+                    return True
+    
+    # 0 = slow clock off, 1 = slow clock on, 2 = slow clock auto
+    async def standby(self,stby=1, attempts=3, timeout=5):
+        for i in range(attempts):
+            if stby in (0,1) and self.dtr_pin == 0:
+                return False
+            if stby == 0:
+                self.gpio.output(self.dtr_pin,self.gpio.LOW)
+                if not await self.wait_ready(timeout=timeout, probe=0.1):
+                    continue
+                if await self.write_simple_command('AT+CSCLK=0',attempts=1):
+                    self.settings['AT+CSCLK'] = 'AT+CSCLK=0'
+                    return True
+                continue
+            if stby == 1:
+                self.gpio.output(self.dtr_pin,self.gpio.HIGH)
+            if await self.write_setting('AT+CSCLK={}'.format(stby),attempts):
+                return True
+        return False
+    
+    async def sim_get_ccid(self, attempts=3):
+        for i in range(attempts):
+            final, frames = await self.write_command('AT+CCID')
+            for frame in frames:
+                if frame.kind == 'text':
+                    try:
+                        return frame.line.decode('utf-8')
+                    except:
+                        self.metrics.counters['decode_errors'] += 1
+                        continue
+        return 0
+    
+    async def sms_get(self, type='ALL', mode=0, attempts=3):
+        for i in range(attempts):
+            if not await self.write_setting('AT+CMGF=1'):
+                continue
+            final, frames = await self.write_command('AT+CMGL="{}",{}'.format(type,mode), timeout=20)
+            if final != b'OK':
+                continue
+            return self.sms_parse_list(frames)
+        return None
+    
+    @transaction
+    async def sms_send(self, number, message, attempts=3):
+        for i in range(attempts):
+            if not await self.write_setting('AT+CMGF=1'):
+                continue
+            self.flush()
+            await self.write('AT+CMGS=\"{}\"\r'.format(number).encode('utf-8'))
+            frame = await self.wait_for((b'>', b'ERROR', b'+CMS ERROR'))
+            if frame is None or frame.kind != 'prompt':
+                continue
+            await self.write(message.encode('utf-8')+chr(26).encode('utf-8'))
+            final, frames = await self.read_response(timeout=60)
+            if final == b'OK':
+                return True
+        return False
+    
+    async def gps_read(self,attempts=3):
+        for i in range(attempts):
+            final, frames = await self.write_command('AT+CGNSINF')
+            for frame in frames:
+                if frame.line.startswith(b'+CGNSINF:'):
+                    gps = self.gps_parse(frame.line)
+                    if gps is not None:
+                        return gps
+            if final == b'OK':
+                return {}
+        return None
+    
+    async def bearer_query(self, bearer=1, attempts=3):
+        for i in range(attempts):
+            final, frames = await self.write_command('AT+SAPBR=2,{}'.format(bearer))
+            result = self.bearer_parse(frames)
+            if result is not None:
+                self.bearers[bearer] = result[1]
+                return result
+        return 0, 0, ""
+    
+    # 0 = connecting, 1 = connected, 2 = closing, 3 = closed
+    async def bearer_get_status(self, bearer=1):
+        cid, status, ip = await self.bearer_query(bearer = bearer)
+        return status
+    
+    async def bearer_get_ip(self, bearer=1):
+        cid, status, ip = await self.bearer_query(bearer = bearer)
+        return ip
+    
+    # wait for the bearer to settle in the wanted state, sending the command again while it does not
+    async def bearer_switch(self, bearer, open, attempts, timeout):
+        target = 1 if open else 3
+        cmd = 'AT+SAPBR={},{}'.format(1 if open else 0, bearer)
+        deadline = self.loop.time() + timeout
+        while self.loop.time() < deadline:
+            status = await self.bearer_get_status(bearer=bearer)
+            if status == target:
+                return True
+            if status in (0,2):
+                await asyncio.sleep(1)
+                continue
+            if attempts <= 0:
+                return False
+            attempts = attempts-1
+            await self.write_simple_command(cmd, attempts=1, timeout=85)
+        return False
+    
+    async def bearer_open(self, bearer=1, attempts=5, timeout=180):
+        return await self.bearer_switch(bearer, True, attempts, timeout)
+    
+    async def bearer_close(self, bearer=1, attempts=5, timeout=120):
+        return await self.bearer_switch(bearer, False, attempts, timeout)
+    
+    async def bearer_acquire(self, bearer=1, apn=None, attempts=5, verify=False):
+        self.bearer_used[bearer] = self.loop.time()
+        if self.bearers.get(bearer) == 1 and not verify:
+            return True
+        retry, delay = self.bearer_backoff.get(bearer, (0, 0))
+        if self.loop.time() < retry:
+            return False
+        if (await self.bearer_set_connection_type(bearer=bearer, type="GPRS", attempts=attempts)
+                and await self.bearer_set_apn(apn or self.apn, bearer=bearer, attempts=attempts)
+                and await self.bearer_open(bearer=bearer, attempts=attempts)):
+            self.bearer_backoff.pop(bearer, None)
+            return True
+        delay = min(max(delay*2, 10), 600)
+        self.bearer_backoff[bearer] = (self.loop.time()+delay, delay)
+        self.report('Bearer {} could not be opened, next try in {} seconds.'.format(bearer, delay), level=logging.WARNING)
+        return False
+    
+    async def bearer_close_idle(self, idle=300):
+        closed = []
+        for bearer, used in list(self.bearer_used.items()):
+            if self.bearers.get(bearer) == 1 and self.loop.time()-used >= idle and await self.bearer_close(bearer=bearer):
+                closed.append(bearer)
+        return closed
+    
+    async def network_get_registration(self, attempts=3):
+        for i in range(attempts):
+            final, frames = await self.write_command('AT+CREG?')
+            result = self.network_parse_registration(frames)
+            if result is not None:
+                return result
+        return {'n':None, 'stat':None, 'lac':None, 'ci':None}
+    
+    async def operator_get_available(self, attempts=3):
+        for i in range(attempts):
+            final, frames = await self.write_command('AT+COPS=?', timeout=180)
+            result = self.operator_parse_available(frames)
+            if result is not None:
+                return result
+        return {'available':None,'modes':None,'formats':None}
+    
+    async def operator_get_current(self, attempts=3):
+        for i in range(attempts):
+            final, frames = await self.write_command('AT+COPS?')
+            result = self.operator_parse_current(frames)
+            if result is not None:
+                return result
+        return {'mode':None,'format':None,'operator':None}
+    
+    async def ftp_initialize(self, attempts=5):
+        for i in range(attempts):
+            if not await self.bearer_acquire(self.ftp_bearer, self.apn, attempts=attempts):
+                continue
+            if not await self.ftp_set_profile_id(self.ftp_bearer,attempts=attempts):
+                continue
+            if not await self.ftp_set_server(self.ftp_server,attempts=attempts):
+                continue
+            if not await self.ftp_set_port(self.ftp_port,attempts=attempts):
+                continue
+            if not await self.ftp_set_username(self.ftp_user,attempts=attempts):
+                continue
+            if not await self.ftp_set_password(self.ftp_pwd,attempts=attempts):
+                continue
+            return True
+        return False
+    
+    # FTP commands that are confirmed by a +FTPXXX: 1,<result> URC, returns the result code (None on timeout)
+    async def ftp_wait_result(self, cmd, timeout=75):
+        if not await self.write_simple_command(cmd):
+            return None
+        frame = await self.wait_for(cmd[2:].split('=')[0].encode('utf-8')+b': 1,', timeout=timeout)
+        if frame is None:
+            return None
+        fields = parse_response(frame.line)
+        return fields[1] if fields else None
+    
+    @transaction
+    async def ftp_open_put_session(self,attempts=3):
+        if not await self.write_simple_command('AT+FTPPUT=1',attempts=attempts):
+            return (False,0,0)
+        frame = await self.wait_for(b'+FTPPUT: 1,', timeout=75)
+        if frame is None:
+            return (False,0,0)
+        mode, error, maxlength = parse_response(frame.line, b'+FTPPUT') or (1, 0, None)
+        if error != 1 or maxlength is None:
+            return (False,error,0)
+        return (True,1,maxlength)
+    
+    # send one chunk in an open put session, returns the length the module accepts next (0 on error)
+    # last = True for the final short chunk, the module is not asked for the next one, its length is returned
+    @transaction
+    async def ftp_put_chunk(self, data, timeout=75, last=False):
+        await self.write('AT+FTPPUT=2,{}\r\n'.format(len(data)).encode('utf-8'))
+        frame = await self.wait_for((b'+FTPPUT: 2,', b'ERROR', b'+CME ERROR'))
+        if frame is None or frame.line != '+FTPPUT: 2,{}'.format(len(data)).encode('utf-8'):
+            return 0
+        await self.write(data)
+        final, frames = await self.read_response(timeout=30)
+        if final != b'OK':
+            return 0
+        if last:
+            return len(data)
+        frame = await self.wait_for(b'+FTPPUT: 1,', timeout=timeout)
+        if frame is None:
+            return 0
+        mode, error, maxlength = parse_response(frame.line, b'+FTPPUT') or (1, 0, None)
+        if error != 1 or maxlength is None:
+            return 0
+        return maxlength
+    
+    @transaction
+    async def ftp_file_upload(self,file,dir,validate=False,attempts=3):
+        start_time = self.loop.time()
+        file_name = self.get_file_from_path(file)
+        for i in range(attempts):
+            if not await self.ftp_put_name(file_name):
+                continue
+            if not await self.ftp_put_path(dir):
+                continue
+            ftp_open, ftp_error, maxlength = await self.ftp_open_put_session()
+            if not ftp_open:
+                self.report(self.ftp_errors.get(ftp_error,ftp_error), level=logging.WARNING)
+                await self.ftp_initialize()
+                continue
+            size = 0
+            with open(file,'rb') as f:
+                chunk = f.read(maxlength)
+                while chunk:
+                    # a short read means the file is exhausted
+                    last = len(chunk) < maxlength
+                    maxlength = await self.ftp_put_chunk(chunk, last=last)
+                    if maxlength == 0:
+                        break
+                    size = size+len(chunk)
+                    chunk = b'' if last else f.read(maxlength)
+            if chunk:
+                continue
+            await self.ftp_close_put_session()
+            duration = self.loop.time()-start_time
+            self.report('Transfer of {} completed in {:.2f} seconds ({} B/s).'.format(file, duration, int(size/duration)))
+            if validate and size != await self.ftp_get_filesize(dir,file_name,attempts=attempts):
+                self.report("File size does not match, attempt again:", level=logging.WARNING)
+                continue
+            return True
+        self.report('Transfer of {} failed.'.format(file), level=logging.WARNING)
+        return False
+    
+    # read the data of an open FTPGET or FTPLIST session and pass every block to sink until the module reports the end of the transfer
+    # returns the final status (0 = complete, otherwise an FTP error) or None on timeout
+    @transaction
+    async def ftp_read_session(self, command, sink, size=FTP_MAX_CHUNK):
+        prefix = '+{}: 1,'.format(command).encode('utf-8')
+        status = 1
+        while status == 1:
+            final, frames = await self.write_command('AT+{}=2,{}'.format(command,size), timeout=10, flush=False)
+            if final != b'OK':
+                return None
+            received = 0
+            for frame in frames:
+                if frame.kind == 'data':
+                    sink(frame.payload)
+                    received = len(frame.payload)
+                elif frame.line.startswith(prefix):
+                    status = self.ftp_session_status(frame, command)
+            if received == 0 and status == 1:
+                frame = await self.wait_for(prefix, timeout=75)
+                if frame is None:
+                    return None
+                status = self.ftp_session_status(frame, command)
+        return status
+    
+    @transaction
+    async def ftp_file_download(self,file,dir_server,dir_local='',validate=False,attempts=3):
+        data = bytearray()
+        errors = []
+        output = {'errors':errors, 'complete':False}
+        for i in range(attempts):
+            if not await self.ftp_get_name(file,attempts=attempts):
+                continue
+            if not await self.ftp_get_path(dir_server,attempts=attempts):
+                continue
+            if not await self.write_simple_command('AT+FTPREST={}'.format(len(data)),attempts=attempts):
+                continue
+            status = await self.ftp_wait_result('AT+FTPGET=1')
+            if status == 1:
+                status = await self.ftp_read_session('FTPGET', data.extend)
+            if status is None:
+                continue
+            if status != 0:
+                errors.append(status)
+                continue
+            if validate and len(data) != await self.ftp_get_filesize(dir_server,file):
+                data = bytearray()
+                continue
+            output['complete'] = True
+            break
+        output['data'] = bytes(data)
+        try:
+            with open(dir_local + file,'wb') as f:
+                f.write(data)
+        except Exception as e:
+            self.report('Could not write data to file: {}'.format(e), level=logging.WARNING)
+        return output
+    
+    @transaction
+    async def ftp_list_dir(self, dir, encoding=[],attempts=3):
+        for i in range(attempts):
+            if not await self.ftp_get_path(dir):
+                continue
+            dir_list = bytearray()
+            status = await self.ftp_wait_result('AT+FTPLIST=1')
+            if status == 1:
+                status = await self.ftp_read_session('FTPLIST', dir_list.extend)
+            if status is None:
+                continue
+            if status != 0:
+                self.report('FTP Error: {}'.format(self.ftp_errors.get(status,status)), level=logging.WARNING)
+            lines = dir_list.decode('utf-8').split('\r\n')
+            if encoding == []:
+                return lines
+            return self.ftp_list_decode(lines,encoding,error=status != 0)
+        return []
+    
+    @transaction
+    async def ftp_get_filesize(self,dir,file,attempts=3):
+        for i in range(attempts):
+            if not await self.ftp_get_path(dir,attempts=attempts):
+                continue
+            if not await self.ftp_get_name(file,attempts=attempts):
+                continue
+            if not await self.write_simple_command('AT+FTPSIZE',attempts=attempts):
+                continue
+            frame = await self.wait_for(b'+FTPSIZE: 1,', timeout=75)
+            if frame is None:
+                continue
+            fields = parse_response(frame.line, b'+FTPSIZE')
+            if not fields:
+                continue
+            mode, error, size = fields
+            if error == 0:
+                return size or 0
+            if error == FTP_FILE_MISSING:
+                return 0
+            return None
+        return None
+    
+    @transaction
+    async def ftp_file_delete(self,file,dir,attempts=3):
+        for i in range(attempts):
+            if not await self.ftp_get_name(file,attempts=attempts):
+                continue
+            if not await self.ftp_get_path(dir,attempts=attempts):
+                continue
+            if await self.ftp_wait_result('AT+FTPDELE') == 0:
+                return True
+        return False
+    
+    # create = True for making dir, False for deleting dir
+    @transaction
+    async def ftp_dir_create_delete(self, dir, create, attempts=3):
+        for i in range(attempts):
+            if not await self.ftp_get_path(dir):
+                continue
+            result = await self.ftp_wait_result('AT+FTPMKD' if create else 'AT+FTPRMD')
+            if result is None:
+                continue
+            if result != 0:
+                self.report(self.ftp_errors.get(result,result), level=logging.WARNING)
+            return result == 0
+        return False
+    
+    async def email_initialize(self, attempts=5):
+        for i in range(attempts):
+            if not await self.bearer_acquire(self.email_bearer, self.apn, attempts=attempts):
+                continue
+            if not await self.email_set_profile_id(self.email_bearer,attempts=attempts):
+                continue
+            if not await self.email_set_timeout(self.email_timeout,attempts=attempts):
+                continue
+            if not await self.email_set_charset(self.email_charset,attempts=attempts):
+                continue
+            if not await self.email_set_server(self.email_server,self.email_port,attempts=attempts):
+                continue
+            if not await self.email_set_auth(self.email_user,self.email_pwd,attempts=attempts):
+                continue
+            if not await self.email_set_sender(self.email_sender_address,self.email_sender_name,attempts=attempts):
+                continue
+            if not await self.email_set_ssl(self.email_ssl,attempts=attempts):
+                continue
+            return True
+        return False
+    
+    # attachment: local path or binary file object, or a list of them, streamed in blocks like in SIM808.email_send
+    @transaction
+    async def email_send(self,subject,message,recipient_to_address,recipient_to_name,recipient_cc_address='',
+                    recipient_cc_name='',recipient_bcc_address='',recipient_bcc_name='',attachment='',attempts=3):
+        message = message.encode('utf-8').hex().encode('utf-8')
+        attachments = list(attachment) if isinstance(attachment, (list, tuple)) else [attachment] if attachment else []
+        recipients = (('to',recipient_to_address,recipient_to_name), ('cc',recipient_cc_address,recipient_cc_name),
+                      ('bcc',recipient_bcc_address,recipient_bcc_name))
+        starts = [None if isinstance(a, str) or not a.seekable() else a.tell() for a in attachments]
+        read = set()
+        for i in range(attempts):
+            if not all([await self.email_set_recipient(type,address,name,attempts) for type, address, name in recipients]):
+                continue
+            if not await self.email_set_subject(subject,attempts):
+                continue
+            if not await self.email_set_attachments(attachments,attempts):
+                continue
+            if i > 0:
+                if any(start is None and not isinstance(a, str) and index in read for index, (a, start) in enumerate(zip(attachments, starts))):
+                    self.report('Attachment stream was already read, the email is not sent again.', level=logging.WARNING)
+                    break
+                for a, start in zip(attachments, starts):
+                    if start is not None:
+                        a.seek(start)
+            self.flush()
+            await self.write('AT+SMTPBODY={}\r\n'.format(len(message)).encode('utf-8'))
+            frame = await self.wait_for((b'DOWNLOAD', b'ERROR'))
+            if frame is None or frame.line != b'DOWNLOAD':
+                continue
+            await self.write(message)
+            final, frames = await self.read_response(timeout=15)
+            if final != b'OK':
+                continue
+            try:
+                files = [open(a,'rb') if isinstance(a, str) else a for a in attachments]
+            except OSError as e:
+                self.report('Attachment not readable: {}'.format(e), level=logging.WARNING)
+                return False
+            try:
+                if not await self.write_simple_command('AT+SMTPSEND',attempts=1):
+                    continue
+                error = await self.email_send_attachments(files, read)
+            finally:
+                for a, f in zip(attachments, files):
+                    if isinstance(a, str):
+                        f.close()
+            if error is None:
+                continue
+            if error == 1:
+                return True
+            self.report('Error sending Email: {}.'.format(SMTP_ERRORS.get(error,error)), level=logging.WARNING)
             return False
+        return False
+    
+    async def email_set_attachments(self, attachments, attempts=3):
+        commands = {}
+        for key in self.settings:
+            if key.startswith('AT+SMTPFILE='):
+                commands[key] = key+',""'
+        for index, attachment in enumerate(attachments, 1):
+            name = self.get_file_from_path(attachment if isinstance(attachment, str) else getattr(attachment, 'name', 'attachment{}'.format(index)))
+            commands['AT+SMTPFILE={}'.format(index)] = 'AT+SMTPFILE={},"{}",1'.format(index, name)
+        for key, cmd in sorted(commands.items()):
+            if not await self.write_setting(cmd, attempts, key=key):
+                return False
+        return True
+    
+    # returns the result code of +SMTPSEND, None if the transfer broke off, see SIM808.email_send_attachments
+    @transaction
+    async def email_send_attachments(self, files, read=None):
+        current = 0
+        while True:
+            frame = await self.wait_for((b'+SMTPFT: 1,', b'+SMTPSEND:'), timeout=120)
+            if frame is None:
+                return None
+            if frame.line.startswith(b'+SMTPSEND:'):
+                fields = parse_response(frame.line, b'+SMTPSEND')
+                return fields[0] if fields else None
+            mode, maxlength = parse_response(frame.line, b'+SMTPFT') or (1, 0)
+            if read is not None and current < len(files):
+                read.add(current)
+            data = files[current].read(maxlength) if current < len(files) else b''
+            await self.write('AT+SMTPFT={}\r\n'.format(len(data)).encode('utf-8'))
+            if data:
+                frame = await self.wait_for((b'+SMTPFT: 2,', b'ERROR', b'+CME ERROR'))
+                if frame is None or frame.line != '+SMTPFT: 2,{}'.format(len(data)).encode('utf-8'):
+                    return None
+                await self.write(data)
+            else:
+                current = current+1
+            final, frames = await self.read_response(timeout=30, echo='AT+SMTPFT={}'.format(len(data)).encode('utf-8'))
+            if final != b'OK':
+                return None
@@ -0,0 +1,190 @@
+# Benchmarks of the driver against the simulated module in simulator.py
+# measures command round trips, FTP upload and download throughput over file and chunk sizes,
+# listing of large FTP directories and time lost waiting for responses that never came
+# results are written as JSON, so runs of different driver versions can be compared
+# the same scenarios run over a serial trace recorded with --record (ReplayPort) instead of the simulator with --trace,
+# the trace has to be recorded with the same --quick setting, payloads are generated from a fixed seed for this
+#
+#   python benchmark.py --latency 0.02 --baud 115200 --output results.json
+#   python benchmark.py --quick --record session.rec
+#   python benchmark.py --quick --trace session.rec
+
+import time, os, io, json, argparse, platform, subprocess, random
+from simulator import ModemSimulator
+from SIM808 import SIM808, ReplayPort
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    result = {'p{}'.format(p):values[min(len(values)-1, int(len(values)*p/100))] for p in points}
+    result['min'] = values[0]
+    result['max'] = values[-1]
+    result['mean'] = sum(values)/len(values)
+    return result
+
+# counts waits for frames that ran into their deadline and the time spent in them
+class TimeoutCounter():
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.next_frame = sim.next_frame
+        self.timeouts = 0
+        self.wasted = 0.0
+        sim.next_frame = self.counted
+
+    def counted(self, deadline):
+        start = time.monotonic()
+        frame = self.next_frame(deadline)
+        if frame is None:
+            self.timeouts = self.timeouts+1
+            self.wasted = self.wasted+time.monotonic()-start
+        return frame
+
+    def reset(self):
+        self.timeouts = 0
+        self.wasted = 0.0
+
+    def result(self):
+        return {'timeouts':self.timeouts, 'wasted_seconds':self.wasted}
+
+class Benchmark():
+
+    # trace: serial recording to replay instead of the simulator, record: path to record the run to
+    def __init__(self, latency=0.0, baud=None, noise=0.0, drop=0.0, seed=1, trace=None, record=None):
+        if trace is None:
+            self.modem = ModemSimulator(latency=latency, baud=baud, noise=noise, drop=drop, seed=seed)
+            self.sim = SIM808(port=self.modem.port, t_out=0.5, verbose=0)
+            self.settings = {'latency':latency, 'baud':baud, 'noise':noise, 'drop':drop, 'seed':seed}
+        else:
+            self.modem = None
+            self.sim = SIM808(port=ReplayPort(trace, timeout=0.5), verbose=0)
+            self.settings = {'trace':trace, 'seed':seed}
+        if record is not None:
+            self.sim.record(record)
+        # payloads have to be the same in a recording and its replay
+        self.random = random.Random(seed)
+        self.counter = TimeoutCounter(self.sim)
+
+    # returns the result of function, the elapsed time and the timeouts, retries and package errors it ran into
+    def measure(self, function, *args, **kwargs):
+        self.counter.reset()
+        counters = dict(self.sim.metrics.counters)
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter()-start
+        overhead = self.counter.result()
+        for name in ('retries', 'package_errors'):
+            overhead[name] = self.sim.metrics.counters[name]-counters.get(name, 0)
+        return result, elapsed, overhead
+
+    def command_latency(self, count=200):
+        times = []
+        failed = 0
+        self.counter.reset()
+        for i in range(count):
+            start = time.perf_counter()
+            if not self.sim.write_simple_command('AT'):
+                failed = failed+1
+            times.append(time.perf_counter()-start)
+        result = {'count':count, 'failed':failed, 'seconds':percentiles(times)}
+        result.update(self.counter.result())
+        return result
+
+    def setup_ftp(self):
+        self.sim.ftp_parameters(apn="internet", server="ftp.example.com", port=21, user="user", pwd="pwd")
+        return self.sim.ftp_initialize()
+
+    def upload(self, sizes, chunks):
+        results = []
+        for chunk in chunks:
+            if self.modem is not None:
+                self.modem.put_max = chunk
+            for size in sizes:
+                data = self.random.randbytes(size)
+                ok, elapsed, overhead = self.measure(self.sim.ftp_file_upload, io.BytesIO(data), '/', name='upload.bin')
+                # a trace cannot show what the server stored
+                complete = ok and (self.modem is None or self.modem.files['/'].get('upload.bin') == data)
+                result = {'size':size, 'chunk':chunk, 'complete':bool(complete), 'seconds':elapsed, 'bytes_per_second':size/elapsed}
+                result.update(overhead)
+                results.append(result)
+        if self.modem is not None:
+            self.modem.put_max = 1360
+        return results
+
+    def download(self, sizes, chunks):
+        results = []
+        for chunk in chunks:
+            for size in sizes:
+                data = self.random.randbytes(size)
+                if self.modem is not None:
+                    self.modem.files['/']['download.bin'] = data
+                self.sim.ftp_chunk_max = chunk
+                sink = io.BytesIO()
+                status, elapsed, overhead = self.measure(self.sim.ftp_file_download_stream, 'download.bin', '/', sink)
+                result = {'size':size, 'chunk':chunk, 'complete':status['complete'] and sink.getvalue() == data,
+                          'seconds':elapsed, 'bytes_per_second':size/elapsed}
+                result.update(overhead)
+                results.append(result)
+        return results
+
+    def listing(self, counts):
+        results = []
+        for count in counts:
+            if self.modem is not None:
+                self.modem.files['/list/'] = {'file{:05d}.csv'.format(i):b'' for i in range(count)}
+            lines, elapsed, overhead = self.measure(self.sim.ftp_list_dir, '/list/')
+            result = {'entries':count, 'listed':len([line for line in lines if line]), 'seconds':elapsed}
+            result.update(overhead)
+            results.append(result)
+        return results
+
+    def close(self):
+        self.sim.record_stop()
+        self.sim.reading = False
+        if self.modem is not None:
+            self.modem.close()
+        else:
+            self.sim.port.close()
+
+def driver_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+def run(latency=0.0, baud=None, noise=0.0, drop=0.0, quick=False, trace=None, record=None):
+    sizes = [1024, 16384] if quick else [1024, 16384, 65536, 262144]
+    chunks_up = [512, 1360]
+    chunks_down = [512, 1460] if quick else [256, 512, 1024, 1460]
+    listings = [100] if quick else [100, 1000, 5000]
+    benchmark = Benchmark(latency=latency, baud=baud, noise=noise, drop=drop, trace=trace, record=record)
+    try:
+        results = {'driver':driver_version(), 'python':platform.python_version(), 'time':time.time(), 'settings':benchmark.settings}
+        results['command_latency'] = benchmark.command_latency(50 if quick else 200)
+        results['ftp_setup'] = benchmark.setup_ftp()
+        results['upload'] = benchmark.upload(sizes, chunks_up)
+        results['download'] = benchmark.download(sizes, chunks_down)
+        results['list_dir'] = benchmark.listing(listings)
+    finally:
+        benchmark.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the SIM808 driver against the simulated module')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before every response')
+    parser.add_argument('--baud', type=int, default=None, help='throttle the link to this baudrate')
+    parser.add_argument('--noise', type=float, default=0.0, help='probability of a corrupted byte')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of a lost byte')
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller runs')
+    parser.add_argument('--output', default=None, help='file for the JSON results instead of stdout')
+    parser.add_argument('--record', default=None, metavar='FILE', help='record the serial traffic of the run to FILE')
+    parser.add_argument('--trace', default=None, metavar='FILE', help='replay a recorded serial trace instead of the simulator')
+    args = parser.parse_args()
+    results = run(latency=args.latency, baud=args.baud, noise=args.noise, drop=args.drop, quick=args.quick,
+                  trace=args.trace, record=args.record)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
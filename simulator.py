@@ -0,0 +1,632 @@
+# Offline simulator of a SIM808 module on a pseudo-terminal, for testing and benchmarking without hardware
+# implements the AT commands used by SIM808.py: SMS, GPS, bearer, FTP, SMTP, network, baudrate and slow clock
+# the link can be made realistic with command latency, baudrate throttling, line noise, dropped bytes and injected URCs
+#
+#   modem = ModemSimulator(latency=0.05, baud=115200)
+#   sim = SIM808(port=modem.port)
+#
+# or from a shell, printing the port to connect to:
+#   python simulator.py --latency 0.05 --baud 115200
+
+import os, pty, tty, threading, time, random, argparse, re
+from SIM808 import gsm7_encode, gsm7_pack, SMS_STAT
+
+# separators of concatenated commands (AT+CMGD=1;+CMGD=2), outside of quoted strings
+CONCATENATED = re.compile(';(?=(?:[^"]*"[^"]*")*[^"]*$)')
+
+class ModemSimulator():
+
+    # latency: seconds between a command and its response
+    # baud: throttle both directions to this baudrate (None = as fast as the pty allows)
+    # noise, drop: probability of every sent byte to be corrupted or lost
+    def __init__(self, latency=0.0, baud=None, noise=0.0, drop=0.0, seed=None):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.latency = latency
+        self.baud = baud
+        self.noise = noise
+        self.drop = drop
+        self.random = random.Random(seed)
+        self.write_lock = threading.Lock()
+
+        # module state
+        self.powered = True
+        self.echo = True
+        self.settings = {}
+        self.sms = []
+        self.sms_index = 0
+        self.sent_sms = []
+        self.message_reference = 0
+        self.emails = []
+        self.body = b''
+        # recipients by kind (0 = to, 1 = cc, 2 = bcc) and attachment names by index
+        self.recipients = {}
+        self.attachment_names = {}
+        self.attachments = None
+        self.registration = 1
+        self.operator = 'E-Plus'
+        self.gps = '1,1,20211010120000.000,52.520008,13.404954,34.5,0.5,90.0,1,,1.2,1.5,0.9,,12,8,3,,40,5.0,7.0'
+        self.gps_urc = 0
+        self.gps_period = 1.0
+        self.bearers = {1:3, 2:3, 3:3}
+        self.ip = '10.0.0.2'
+
+        # FTP server content by directory, names and paths are taken from the FTP settings
+        self.files = {'/': {}}
+        self.put_max = 1360
+        self.get_max = 1460
+        self.get_data = None
+        self.list_data = None
+        # number of uploaded bytes after which the put session fails with a net error, for testing resume
+        self.fail_put_after = None
+
+        # commands as received, for assertions in tests
+        self.log = []
+
+        self.buffer = bytearray()
+        self.data_length = 0
+        self.data_callback = None
+        self.sms_input = None
+        self.final = None
+        self.swallow_ok = False
+        self.running = True
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        self.gps_thread = threading.Thread(target=self.gps_loop, daemon=True)
+        self.gps_thread.start()
+
+    def close(self):
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+    # everything the module sends passes through the simulated link
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.noise or self.drop:
+            out = bytearray()
+            for byte in data:
+                r = self.random.random()
+                if r < self.drop:
+                    continue
+                if r < self.drop+self.noise:
+                    byte = self.random.randrange(256)
+                out.append(byte)
+            data = bytes(out)
+        with self.write_lock:
+            os.write(self.master, data)
+            if self.baud:
+                time.sleep(len(data)*10/self.baud)
+
+    def line(self, text):
+        if text in ('OK', 'ERROR'):
+            self.final = text
+            # only the last of concatenated commands reports OK
+            if text == 'OK' and self.swallow_ok:
+                return
+        self.send('\r\n'+text+'\r\n')
+
+    # send an unsolicited result code, after delay seconds from a separate thread
+    def urc(self, text, delay=0.0):
+        if delay <= 0:
+            self.line(text)
+            return
+        timer = threading.Timer(delay, self.line, (text,))
+        timer.daemon = True
+        timer.start()
+
+    # repeat an unsolicited result code every interval seconds until the simulator is closed
+    def urc_every(self, text, interval):
+        def repeat():
+            while self.running:
+                time.sleep(interval)
+                if self.running and self.powered:
+                    self.line(text)
+        threading.Thread(target=repeat, daemon=True).start()
+
+    # power on after CPOWD, with the start-up messages of the module
+    # boot: seconds until the module answers, like the start-up time after the power pin was toggled
+    def power_on(self, boot=0.0):
+        if boot:
+            threading.Timer(boot, self.power_on).start()
+            return
+        self.powered = True
+        self.settings = {}
+        self.gps_urc = 0
+        self.bearers = {1:3, 2:3, 3:3}
+        for text in ('RDY', '+CFUN: 1', '+CPIN: READY', 'Call Ready', 'SMS Ready'):
+            self.line(text)
+
+    # deactivate a bearer as the network would
+    def drop_bearer(self, cid=1):
+        self.bearers[cid] = 3
+        self.urc('+SAPBR {}: DEACT'.format(cid))
+
+    # store a received SMS, announced by +CMTI like on the module, or pass it on as +CMT if AT+CNMI routes it to the host
+    # long messages are split into concatenated parts, each stored under its own index, returns the indices of stored parts
+    def receive_sms(self, sender, message, timestamp='21/10/10,12:00:00+08'):
+        gsm7 = gsm7_encode(message) is not None
+        single, limit = (160, 153) if gsm7 else (70, 67)
+        def units(text):
+            return len(gsm7_encode(text)) if gsm7 else len(text.encode('utf-16-be'))//2
+        texts = [message]
+        if units(message) > single:
+            texts = ['']
+            for c in message:
+                if units(texts[-1]+c) > limit:
+                    texts.append('')
+                texts[-1] = texts[-1]+c
+        reference = self.random.randrange(256)
+        indices = []
+        for n, text in enumerate(texts):
+            header = bytes([0x05, 0x00, 0x03, reference, len(texts), n+1]) if len(texts) > 1 else b''
+            if gsm7:
+                septets = gsm7_encode(text)
+                fill_bits = (7-len(header)*8 % 7) % 7
+                ud = header+gsm7_pack(septets, fill_bits)
+                length = (len(header)*8+fill_bits)//7+len(septets)
+            else:
+                ud = header+text.encode('utf-16-be')
+                length = len(ud)
+            pdu = self.deliver_pdu(sender, timestamp, 0x00 if gsm7 else 0x08, ud, length, bool(header))
+            # AT+CNMI=<mode>,2 routes messages to the host as +CMT instead of storing them
+            if self.setting('CNMI').split(',')[1:2] == ['2']:
+                if self.setting('CMGF', '1') == '0':
+                    self.urc('+CMT: ,{}\r\n{}'.format(len(pdu)//2-1, pdu))
+                else:
+                    self.urc('+CMT: "{}","","{}"\r\n{}'.format(sender, timestamp, text))
+                continue
+            self.sms_index = self.sms_index+1
+            self.sms.append({'index':self.sms_index, 'stat':'REC UNREAD', 'sender':sender, 'timestamp':timestamp, 'message':text, 'pdu':pdu})
+            self.urc('+CMTI: "SM",{}'.format(self.sms_index))
+            indices.append(self.sms_index)
+        return indices
+
+    # SMS-DELIVER PDU without service centre address, as hex like in AT+CMGL
+    def deliver_pdu(self, sender, timestamp, dcs, ud, length, header):
+        number = sender.lstrip('+')
+        digits = number+('F' if len(number) % 2 else '')
+        address = ''.join(digits[i+1]+digits[i] for i in range(0, len(digits), 2))
+        fields = re.findall('[0-9]{2}', timestamp)
+        zone = int(fields[6][1]+fields[6][0], 16) | (0x08 if '-' in timestamp[17:] else 0)
+        scts = ''.join(field[1]+field[0] for field in fields[:6])+'{:02X}'.format(zone)
+        first = 0x04 | (0x40 if header else 0)
+        return '00{:02X}{:02X}{:02X}{}00{:02X}{}{:02X}{}'.format(first, len(number), 0x91 if sender.startswith('+') else 0x81,
+                                                             address, dcs, scts, length, ud.hex().upper())
+
+    def read_loop(self):
+        while self.running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if self.baud:
+                time.sleep(len(data)*10/self.baud)
+            if not self.powered:
+                continue
+            self.buffer += data
+            while self.process():
+                pass
+
+    # handle one complete unit of input, False if more input is needed
+    def process(self):
+        buffer = self.buffer
+        if self.data_length:
+            if len(buffer) < self.data_length:
+                return False
+            data = bytes(buffer[:self.data_length])
+            del buffer[:self.data_length]
+            self.data_length = 0
+            self.data_callback(data)
+            return True
+        if self.sms_input is not None:
+            # text of AT+CMGS ends with ctrl-z, esc cancels
+            for i in range(len(buffer)):
+                if buffer[i] in (26, 27):
+                    text = bytes(buffer[:i])
+                    cancel = buffer[i] == 27
+                    del buffer[:i+1]
+                    callback = self.sms_input
+                    self.sms_input = None
+                    callback(text, cancel)
+                    return True
+            return False
+        end = buffer.find(b'\r')
+        if end < 0:
+            return False
+        cmd = bytes(buffer[:end]).strip(b'\n').decode('utf-8', 'replace')
+        del buffer[:end+1]
+        if buffer[:1] == b'\n':
+            del buffer[:1]
+        if not cmd:
+            return True
+        self.log.append(cmd)
+        if self.echo:
+            self.send(cmd+'\r')
+        if self.latency:
+            time.sleep(self.latency)
+        self.handle(cmd)
+        return True
+
+    # AT+<name>=<arg>, AT+<name>? and AT+<name>=? are passed to cmd_<name>(arg, query)
+    # set commands without a handler are stored as settings, which read commands without a handler report
+    def handle(self, cmd):
+        if cmd[:2].upper() != 'AT':
+            self.line('ERROR')
+            return
+        # concatenated commands share one final result code and stop at the first error
+        commands = CONCATENATED.split(cmd[2:])
+        for i, body in enumerate(commands):
+            self.final = None
+            self.swallow_ok = i < len(commands)-1
+            self.execute(body)
+            if self.final == 'ERROR':
+                break
+        self.swallow_ok = False
+
+    def execute(self, body):
+        if body in ('E0', 'E1'):
+            self.echo = body == 'E1'
+            self.line('OK')
+            return
+        name, sep, arg = body.partition('=')
+        query = name.endswith('?')
+        name = name.strip('+?').upper()
+        if sep and arg != '?':
+            self.settings[name] = arg
+        handler = getattr(self, 'cmd_'+name.lower(), None)
+        if handler is not None:
+            handler(arg if sep else None, query)
+        elif not name or sep:
+            self.line('OK')
+        elif query and name in self.settings:
+            self.line('+{}: {}'.format(name, self.settings[name]))
+            self.line('OK')
+        else:
+            self.line('ERROR')
+
+    def setting(self, name, default=''):
+        return self.settings.get(name, default).strip('"')
+
+    def cmd_ccid(self, arg, query):
+        self.line('8949020000012345678')
+        self.line('OK')
+
+    def cmd_cpowd(self, arg, query):
+        self.line('NORMAL POWER DOWN')
+        self.powered = False
+
+    def cmd_creg(self, arg, query):
+        if query:
+            self.line('+CREG: 0,{}'.format(self.registration))
+        self.line('OK')
+
+    def cmd_cops(self, arg, query):
+        if arg == '?':
+            self.line('+COPS: (2,"{0}","{0}","26203"),(3,"T-Mobile D","TMO D","26201"),,(0-4),(0-2)'.format(self.operator))
+        elif query:
+            self.line('+COPS: 0,0,"{}"'.format(self.operator))
+        self.line('OK')
+
+    def cmd_ipr(self, arg, query):
+        if query:
+            self.line('+IPR: {}'.format(self.settings.get('IPR', '115200')))
+        elif arg and int(arg) and self.baud:
+            # answer at the new rate from the next command on
+            self.baud = int(arg)
+        self.line('OK')
+
+    def cmd_csclk(self, arg, query):
+        if query:
+            self.line('+CSCLK: {}'.format(self.settings.get('CSCLK', '0')))
+        self.line('OK')
+
+    # GPS
+
+    def cmd_cgnsinf(self, arg, query):
+        if self.settings.get('CGNSPWR') == '0':
+            self.line('+CGNSINF: 0,,,,,,,,,,,,,,,,,,,,')
+        else:
+            self.line('+CGNSINF: '+self.gps)
+        self.line('OK')
+
+    def cmd_cgnsurc(self, arg, query):
+        if query:
+            self.line('+CGNSURC: {}'.format(self.gps_urc))
+        elif arg:
+            self.gps_urc = int(arg)
+        self.line('OK')
+
+    # every gps_urc-th fix is reported as +UGNSINF, one fix per gps_period
+    def gps_loop(self):
+        count = 0
+        while self.running:
+            time.sleep(self.gps_period)
+            count = count+1
+            if self.powered and self.gps_urc and count % self.gps_urc == 0:
+                self.line('+UGNSINF: '+self.gps)
+
+    # SMS in text mode
+
+    # text mode lists by stat name, PDU mode (AT+CMGF=0) by stat number
+    def cmd_cmgl(self, arg, query):
+        pdu = self.settings.get('CMGF') == '0'
+        values = (arg or ('4' if pdu else '"ALL"')).split(',')
+        stat = SMS_STAT.get(int(values[0]), '') if pdu else values[0].strip('"')
+        keep = len(values) > 1 and values[1] == '1'
+        numbers = {name:number for number, name in SMS_STAT.items()}
+        for sms in self.sms:
+            if stat not in ('ALL', sms['stat']):
+                continue
+            if pdu:
+                self.line('+CMGL: {},{},,{}\r\n{}'.format(sms['index'], numbers[sms['stat']], len(sms['pdu'])//2-1, sms['pdu']))
+            else:
+                self.line('+CMGL: {},"{}","{}","","{}"\r\n{}'.format(sms['index'], sms['stat'], sms['sender'], sms['timestamp'], sms['message']))
+            if not keep and sms['stat'] == 'REC UNREAD':
+                sms['stat'] = 'REC READ'
+        self.line('OK')
+
+    # AT+CMGD=<index>[,<delflag>], delflag 4 deletes all messages
+    def cmd_cmgd(self, arg, query):
+        values = arg.split(',')
+        if len(values) > 1 and values[1] == '4':
+            self.sms = []
+        else:
+            self.sms = [sms for sms in self.sms if sms['index'] != int(values[0])]
+        self.line('OK')
+
+    # text mode: AT+CMGS="<number>", PDU mode: AT+CMGS=<length> followed by the PDU in hex
+    def cmd_cmgs(self, arg, query):
+        pdu = self.settings.get('CMGF') == '0'
+        number = arg.strip('"')
+        def sent(text, cancel):
+            if cancel:
+                return
+            self.message_reference = (self.message_reference+1) % 256
+            if pdu:
+                sms = {'pdu':text.decode('utf-8', 'replace'), 'length':int(arg), 'mr':self.message_reference}
+            else:
+                sms = {'number':number, 'message':text.decode('utf-8', 'replace'), 'mr':self.message_reference}
+            self.sent_sms.append(sms)
+            self.line('+CMGS: {}'.format(self.message_reference))
+            self.line('OK')
+        self.sms_input = sent
+        self.send('\r\n> ')
+
+    # bearer
+
+    # AT+SAPBR=<cmd>,<cid>[,...]: 0 close, 1 open, 2 query, 3 set parameter
+    def cmd_sapbr(self, arg, query):
+        values = arg.split(',')
+        action = int(values[0])
+        cid = int(values[1])
+        if action == 1:
+            if self.bearers[cid] == 1:
+                self.line('ERROR')
+                return
+            self.bearers[cid] = 1
+        elif action == 0:
+            if self.bearers[cid] == 3:
+                self.line('ERROR')
+                return
+            self.bearers[cid] = 3
+        elif action == 2:
+            ip = self.ip if self.bearers[cid] == 1 else '0.0.0.0'
+            self.line('+SAPBR: {},{},"{}"'.format(cid, self.bearers[cid], ip))
+        self.line('OK')
+
+    # FTP, results of sessions are reported as URCs like on the module
+
+    def ftp_connected(self):
+        return self.bearers.get(int(self.setting('FTPCID', '1')), 3) == 1
+
+    def ftp_directory(self, name):
+        return self.files.setdefault(self.setting(name, '/'), {})
+
+    def cmd_ftpput(self, arg, query):
+        values = arg.split(',')
+        if values[0] == '1':
+            self.line('OK')
+            if not self.ftp_connected():
+                self.urc('+FTPPUT: 1,61', self.latency)
+                return
+            directory = self.ftp_directory('FTPPUTPATH')
+            name = self.setting('FTPPUTNAME')
+            if self.setting('FTPPUTOPT', 'STOR') != 'APPE' or name not in directory:
+                directory[name] = b''
+            self.urc('+FTPPUT: 1,1,{}'.format(self.put_max), self.latency)
+            return
+        length = int(values[1])
+        if length == 0:
+            self.line('OK')
+            self.urc('+FTPPUT: 1,0', self.latency)
+            return
+        if length > self.put_max:
+            self.line('ERROR')
+            return
+        def received(data):
+            directory = self.ftp_directory('FTPPUTPATH')
+            name = self.setting('FTPPUTNAME')
+            directory[name] = directory.get(name, b'')+data
+            self.line('OK')
+            if self.fail_put_after is not None and len(directory[name]) >= self.fail_put_after:
+                self.fail_put_after = None
+                self.urc('+FTPPUT: 1,61', self.latency)
+            else:
+                self.urc('+FTPPUT: 1,1,{}'.format(self.put_max), self.latency)
+        self.line('+FTPPUT: 2,{}'.format(length))
+        self.data_length = length
+        self.data_callback = received
+
+    # AT+FTPGET=1 opens the session, AT+FTPGET=2,<n> reads up to n bytes
+    def cmd_ftpget(self, arg, query):
+        values = arg.split(',')
+        if values[0] == '1':
+            self.line('OK')
+            data = self.ftp_directory('FTPGETPATH').get(self.setting('FTPGETNAME'))
+            if not self.ftp_connected():
+                self.urc('+FTPGET: 1,61', self.latency)
+            elif data is None:
+                self.urc('+FTPGET: 1,77', self.latency)
+            else:
+                self.get_data = bytearray(data[int(self.setting('FTPREST', '0')):])
+                self.urc('+FTPGET: 1,1', self.latency)
+            return
+        self.ftp_read('FTPGET', 'get_data', int(values[1]))
+
+    def cmd_ftplist(self, arg, query):
+        values = arg.split(',')
+        if values[0] == '1':
+            self.line('OK')
+            if not self.ftp_connected():
+                self.urc('+FTPLIST: 1,61', self.latency)
+                return
+            directory = self.ftp_directory('FTPGETPATH')
+            lines = ['-rw-r--r--    1 user     group    {:8d} Oct 10 12:00 {}\r\n'.format(len(data), name) for name, data in directory.items()]
+            self.list_data = bytearray(''.join(lines).encode('utf-8'))
+            self.urc('+FTPLIST: 1,1', self.latency)
+            return
+        self.ftp_read('FTPLIST', 'list_data', int(values[1]))
+
+    def ftp_read(self, command, attribute, length):
+        data = getattr(self, attribute)
+        if data is None or length > self.get_max:
+            self.line('ERROR')
+            return
+        chunk = bytes(data[:length])
+        del data[:length]
+        if chunk:
+            self.send('\r\n+{}: 2,{}\r\n'.format(command, len(chunk)).encode('utf-8')+chunk)
+            self.line('OK')
+        else:
+            self.line('+{}: 2,0'.format(command))
+            self.line('OK')
+            setattr(self, attribute, None)
+            self.urc('+{}: 1,0'.format(command), self.latency)
+
+    # ends the FTP session, data that was not read yet is dropped
+    def cmd_ftpquit(self, arg, query):
+        self.get_data = None
+        self.list_data = None
+        self.line('OK')
+
+    def cmd_ftpsize(self, arg, query):
+        self.line('OK')
+        data = self.ftp_directory('FTPGETPATH').get(self.setting('FTPGETNAME'))
+        if not self.ftp_connected():
+            self.urc('+FTPSIZE: 1,61,0', self.latency)
+        elif data is None:
+            self.urc('+FTPSIZE: 1,77,0', self.latency)
+        else:
+            self.urc('+FTPSIZE: 1,0,{}'.format(len(data)), self.latency)
+
+    def cmd_ftpdele(self, arg, query):
+        self.line('OK')
+        directory = self.ftp_directory('FTPGETPATH')
+        name = self.setting('FTPGETNAME')
+        if name not in directory:
+            self.urc('+FTPDELE: 1,77', self.latency)
+            return
+        del directory[name]
+        self.urc('+FTPDELE: 1,0', self.latency)
+
+    def cmd_ftpmkd(self, arg, query):
+        self.line('OK')
+        self.files.setdefault(self.setting('FTPGETPATH', '/'), {})
+        self.urc('+FTPMKD: 1,0', self.latency)
+
+    def cmd_ftprmd(self, arg, query):
+        self.line('OK')
+        result = 0 if self.files.pop(self.setting('FTPGETPATH', '/'), None) is not None else 77
+        self.urc('+FTPRMD: 1,{}'.format(result), self.latency)
+
+    # SMTP, the body is sent as hex by SIM808.email_send
+
+    def cmd_smtpbody(self, arg, query):
+        def received(data):
+            self.body = data
+            self.line('OK')
+        self.body = b''
+        self.data_length = int(arg)
+        self.data_callback = received
+        self.line('DOWNLOAD')
+
+    def cmd_smtprcpt(self, arg, query):
+        values = arg.split(',', 2)
+        if len(values) < 3:
+            self.recipients.pop(values[0], None)
+        else:
+            self.recipients[values[0]] = arg
+        self.line('OK')
+
+    def cmd_smtpfile(self, arg, query):
+        values = arg.split(',')
+        if values[1].strip('"'):
+            self.attachment_names[int(values[0])] = values[1].strip('"')
+        else:
+            self.attachment_names.pop(int(values[0]), None)
+        self.line('OK')
+
+    # attachments are requested one after the other with +SMTPFT: 1,<max length> once the email is sent
+    def cmd_smtpsend(self, arg, query):
+        self.line('OK')
+        if self.bearers.get(int(self.setting('EMAILCID', '1')), 3) != 1:
+            self.urc('+SMTPSEND: 61', self.latency)
+            return
+        self.attachments = [(self.attachment_names[index], bytearray()) for index in sorted(self.attachment_names)]
+        self.attachment_index = 0
+        if self.attachments:
+            self.urc('+SMTPFT: 1,{}'.format(self.put_max), self.latency)
+        else:
+            self.smtp_sent()
+
+    def cmd_smtpft(self, arg, query):
+        length = int(arg)
+        if self.attachments is None or length > self.put_max:
+            self.line('ERROR')
+            return
+        if length == 0:
+            self.line('OK')
+            self.attachment_index = self.attachment_index+1
+            if self.attachment_index < len(self.attachments):
+                self.urc('+SMTPFT: 1,{}'.format(self.put_max), self.latency)
+            else:
+                self.smtp_sent()
+            return
+        def received(data):
+            self.attachments[self.attachment_index][1].extend(data)
+            self.line('OK')
+            self.urc('+SMTPFT: 1,{}'.format(self.put_max), self.latency)
+        self.line('+SMTPFT: 2,{}'.format(length))
+        self.data_length = length
+        self.data_callback = received
+
+    def smtp_sent(self):
+        self.emails.append({'to':self.recipients.get('0'), 'cc':self.recipients.get('1'), 'bcc':self.recipients.get('2'),
+                            'subject':self.setting('SMTPSUB'), 'body':self.body,
+                            'attachments':{name:bytes(data) for name, data in self.attachments or []}})
+        self.attachments = None
+        self.urc('+SMTPSEND: 1', self.latency)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulated SIM808 module on a pseudo-terminal')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before every response')
+    parser.add_argument('--baud', type=int, default=None, help='throttle the link to this baudrate')
+    parser.add_argument('--noise', type=float, default=0.0, help='probability of a corrupted byte')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of a lost byte')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--urc', action='append', default=[], help='unsolicited result code to inject repeatedly')
+    parser.add_argument('--urc-interval', type=float, default=10.0)
+    args = parser.parse_args()
+    modem = ModemSimulator(latency=args.latency, baud=args.baud, noise=args.noise, drop=args.drop, seed=args.seed)
+    for text in args.urc:
+        modem.urc_every(text, args.urc_interval)
+    print(modem.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        modem.close()
@@ -0,0 +1,48 @@
+# email outbox against the simulated module in simulator.py
+#
+#   python -m pytest test_email.py
+
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simulator import ModemSimulator
+from SIM808 import SIM808, EmailOutbox
+
+class EmailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = ModemSimulator()
+        self.sim = SIM808(port=self.modem.port, t_out=0.5, verbose=0)
+        self.sim.email_parameters("internet", "smtp.example.com", 25, "user", "pwd", "pi@example.com", "Pi")
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.sim.reading = False
+        self.modem.close()
+
+    def test_outbox_sends_attachments(self):
+        path = os.path.join(self.dir, 'log.csv')
+        with open(path, 'wb') as f:
+            f.write(b'1,2,3\n'*1000)
+        outbox = EmailOutbox(os.path.join(self.dir, 'outbox.json'))
+        outbox.add('Log', 'see attachment', 'a@example.com', 'A', attachments=[path])
+        outbox.add('Hello', 'no attachment', 'b@example.com', 'B', cc_address='c@example.com', cc_name='C')
+        result = self.sim.email_send_outbox(outbox)
+        self.assertEqual(result['sent'], 2)
+        self.assertEqual(self.modem.emails[0]['attachments'], {'log.csv':b'1,2,3\n'*1000})
+        # recipients and attachments of the first email do not stay set for the second
+        self.assertEqual(self.modem.emails[1]['attachments'], {})
+        self.assertIsNone(self.modem.emails[0]['cc'])
+        self.assertEqual(EmailOutbox(outbox.path).pending(), [])
+
+    def test_outbox_corrupt_file(self):
+        path = os.path.join(self.dir, 'outbox.json')
+        with open(path, 'w') as f:
+            f.write('not json')
+        with self.assertLogs('SIM808', 'WARNING'):
+            outbox = EmailOutbox(path)
+        self.assertEqual(outbox.messages, [])
+        with open(path+'.bad') as f:
+            self.assertEqual(f.read(), 'not json')
+
+if __name__ == '__main__':
+    unittest.main()
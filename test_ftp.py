@@ -0,0 +1,122 @@
+# resumable FTP transfers and the FTP cache against the simulated module in simulator.py
+#
+#   python -m pytest test_ftp.py
+
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simulator import ModemSimulator
+from SIM808 import SIM808, TransferJournal, FTPCache
+
+class FTPTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = ModemSimulator()
+        self.sim = SIM808(port=self.modem.port, t_out=0.5, verbose=0)
+        self.sim.ftp_parameters(apn="internet", server="ftp.example.com", port=21, user="user", pwd="pwd")
+        self.assertTrue(self.sim.ftp_initialize())
+        self.dir = tempfile.mkdtemp()
+        self.data = bytes(range(256))*24
+        self.path = os.path.join(self.dir, 'log.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.journal = TransferJournal(os.path.join(self.dir, 'journal.json'), interval=1)
+        self.key = self.journal.key('upload', '/', 'log.bin')
+
+    def tearDown(self):
+        self.sim.reading = False
+        self.modem.close()
+
+    def stored(self):
+        return self.modem.files['/'].get('log.bin')
+
+    def interrupted_upload(self):
+        self.modem.fail_put_after = 2000
+        self.assertFalse(self.sim.ftp_file_upload_journal(self.path, '/', self.journal, attempts=1))
+        self.assertTrue(self.sim.ftp_reconnect())
+        entry = self.journal.get(self.key)
+        self.assertGreater(entry['offset'], 0)
+        self.assertEqual(self.stored(), self.data[:entry['offset']])
+        return entry
+
+    def test_upload_resumes(self):
+        self.interrupted_upload()
+        del self.modem.log[:]
+        self.assertTrue(self.sim.ftp_file_upload_journal(self.path, '/', self.journal, validate=True))
+        self.assertIn('AT+FTPPUTOPT="APPE"', self.modem.log)
+        self.assertEqual(self.stored(), self.data)
+        self.assertIsNone(TransferJournal(self.journal.path).get(self.key))
+
+    def test_upload_keeps_journal_without_size(self):
+        entry = dict(self.interrupted_upload())
+        # the size of the remote file is unknown without a bearer
+        self.modem.drop_bearer()
+        self.assertIsNone(self.sim.ftp_get_filesize('/', 'log.bin', attempts=1))
+        self.assertFalse(self.sim.ftp_file_upload_journal(self.path, '/', self.journal, attempts=1))
+        self.assertEqual(self.journal.get(self.key), entry)
+
+    def test_upload_restarts_after_local_change(self):
+        self.interrupted_upload()
+        with open(self.path, 'r+b') as f:
+            f.write(b'changed')
+        # same size and modification time, only the checksum shows the change
+        entry = self.journal.get(self.key)
+        os.utime(self.path, (entry['mtime'], entry['mtime']))
+        del self.modem.log[:]
+        self.assertTrue(self.sim.ftp_file_upload_journal(self.path, '/', self.journal))
+        self.assertNotIn('AT+FTPPUTOPT="APPE"', self.modem.log)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.stored(), f.read())
+
+    def test_filesize(self):
+        self.modem.files['/']['log.bin'] = self.data
+        self.assertEqual(self.sim.ftp_get_filesize('/', 'log.bin'), len(self.data))
+        self.assertEqual(self.sim.ftp_get_filesize('/', 'missing.bin'), 0)
+
+    def test_download_postponed_without_size(self):
+        self.modem.files['/']['log.bin'] = self.data
+        path = os.path.join(self.dir, 'download.bin')
+        key = self.journal.key('download', '/', 'log.bin')
+        self.journal.start(key, '/', 'log.bin', path, len(self.data), offset=1000, crc=self.journal.checksum(self.path, 1000))
+        with open(path, 'wb') as f:
+            f.write(self.data[:1000])
+        self.modem.drop_bearer()
+        output = self.sim.ftp_file_download_journal('log.bin', '/', path, self.journal, attempts=1)
+        self.assertFalse(output['complete'])
+        self.assertEqual(self.journal.get(key)['offset'], 1000)
+        self.assertEqual(os.path.getsize(path), 1000)
+
+    def test_sync_uses_cache(self):
+        local = os.path.join(self.dir, 'sync')
+        os.mkdir(local)
+        for name in ('a.csv', 'b.csv'):
+            with open(os.path.join(local, name), 'wb') as f:
+                f.write(name.encode('utf-8')*100)
+        self.sim.ftp_cache = FTPCache(path=os.path.join(self.dir, 'cache.json'))
+        result = self.sim.ftp_sync(local, '/logs/')
+        self.assertEqual(len(result['uploaded']), 2)
+        self.assertEqual(self.modem.files['/logs/']['a.csv'], b'a.csv'*100)
+        # the second sync is answered from the cache without listing or uploading
+        del self.modem.log[:]
+        result = self.sim.ftp_sync(local, '/logs/')
+        self.assertEqual(len(result['unchanged']), 2)
+        self.assertFalse([cmd for cmd in self.modem.log if cmd.startswith(('AT+FTPLIST', 'AT+FTPPUT'))])
+        # a file changed with the same size is uploaded again
+        path = os.path.join(local, 'b.csv')
+        with open(path, 'wb') as f:
+            f.write(b'B.csv'*100)
+        os.utime(path, (1, 1))
+        result = self.sim.ftp_sync(local, '/logs/')
+        self.assertEqual(result['uploaded'], [path])
+        self.assertEqual(self.modem.files['/logs/']['b.csv'], b'B.csv'*100)
+
+    def test_cache_corrupt_file(self):
+        path = os.path.join(self.dir, 'cache.json')
+        with open(path, 'w') as f:
+            f.write('{"ftp.example.com:21|/": ')
+        cache = FTPCache(path=path)
+        self.assertEqual(cache.dirs, {})
+        cache.set_size('ftp.example.com:21', '/', 'log.bin', 10)
+        self.assertEqual(FTPCache(path=path).size('ftp.example.com:21', '/', 'log.bin'), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+# serial recordings against the simulated module in simulator.py
+#
+#   python -m pytest test_recording.py
+
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simulator import ModemSimulator
+from SIM808 import SIM808, read_recording
+
+class RecordingTest(unittest.TestCase):
+
+    def test_record_command(self):
+        modem = ModemSimulator()
+        sim = SIM808(port=modem.port, verbose=0)
+        path = os.path.join(tempfile.mkdtemp(), 'session.rec')
+        # the reader is already waiting for data on the port when the recording starts
+        sim.record(path)
+        final, frames = sim.write_command('AT+CREG?')
+        sim.record_stop()
+        sim.reading = False
+        modem.close()
+        self.assertEqual(final, b'OK')
+        records = list(read_recording(path))
+        self.assertEqual(b''.join(data for direction, seconds, data in records if direction == b'>'), b'AT+CREG?\r\n')
+        self.assertEqual(b''.join(data for direction, seconds, data in records if direction == b'<'),
+                         b'AT+CREG?\r\r\n+CREG: 0,1\r\n\r\nOK\r\n')
+
+if __name__ == '__main__':
+    unittest.main()
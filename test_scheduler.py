@@ -0,0 +1,87 @@
+# duty cycle scheduler against the simulated module in simulator.py
+#
+#   python -m pytest test_scheduler.py
+
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simulator import ModemSimulator
+from SIM808 import SIM808, DutyCycleScheduler
+
+# stands in for RPi.GPIO, the simulator has no DTR line
+class FakeGPIO():
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.pins = {}
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+
+    def cleanup(self, pin=None):
+        pass
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = ModemSimulator()
+        self.sim = SIM808(port=self.modem.port, t_out=0.5, verbose=0)
+
+    def tearDown(self):
+        self.sim.reading = False
+        self.modem.close()
+
+    def test_jobs_ride_along(self):
+        scheduler = DutyCycleScheduler(self.sim, idle=None, lead=30)
+        order = []
+        scheduler.add(lambda sim: order.append('later') or True, deadline=3600)
+        # no window is due before the deadline comes near
+        self.assertIsNone(scheduler.run_pending())
+        scheduler.add(lambda sim: order.append('urgent') or True, deadline=0, priority=1)
+        record = scheduler.run_pending()
+        self.assertEqual(order, ['urgent', 'later'])
+        self.assertEqual([job['done'] for job in record['jobs']], [True, True])
+        self.assertIsNone(scheduler.next_window())
+        self.assertEqual(scheduler.stats()['windows'], 1)
+        self.assertEqual(self.sim.metrics.counters['jobs_late'], 1)
+
+    def test_failed_job_retried_until_attempts(self):
+        scheduler = DutyCycleScheduler(self.sim, idle=None, attempts=2, retry=0)
+        calls = []
+        scheduler.add(lambda sim: calls.append(1) and False, deadline=0)
+        scheduler.run_window()
+        self.assertEqual(len(scheduler.jobs), 1)
+        self.assertEqual(scheduler.jobs[0]['attempts'], 1)
+        scheduler.run_window()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(scheduler.jobs, [])
+        self.assertEqual(scheduler.stats()['jobs_failed'], 2)
+
+    def test_network_job_needs_apn(self):
+        scheduler = DutyCycleScheduler(self.sim, idle=None)
+        with self.assertRaises(ValueError):
+            scheduler.add(lambda sim: True, network=True)
+        self.sim.ftp_parameters(apn="internet", server="ftp.example.com", port=21, user="user", pwd="pwd")
+        scheduler.add(lambda sim: sim.bearers.get(1) == 1, deadline=0, network=True)
+        record = scheduler.run_window()
+        self.assertTrue(record['jobs'][0]['done'])
+        self.assertEqual(self.modem.bearers[1], 1)
+
+    def test_standby_between_windows(self):
+        self.sim.gpio = FakeGPIO()
+        self.sim.dtr_pin = 7
+        scheduler = DutyCycleScheduler(self.sim, idle='standby')
+        scheduler.add(lambda sim: sim.write_simple_command('AT'), deadline=0)
+        record = scheduler.run_window()
+        self.assertTrue(record['awake'])
+        self.assertTrue(record['jobs'][0]['done'])
+        # the module is back in slow clock with DTR high after the window
+        self.assertEqual(self.sim.gpio.pins[7], FakeGPIO.HIGH)
+        self.assertEqual(self.sim.settings.get('AT+CSCLK'), 'AT+CSCLK=1')
+
+    def test_standby_needs_dtr_pin(self):
+        with self.assertRaises(ValueError):
+            DutyCycleScheduler(self.sim, idle='standby')
+
+if __name__ == '__main__':
+    unittest.main()
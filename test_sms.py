@@ -0,0 +1,110 @@
+# SMS PDU codec, inbox and queue against the simulated module in simulator.py
+#
+#   python -m pytest test_sms.py
+
+import os, sys, tempfile, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simulator import ModemSimulator
+from SIM808 import SIM808, SMSInbox, SMSQueue, pdu_decode, pdu_encode_submit
+
+LONG_TEXT = 'The quick brown fox jumps over the lazy dog [{}] and keeps running. '*5
+
+class PDUTest(unittest.TestCase):
+
+    def test_single_gsm7(self):
+        pdus = pdu_encode_submit('+491234567', 'Hello {world} ~ 100€')
+        self.assertEqual(len(pdus), 1)
+        message = pdu_decode(pdus[0][0])
+        self.assertEqual(message['number'], '+491234567')
+        self.assertEqual(message['text'], 'Hello {world} ~ 100€')
+        self.assertEqual(message['parts'], 1)
+
+    def test_multipart_ucs2(self):
+        text = 'Grüße aus Köln 😀 '*10
+        pdus = pdu_encode_submit('01701234567', text, reference=300)
+        self.assertGreater(len(pdus), 1)
+        messages = [pdu_decode(pdu) for pdu, length in pdus]
+        self.assertEqual([m['part'] for m in messages], list(range(1, len(pdus)+1)))
+        self.assertTrue(all(m['reference'] == 300 % 256 and m['parts'] == len(pdus) for m in messages))
+        self.assertEqual(''.join(m['text'] for m in messages), text)
+        # the length for AT+CMGS does not count the empty service centre address
+        self.assertTrue(all(length == len(pdu)//2-1 for pdu, length in pdus))
+
+    def test_multipart_gsm7_split(self):
+        # escape sequences take two septets and must not be split between parts
+        text = '{'*100
+        pdus = pdu_encode_submit('+491234567', text)
+        self.assertEqual(''.join(pdu_decode(pdu)['text'] for pdu, length in pdus), text)
+
+class SMSModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = ModemSimulator()
+        self.sim = SIM808(port=self.modem.port, t_out=0.5, verbose=0)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.sim.reading = False
+        self.modem.close()
+
+    def test_iter_joins_parts(self):
+        self.modem.receive_sms('+491234567', LONG_TEXT)
+        self.modem.receive_sms('+497654321', 'short')
+        messages = list(self.sim.sms_iter(delete=True))
+        self.assertEqual(sorted(m['message'] for m in messages), sorted([LONG_TEXT, 'short']))
+        joined = next(m for m in messages if m['sender'] == '+491234567')
+        self.assertGreater(len(joined['index']), 1)
+        self.assertEqual(self.modem.sms, [])
+
+    def test_inbox_receives_parts(self):
+        inbox = SMSInbox(os.path.join(self.dir, 'inbox.jsonl'))
+        received = []
+        self.sim.sms_subscribe(received.append)
+        self.assertTrue(self.sim.write_setting('AT+CMGF=0'))
+        self.assertTrue(self.sim.sms_receive_start(inbox))
+        self.modem.receive_sms('+491234567', LONG_TEXT, timestamp='21/10/10,12:00:00+08')
+        self.modem.receive_sms('+497654321', 'later', timestamp='21/10/10,13:00:00+08')
+        deadline = time.monotonic()+5
+        while len(received) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([m['message'] for m in received], [LONG_TEXT, 'later'])
+        # the index is rebuilt from the file, parts are not listed as messages of their own
+        inbox = SMSInbox(inbox.path)
+        self.assertEqual(len(inbox), 2)
+        self.assertEqual([m['message'] for m in inbox.sender('+491234567')], [LONG_TEXT])
+        start = received[1]['time']
+        self.assertEqual([m['message'] for m in inbox.between(start, start+1)], ['later'])
+        self.assertEqual([m['message'] for m in inbox.latest(1)], ['later'])
+
+    def test_inbox_cut_line(self):
+        path = os.path.join(self.dir, 'inbox.jsonl')
+        inbox = SMSInbox(path)
+        inbox.add({'sender':'+491234567', 'timestamp':'21/10/10,12:00:00+08', 'message':'one', 'data':None})
+        with open(path, 'ab') as f:
+            f.write(b'{"sender": "+49')
+        inbox = SMSInbox(path)
+        self.assertEqual(len(inbox), 1)
+        self.assertEqual(os.path.getsize(path), inbox.size)
+
+    def test_queue_sends_parts(self):
+        queue = SMSQueue(os.path.join(self.dir, 'queue.json'))
+        queue.add('+491234567', LONG_TEXT)
+        result = self.sim.sms_send_queue(queue)
+        self.assertEqual(result['sent'], 1)
+        self.assertEqual(result['parts'], len(queue.messages[0]['parts']))
+        self.assertEqual(len(self.modem.sent_sms), result['parts'])
+        self.assertEqual(SMSQueue(queue.path).pending(), [])
+
+    def test_queue_corrupt_file(self):
+        path = os.path.join(self.dir, 'queue.json')
+        with open(path, 'w') as f:
+            f.write('[{"id": 1,')
+        with self.assertLogs('SIM808', 'WARNING'):
+            queue = SMSQueue(path)
+        self.assertEqual(queue.messages, [])
+        self.assertTrue(os.path.exists(path+'.bad'))
+        queue.add('+491234567', 'after')
+        self.assertEqual(len(SMSQueue(path).messages), 1)
+
+if __name__ == '__main__':
+    unittest.main()